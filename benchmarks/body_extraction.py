@@ -0,0 +1,80 @@
+"""
+Compares the body extraction of `BodyExtractor` with the BeautifulSoup one it replaced
+
+    python benchmarks/body_extraction.py [--emails 200] [--repeat 5]
+"""
+from __future__ import annotations
+
+import timeit
+from argparse import ArgumentParser
+from email.message import EmailMessage, Message
+
+from bs4 import BeautifulSoup
+
+from email_reader.body import BodyExtractor
+
+ROW = '''
+<tr><td style="padding: 8px">
+<a href="https://example.com/item/{index}"><img src="https://example.com/{index}.png"></a></td>
+<td><h3>Item {index} &amp; More</h3><p>Deal of the week, <b>{index}% off</b> for a limited time only.</p></td></tr>
+'''
+
+
+def newsletter_html(rows: int) -> str:
+    body = ''.join(ROW.format(index=index) for index in range(rows))
+    return (
+        '<html><head><style>td { font-family: sans-serif; }</style></head><body>'
+        f'<table>{body}</table><p>Unsubscribe</p></body></html>'
+    )
+
+
+def newsletters(count: int, rows: int) -> list[EmailMessage]:
+    html = newsletter_html(rows)
+    messages = []
+    for index in range(count):
+        message = EmailMessage()
+        message['Subject'] = f'Newsletter {index}'
+        if index % 2:
+            message.set_content(f'Newsletter {index} in plain text')
+            message.add_alternative(html, subtype='html')
+        else:
+            message.set_content(html, subtype='html')
+        messages.append(message)
+    return messages
+
+
+def legacy_body(email_message: Message) -> str:
+    """The extraction done by `Email.from_email_message` before `BodyExtractor`"""
+    body = ''
+    for part in email_message.walk():
+        if 'attachment' in str(part.get('Content-Disposition')):
+            continue
+        if part.get_content_type() == 'text/plain':
+            body = part.get_payload(decode=True).decode()  # type: ignore
+        elif part.get_content_type() == 'text/html':
+            html = part.get_payload(decode=True).decode()  # type: ignore
+            body = '\n'.join(BeautifulSoup(html, 'html.parser').stripped_strings)
+    return body
+
+
+def run() -> None:
+    parser = ArgumentParser(description='Body Extraction Micro Benchmark')
+    parser.add_argument('--emails', type=int, default=200)
+    parser.add_argument('--rows', help='Table Rows in Each Newsletter', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    messages = newsletters(args.emails, args.rows)
+    extractors = {
+        'legacy bs4': legacy_body,
+        'stdlib': BodyExtractor(),
+        'bs4': BodyExtractor(html_parser='bs4'),
+    }
+
+    for name, extract in extractors.items():
+        seconds = min(timeit.repeat(lambda: [extract(message) for message in messages], number=1, repeat=args.repeat))
+        print(f'{name:>12}: {seconds * 1000:8.1f} ms, {args.emails / seconds:8.0f} Emails/s')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,346 @@
+"""
+End to end benchmark of loading a synthetic mailbox and running a rule set over it
+
+    python -m benchmarks.pipeline [--messages 10000] [--rules 50] [--latency 0.05] [--output results.json]
+    python -m benchmarks.pipeline --messages 1000000 --compare results.json
+
+Drives `load_emails` and `process_emails` against a `MockGmailService` serving a `SyntheticMailbox`,
+every round trip takes `--latency` seconds plus up to `--jitter` more. For each stage the throughput,
+the p50/p99 latency of its operations and the peak RSS are reported, and saved as JSON with `--output`.
+`--compare` fails when a stage is slower or bigger than in an earlier result by more than `--threshold`
+"""
+from __future__ import annotations
+
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.synthetic import SyntheticMailbox, synthetic_rules
+
+console = Console()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+class MemorySampler:
+    """Peak resident memory while running, sampled from /proc or taken from `getrusage` elsewhere"""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    @staticmethod
+    def current_rss() -> int:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import resource
+        except ImportError:
+            return 0
+        # Peak of the whole process, in KiB on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current_rss())
+
+    def __enter__(self) -> MemorySampler:
+        self.peak = self.current_rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+@dataclass
+class StageResult:
+    seconds: float = 0.0
+    items: int = 0
+    round_trips: int = 0
+    fetched_mb: float = 0.0
+    peak_rss_mb: float = 0.0
+    latency_ms: dict[str, dict[str, float]] = field(default_factory=dict)
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def to_json(self) -> dict[str, Any]:
+        return {**asdict(self), 'items_per_second': self.items_per_second}
+
+
+class Stage:
+    """Times a stage, its operations are wrapped with `timed` to collect their latencies"""
+
+    def __init__(self, service) -> None:
+        self.service = service
+        self.samples: dict[str, list[float]] = {}
+        self.result = StageResult()
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        samples = self.samples.setdefault(name, [])
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - started)
+        return wrapper
+
+    @contextmanager
+    def run(self) -> Iterator[Stage]:
+        from email_reader.metrics import metrics
+
+        service = self.service
+        fetchers = (service.fetcher, service.metadata_fetcher)
+        for fetcher in fetchers:
+            fetcher._fetch_batch = self.timed('messages.get batch', fetcher._fetch_batch)
+        service.batch_modify = self.timed('messages.batchModify', service.batch_modify)
+        round_trips = service._service.round_trips
+        fetched = metrics.value('gmail_fetched_bytes_total')
+
+        try:
+            with MemorySampler() as memory:
+                started = time.perf_counter()
+                yield self
+                self.result.seconds = time.perf_counter() - started
+        finally:
+            for fetcher in fetchers:
+                del fetcher._fetch_batch
+            del service.batch_modify
+
+        self.result.round_trips = service._service.round_trips - round_trips
+        self.result.fetched_mb = (metrics.value('gmail_fetched_bytes_total') - fetched) / 2 ** 20
+        self.result.peak_rss_mb = memory.peak / 2 ** 20
+        self.result.latency_ms = {
+            name: {
+                'count': len(samples),
+                'p50': percentile(samples, 0.5) * 1000,
+                'p99': percentile(samples, 0.99) * 1000,
+            }
+            for name, samples in self.samples.items() if samples
+        }
+
+
+def run_benchmark(
+        messages: int, rules: int, latency: float = 0.0, jitter: float = 0.0, new_messages: Optional[int] = None,
+        seed: int = 0, html_ratio: float = 0.2, multipart_ratio: float = 0.2, batch_size: int = 100,
+        concurrency: int = 4, parse_processes: int = 0, chunk_size: int = 500,
+        metadata_only: bool = False) -> dict[str, StageResult]:
+    """Runs the stages against the configured database, which should be empty"""
+
+    from email_reader.loader import ChunkWriter, load_emails
+    from email_reader.logics.filters import Rules
+    from email_reader.manager import process_emails
+    from email_reader.services.gmail import MockGmailService
+
+    mailbox = SyntheticMailbox(messages, seed=seed, html_ratio=html_ratio, multipart_ratio=multipart_ratio)
+    rng = random.Random(seed)
+    service = MockGmailService(
+        None, emails=mailbox, latency=lambda: latency + rng.uniform(0, jitter), batch_size=batch_size,  # type: ignore
+        concurrency=concurrency, parse_processes=parse_processes, metadata_only=metadata_only,
+    )
+    rule_set = Rules.model_validate(synthetic_rules(rules, seed=seed))
+    results = {}
+
+    write = ChunkWriter.write
+    stage = Stage(service)
+    ChunkWriter.write = stage.timed('write chunk', write)  # type: ignore[method-assign]
+    try:
+        with stage.run():
+            stage.result.items = load_emails(service, since_last_commit=False, chunk_size=chunk_size)
+        results['full load'] = stage.result
+
+        stage = Stage(service)
+        with stage.run():
+            process_emails(service, rules=rule_set, use_watermarks=False)
+            stage.result.items = messages
+        results['process rules'] = stage.result
+
+        stage = Stage(service)
+        with stage.run():
+            stage.result.items = filter_bodies(stage, rule_set)
+        results['body filter'] = stage.result
+
+        for index in range(messages, messages + (new_messages if new_messages is not None else messages // 100)):
+            service._service.add_message(mailbox.generate(index))
+
+        stage = Stage(service)
+        ChunkWriter.write = stage.timed('write chunk', write)  # type: ignore[method-assign]
+        with stage.run():
+            stage.result.items = load_emails(service, chunk_size=chunk_size)
+        results['incremental load'] = stage.result
+    finally:
+        ChunkWriter.write = write  # type: ignore[method-assign]
+
+    return results
+
+
+def filter_bodies(stage: Stage, rule_set) -> int:
+    """
+    Counts the emails matching each body condition of the rules, returns the number of conditions.
+    Every body decompressed by the queries is timed, their count is the cost of the body filters
+    """
+    from sqlalchemy import func, select
+
+    from email_reader.database import compression
+    from email_reader.database.engine import SessionFactory
+    from email_reader.database.tables import Email
+
+    conditions = [
+        condition for rule in rule_set.rules for condition in rule.conditions.rules if condition.field == 'body'
+    ]
+    decompressors = dict(compression.DECOMPRESSORS)
+    for prefix, decompress in decompressors.items():
+        compression.DECOMPRESSORS[prefix] = stage.timed('body decompress', decompress)
+
+    def count(session, condition) -> int:
+        return session.scalar(select(func.count()).select_from(Email).where(condition.get_statement()))
+
+    timed_count = stage.timed('body query', count)
+    try:
+        with SessionFactory() as session:
+            for condition in conditions:
+                timed_count(session, condition)
+    finally:
+        compression.DECOMPRESSORS.update(decompressors)
+    return len(conditions)
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+    """Regressions of `results` against `baseline`, as messages"""
+    regressions = []
+    for name, stage in results['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if before is None:
+            continue
+        if stage['items_per_second'] < before['items_per_second'] * (1 - threshold):
+            regressions.append(
+                f"{name}: {stage['items_per_second']:.0f} Items/s, was {before['items_per_second']:.0f}"
+            )
+        if stage['peak_rss_mb'] > before['peak_rss_mb'] * (1 + threshold):
+            regressions.append(f"{name}: Peak RSS {stage['peak_rss_mb']:.0f} MiB, was {before['peak_rss_mb']:.0f}")
+    return regressions
+
+
+def print_results(results: dict[str, Any], baseline: Optional[dict[str, Any]] = None) -> None:
+    table = Table(title=f"{results['config']['messages']} Messages, {results['config']['rules']} Rules")
+    columns = (
+        'Stage', 'Seconds', 'Items/s', 'Round Trips', 'Fetched MiB', 'Peak RSS MiB', 'Operation', 'p50 ms', 'p99 ms'
+    )
+    for column in columns:
+        table.add_column(column, justify='left' if column in ('Stage', 'Operation') else 'right')
+
+    for name, stage in results['stages'].items():
+        throughput = f"{stage['items_per_second']:.0f}"
+        before = (baseline or {}).get('stages', {}).get(name)
+        if before and before['items_per_second']:
+            throughput += f" ({stage['items_per_second'] / before['items_per_second'] - 1:+.0%})"
+
+        operations = list(stage['latency_ms'].items()) or [('', {'p50': 0.0, 'p99': 0.0})]
+        for index, (operation, latency) in enumerate(operations):
+            head = [name, f"{stage['seconds']:.2f}", throughput, str(stage['round_trips']),
+                    f"{stage['fetched_mb']:.1f}", f"{stage['peak_rss_mb']:.0f}"] if index == 0 else [''] * 6
+            table.add_row(*head, operation, f"{latency['p50']:.1f}", f"{latency['p99']:.1f}")
+
+    console.print(table)
+
+
+def run() -> None:
+    parser = ArgumentParser(description='Load and Rule Processing Benchmark on a Synthetic Mailbox')
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--rules', type=int, default=50)
+    parser.add_argument('--new-messages', help='Messages Added Before the Incremental Load (Default 1%%)', type=int)
+    parser.add_argument('--latency', help='Seconds per Round Trip', type=float, default=0.0)
+    parser.add_argument('--jitter', help='Extra Random Seconds per Round Trip', type=float, default=0.0)
+    parser.add_argument('--html-ratio', type=float, default=0.2)
+    parser.add_argument('--multipart-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--parse-processes', type=int, default=0)
+    parser.add_argument('--metadata-only', help='Load Only the Headers, Bodies Are Fetched for the Body Rules',
+                        action='store_true')
+    parser.add_argument('--search-index', help='Create the SQLite Full Text Index of the Subjects and Bodies',
+                        action='store_true')
+    parser.add_argument('--db', help='Database URL, Defaults to a Temporary SQLite File')
+    parser.add_argument('--output', help='Write the Results to This JSON File', type=Path)
+    parser.add_argument('--compare', help='Compare With the Results in This JSON File', type=Path)
+    parser.add_argument('--threshold', help='Allowed Regression (Default 0.1)', type=float, default=0.1)
+    parser.add_argument('--verbose', help='Show the Output of the Stages', action='store_true')
+    args = parser.parse_args()
+
+    # The stages log every chunk and action, writing them to a terminal would dominate the timings
+    quiet = nullcontext() if args.verbose else redirect_stdout(open(os.devnull, 'w'))
+    with tempfile.TemporaryDirectory() as tmp_dir, quiet:
+        # Read when the engine is first used, which is during the first stage
+        os.environ.pop('DB_USE_INMEMORY', None)
+        os.environ['EMAIL_READER_DB_URL'] = args.db or f'sqlite:///{Path(tmp_dir) / "benchmark.sqlite"}'
+        if args.search_index:
+            os.environ['EMAIL_READER_DB_FTS'] = '1'
+
+        stages = run_benchmark(
+            args.messages, args.rules, latency=args.latency, jitter=args.jitter, new_messages=args.new_messages,
+            seed=args.seed, html_ratio=args.html_ratio, multipart_ratio=args.multipart_ratio,
+            batch_size=args.batch_size, concurrency=args.concurrency, parse_processes=args.parse_processes,
+            metadata_only=args.metadata_only,
+        )
+
+    ignored = ('db', 'output', 'compare', 'threshold', 'verbose')
+    config = {key: value for key, value in vars(args).items() if key not in ignored}
+    results = {
+        'config': config,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'stages': {name: stage.to_json() for name, stage in stages.items()},
+    }
+
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_results(results, baseline)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+        console.print(f'Results Written to {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            console.print(f'[red]Regression {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
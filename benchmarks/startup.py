@@ -0,0 +1,137 @@
+"""
+Cold start benchmark of the command line tools
+
+    python -m benchmarks.startup [--runs 10] [--output results.json]
+
+Every run starts `load-emails` and `manage-emails` in a new interpreter and reports the time from starting
+the process to the first connection to Gmail, along with the time to import the module of the command.
+The commands are given a valid fake token and a SQLite database in a temporary directory, the process
+exits as soon as it resolves the address of Gmail so nothing is sent. The first run of a command creates
+the database, the later ones open an existing one
+"""
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Any
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+COMMANDS = {
+    'load-emails': ('email_reader.loader', []),
+    'manage-emails': ('email_reader.manager', ['--rules', '{directory}/rules.json']),
+}
+
+# Runs in the new interpreter, before anything else is imported. Connecting is reported through an audit
+# hook instead of patching the http client, which would have to be imported up front
+CHILD = '''
+import os, sys, time
+started = float(sys.argv[1])
+
+def on_connect(event, args):
+    if event == 'socket.getaddrinfo':
+        sys.stdout.write(f'{time.time() - started}\\n')
+        sys.stdout.flush()
+        os._exit(0)
+
+sys.addaudithook(on_connect)
+module, sys.argv = sys.argv[2], sys.argv[3:]
+if sys.argv[0] == 'import':
+    __import__(module)
+    sys.stdout.write(f'{time.time() - started}\\n')
+    sys.exit(0)
+__import__(module, fromlist=['run']).run()
+sys.exit('Exited Without Connecting to Gmail')
+'''
+
+TOKEN = {
+    'token': 'startup-benchmark', 'refresh_token': 'startup-benchmark', 'client_id': 'startup-benchmark',
+    'client_secret': 'startup-benchmark', 'expiry': '2100-01-01T00:00:00Z',
+}
+RULES = {'rules': [{
+    'name': 'Read Newsletters', 'actions': [{'type': 'mark_as_read'}],
+    'conditions': {'operator': 'ALL', 'rules': [{'field': 'subject', 'predicate': 'Contains', 'value': 'weekly'}]},
+}]}
+
+
+def time_child(directory: Path, module: str, argv: list[str]) -> float:
+    env = {**os.environ, 'EMAIL_READER_DB_URL': f'sqlite:///{directory / "emails.sqlite"}'}
+    env.pop('DB_USE_INMEMORY', None)
+
+    started = time.time()
+    process = subprocess.run(
+        [sys.executable, '-c', CHILD, repr(started), module, *argv], env=env, capture_output=True, text=True
+    )
+    if process.returncode != 0 or not process.stdout.strip():
+        raise RuntimeError(f'{module} {" ".join(argv)} Failed\n{process.stderr}')
+    return float(process.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(runs: int) -> dict[str, Any]:
+    results: dict[str, Any] = {'config': {'runs': runs, 'python': sys.version.split()[0]}, 'commands': {}}
+
+    for command, (module, extra) in COMMANDS.items():
+        with tempfile.TemporaryDirectory(prefix='email-reader-startup-') as temp:
+            directory = Path(temp)
+            (directory / 'credentials.json').write_text('{}')
+            (directory / 'token.json').write_text(json.dumps(TOKEN))
+            (directory / 'rules.json').write_text(json.dumps(RULES))
+            argv = [command, '-c', f'{directory}/credentials.json', *(arg.format(directory=directory) for arg in extra)]
+
+            imports = [time_child(directory, module, ['import']) for _ in range(runs)]
+            first_run = time_child(directory, module, argv)
+            later_runs = [time_child(directory, module, argv) for _ in range(runs)]
+
+        results['commands'][command] = {
+            'import_ms': statistics.median(imports) * 1000,
+            'first_request_new_db_ms': first_run * 1000,
+            'first_request_ms': statistics.median(later_runs) * 1000,
+            'first_request_min_ms': min(later_runs) * 1000,
+        }
+
+    return results
+
+
+def print_results(results: dict[str, Any], baseline: dict[str, Any] | None = None) -> None:
+    table = Table(title=f"Median of {results['config']['runs']} Runs, Python {results['config']['python']}")
+    for column in ('Command', 'Import ms', 'First Request ms', 'Min ms', 'New Database ms'):
+        table.add_column(column, justify='left' if column == 'Command' else 'right')
+
+    for command, timings in results['commands'].items():
+        first_request = f"{timings['first_request_ms']:.0f}"
+        before = (baseline or {}).get('commands', {}).get(command)
+        if before:
+            first_request += f" ({timings['first_request_ms'] / before['first_request_ms'] - 1:+.0%})"
+        table.add_row(
+            command, f"{timings['import_ms']:.0f}", first_request, f"{timings['first_request_min_ms']:.0f}",
+            f"{timings['first_request_new_db_ms']:.0f}"
+        )
+
+    console.print(table)
+
+
+def run() -> None:
+    parser = ArgumentParser(description='Time to First Gmail Request of the Command Line Tools')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='Write the Results to This JSON File', type=Path)
+    parser.add_argument('--compare', help='Compare With the Results in This JSON File', type=Path)
+    args = parser.parse_args()
+
+    results = run_benchmark(args.runs)
+    print_results(results, json.loads(args.compare.read_text()) if args.compare else None)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,182 @@
+"""
+Deterministic synthetic mailboxes and rule sets for the benchmarks
+
+Messages are generated from their index when they are looked up, so a mailbox of a million messages
+costs no memory until messages are changed, and the same seed always gives the same mailbox
+"""
+from __future__ import annotations
+
+import base64
+import datetime
+import random
+from typing import Any, Iterator, MutableMapping
+
+WORDS = (
+    'invoice meeting report update weekly account security order shipping delivery payment receipt '
+    'newsletter offer sale project review schedule travel booking ticket reminder welcome verify '
+    'support request feedback survey launch release notes summary agenda budget contract proposal'
+).split()
+NAMES = 'alice bob carol dave erin frank grace heidi ivan judy mallory niaj olivia peggy rupert sybil trent'.split()
+DOMAINS = [
+    f'{name}.example.{tld}' for name in ('mail', 'news', 'shop', 'bank', 'work') for tld in ('com', 'org', 'net')
+]
+LABELS = (['INBOX'], ['INBOX', 'UNREAD'], ['INBOX', 'UNREAD'], ['SPAM'], ['SENT'], ['TRASH'])
+START_DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class SyntheticMailbox(MutableMapping[str, dict[str, Any]]):
+    """
+    `format=raw` message resources by id, usable as the data of `MockGmailService`. A share of the messages
+    are html only or multipart/alternative newsletters, some with an attachment. Every `thread_size` consecutive
+    messages form a thread. Changed and added messages are kept in an overlay, deleted ones are remembered so
+    that they are skipped
+    """
+
+    def __init__(
+            self, size: int, seed: int = 0, html_ratio: float = 0.2, multipart_ratio: float = 0.2,
+            body_sentences: int = 5, thread_size: int = 4) -> None:
+        self.size = size
+        self.seed = seed
+        self.html_ratio = html_ratio
+        self.multipart_ratio = multipart_ratio
+        self.body_sentences = body_sentences
+        self.thread_size = thread_size
+        self._overlay: dict[str, dict[str, Any]] = {}
+        self._deleted: set[str] = set()
+
+    @staticmethod
+    def message_id(index: int) -> str:
+        return f'synthetic-{index:07d}'
+
+    @staticmethod
+    def index_of(msg_id: str) -> int:
+        prefix, _, index = msg_id.partition('-')
+        if prefix != 'synthetic' or not index.isdigit():
+            return -1
+        return int(index)
+
+    def __getitem__(self, msg_id: str) -> dict[str, Any]:
+        if msg_id in self._overlay:
+            return self._overlay[msg_id]
+        index = self.index_of(msg_id)
+        if not 0 <= index < self.size or msg_id in self._deleted:
+            raise KeyError(msg_id)
+        return self.generate(index)
+
+    def __setitem__(self, msg_id: str, message: dict[str, Any]) -> None:
+        self._deleted.discard(msg_id)
+        self._overlay[msg_id] = message
+
+    def __delitem__(self, msg_id: str) -> None:
+        if msg_id not in self:
+            raise KeyError(msg_id)
+        self._overlay.pop(msg_id, None)
+        self._deleted.add(msg_id)
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.size):
+            msg_id = self.message_id(index)
+            if msg_id not in self._deleted:
+                yield msg_id
+        for msg_id in self._overlay:
+            if not 0 <= self.index_of(msg_id) < self.size:
+                yield msg_id
+
+    def __len__(self) -> int:
+        added = sum(1 for msg_id in self._overlay if not 0 <= self.index_of(msg_id) < self.size)
+        deleted = sum(1 for msg_id in self._deleted if 0 <= self.index_of(msg_id) < self.size)
+        return self.size - deleted + added
+
+    def sentence(self, rng: random.Random, words: int = 8) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+    def generate(self, index: int) -> dict[str, Any]:
+        rng = random.Random(self.seed * 1_000_003 + index)
+        sender = f'{rng.choice(NAMES)}{rng.randrange(100)}@{rng.choice(DOMAINS)}'
+        recipient = f'{rng.choice(NAMES)}@{rng.choice(DOMAINS)}'
+        subject = self.sentence(rng, 6)[:-1]
+        date = START_DATE + datetime.timedelta(minutes=index * 7 + rng.randrange(7))
+        text = ' '.join(self.sentence(rng) for _ in range(self.body_sentences))
+
+        headers = (
+            f'From: {sender.split("@")[0].title()} <{sender}>\r\nTo: {recipient}\r\nSubject: {subject}\r\n'
+            f'Date: {date:%a, %d %b %Y %H:%M:%S +0000}\r\nMIME-Version: 1.0\r\n'
+        )
+
+        kind = rng.random()
+        if kind < self.html_ratio:
+            raw = headers + 'Content-Type: text/html; charset="utf-8"\r\n\r\n' + self.html(rng, text)
+        elif kind < self.html_ratio + self.multipart_ratio:
+            boundary = f'boundary-{index}'
+            parts = [
+                f'Content-Type: text/plain; charset="utf-8"\r\n\r\n{text}',
+                f'Content-Type: text/html; charset="utf-8"\r\n\r\n{self.html(rng, text)}',
+            ]
+            content_type = 'multipart/alternative'
+            if rng.random() < 0.25:
+                content_type = 'multipart/mixed'
+                attachment = base64.b64encode(rng.randbytes(2048)).decode()
+                parts.append(
+                    'Content-Type: application/pdf\r\nContent-Disposition: attachment; filename="file.pdf"\r\n'
+                    f'Content-Transfer-Encoding: base64\r\n\r\n{attachment}'
+                )
+            body = ''.join(f'--{boundary}\r\n{part}\r\n' for part in parts)
+            raw = headers + f'Content-Type: {content_type}; boundary="{boundary}"\r\n\r\n{body}--{boundary}--\r\n'
+        else:
+            raw = headers + f'Content-Type: text/plain; charset="utf-8"\r\n\r\n{text}'
+
+        return {
+            'id': self.message_id(index),
+            # Like Gmail, the id of a thread is the id of its first message
+            'threadId': self.message_id(index - index % self.thread_size),
+            'raw': base64.urlsafe_b64encode(raw.encode()).decode(),
+            'labelIds': list(rng.choice(LABELS)),
+        }
+
+    def html(self, rng: random.Random, text: str) -> str:
+        rows = ''.join(
+            f'<tr><td style="padding: 8px"><a href="https://example.com/{rng.randrange(10 ** 6)}">'
+            f'{self.sentence(rng, 4)}</a></td><td><p>{self.sentence(rng)}</p></td></tr>'
+            for _ in range(rng.randrange(5, 30))
+        )
+        return (
+            '<html><head><style>td { font-family: sans-serif; }</style></head><body>'
+            f'<p>{text}</p><table>{rows}</table><p>Unsubscribe</p></body></html>'
+        )
+
+
+def synthetic_rules(count: int, seed: int = 0) -> dict[str, Any]:
+    """A rules file of `count` rules mixing every field, predicate and action"""
+
+    rng = random.Random(seed)
+    rules = []
+
+    for index in range(count):
+        conditions = []
+        for _ in range(rng.randrange(1, 4)):
+            choice = rng.randrange(5)
+            if choice == 0:
+                conditions.append({'field': 'from_email', 'predicate': 'Contains', 'value': rng.choice(DOMAINS)})
+            elif choice == 1:
+                conditions.append({'field': 'subject', 'predicate': 'Contains', 'value': rng.choice(WORDS)})
+            elif choice == 2:
+                conditions.append({'field': 'body', 'predicate': 'Contains', 'value': rng.choice(WORDS)})
+            elif choice == 3:
+                conditions.append({'field': 'to_email', 'predicate': 'DoesNotContain', 'value': rng.choice(NAMES)})
+            else:
+                date = START_DATE + datetime.timedelta(days=rng.randrange(2000))
+                conditions.append({
+                    'field': 'date', 'predicate': rng.choice(['GreaterThan', 'LessThan']),
+                    'value': date.strftime('%Y-%m-%dT%H:%M:%S'),
+                })
+
+        action = rng.choice([
+            {'type': 'mark_as_read'}, {'type': 'mark_as_unread'},
+            {'type': 'move_message', 'folder': rng.choice(['INBOX', 'SPAM', 'TRASH'])},
+        ])
+        rules.append({
+            'name': f'Synthetic Rule {index}', 'actions': [action],
+            'conditions': {'operator': rng.choice(['ALL', 'ANY']), 'rules': conditions},
+        })
+
+    return {'rules': rules}
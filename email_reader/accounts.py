@@ -0,0 +1,86 @@
+"""
+Several Gmail accounts synced by a single run
+
+Every account has its own token and its own database, so their emails, sync cursors and rule watermarks
+never mix. The accounts are synced in parallel threads, each using its database through `use_database`
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Optional, TypeVar, Union
+
+from pydantic import BaseModel, Field, model_validator
+
+from email_reader.console import console
+from email_reader.database.config import DEFAULT_DB_FILE, DatabaseConfig
+from email_reader.database.engine import use_database
+
+T = TypeVar('T')
+
+ACCOUNTS_DIR = DEFAULT_DB_FILE.parent / 'accounts'
+
+
+class Account(BaseModel):
+    name: str = Field(pattern=r'^[\w.@+-]+$')
+    credentials_file: Path
+    token_file: Optional[Path] = None
+    database_url: Optional[str] = None
+    rules_file: Optional[Path] = None
+
+    def get_token_file(self) -> Path:
+        """Defaults to `token-<name>.json` next to the credentials file, which the accounts can share"""
+        return self.token_file or self.credentials_file.parent / f'token-{self.name}.json'
+
+    def get_database_url(self) -> str:
+        """Defaults to a SQLite file at ~/.email_reader/accounts/<name>.sqlite"""
+        return self.database_url or DatabaseConfig.default_sqlite_url(ACCOUNTS_DIR / f'{self.name}.sqlite')
+
+
+class Accounts(BaseModel):
+    accounts: list[Account]
+
+    @model_validator(mode='after')
+    def require_unique_accounts(self) -> Accounts:
+        names = [account.name for account in self.accounts]
+        if len(set(names)) != len(names):
+            raise ValueError('Account Names Must Be Unique')
+
+        urls = [account.database_url for account in self.accounts if account.database_url]
+        if len(set(urls)) != len(urls):
+            raise ValueError('Accounts Cannot Share a Database')
+        return self
+
+    @classmethod
+    def from_file(cls, file: Path) -> Accounts:
+        return cls.model_validate_json(file.read_text())
+
+
+def run_accounts(
+        accounts: list[Account], task: Callable[[Account], T],
+        parallel: int = 4) -> dict[str, Union[T, Exception]]:
+    """
+    Runs `task` for every account with its database, `parallel` accounts at a time. An account failing
+    does not stop the others, its exception is returned in place of its result
+    """
+
+    if parallel < 1:
+        raise ValueError('Parallel must be at least 1')
+
+    def run(account: Account) -> T:
+        with use_database(account.get_database_url()):
+            return task(account)
+
+    results: dict[str, Union[T, Exception]] = {}
+    with ThreadPoolExecutor(max_workers=min(parallel, max(len(accounts), 1)), thread_name_prefix='account') as executor:
+        futures = {executor.submit(run, account): account for account in accounts}
+        for future in as_completed(futures):
+            account = futures[future]
+            try:
+                results[account.name] = future.result()
+            except Exception as e:
+                console.log(f"[red] Failed to Sync Account {account.name} {e!r} [/red]")
+                results[account.name] = e
+
+    return {account.name: results[account.name] for account in accounts}
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from email.message import Message
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Callable, Optional
+
+DEFAULT_MAX_BODY_LENGTH = 256 * 1024
+
+# Elements whose text is never shown, BeautifulSoup leaves them out of `stripped_strings` as well
+SKIPPED_TAGS = frozenset({'script', 'style', 'template'})
+
+
+class TextCapReached(Exception):
+    pass
+
+
+class HTMLTextParser(HTMLParser):
+    """Collects the stripped text of the document as it is fed, stops once `max_length` characters are collected"""
+
+    def __init__(self, max_length: Optional[int] = None) -> None:
+        super().__init__(convert_charrefs=True)
+        self.max_length = max_length
+        self.strings: list[str] = []
+        self.length = 0
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag: str, attrs) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if self._skip_depth:
+            return
+
+        data = data.strip()
+        if not data:
+            return
+
+        self.strings.append(data)
+        self.length += len(data) + 1
+        if self.max_length is not None and self.length > self.max_length:
+            raise TextCapReached
+
+    @property
+    def text(self) -> str:
+        text = '\n'.join(self.strings)
+        return text[:self.max_length] if self.max_length is not None else text
+
+
+def html_to_text(html: str, max_length: Optional[int] = None) -> str:
+    """Text of the html, one stripped string per line like BeautifulSoup's `stripped_strings`"""
+
+    parser = HTMLTextParser(max_length)
+    try:
+        parser.feed(html)
+        parser.close()
+    except TextCapReached:
+        pass
+    return parser.text
+
+
+def bs4_html_to_text(html: str, max_length: Optional[int] = None) -> str:
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError as e:
+        raise ImportError('The bs4 Html Parser Needs beautifulsoup4, Install email_reader[html]') from e
+
+    text = '\n'.join(BeautifulSoup(html, 'html.parser').stripped_strings)
+    return text[:max_length] if max_length is not None else text
+
+
+HTML_PARSERS: dict[str, Callable[[str, Optional[int]], str]] = {
+    'stdlib': html_to_text,
+    'bs4': bs4_html_to_text,
+}
+
+
+@dataclass(frozen=True)
+class BodyExtractor:
+    """
+    Extracts the body text of an email, read from the environment
+
+    EMAIL_READER_HTML_PARSER        Name of the parser in `HTML_PARSERS` used for html only emails (Default stdlib)
+    EMAIL_READER_MAX_BODY_LENGTH    Characters of the body kept, `0` keeps the whole body (Default 256 KiB)
+    """
+
+    html_parser: str = 'stdlib'
+    max_length: Optional[int] = DEFAULT_MAX_BODY_LENGTH
+
+    def __post_init__(self) -> None:
+        if self.html_parser not in HTML_PARSERS:
+            raise ValueError(f'Unknown Html Parser {self.html_parser!r}, Expected One of {sorted(HTML_PARSERS)}')
+
+    @classmethod
+    def from_env(cls) -> BodyExtractor:
+        max_length = int(os.getenv('EMAIL_READER_MAX_BODY_LENGTH', DEFAULT_MAX_BODY_LENGTH))
+        return cls(
+            html_parser=os.getenv('EMAIL_READER_HTML_PARSER', cls.html_parser),
+            max_length=max_length or None,
+        )
+
+    def __call__(self, email_message: Message) -> str:
+        """
+        Body of the email from its first non empty text/plain part, falling back to the first text/html one.
+        Parts are only decoded until a usable one is found and attachments are never decoded
+        """
+
+        html_part = None
+
+        for part in email_message.walk():
+            if part.is_multipart() or 'attachment' in str(part.get('Content-Disposition')):
+                continue
+
+            content_type = part.get_content_type()
+            if content_type == 'text/html':
+                if html_part is None:
+                    html_part = part
+            elif content_type == 'text/plain' or not email_message.is_multipart():
+                text = self.decode(part).strip()
+                if text:
+                    return text[:self.max_length] if self.max_length is not None else text
+
+        if html_part is None:
+            return ''
+        return HTML_PARSERS[self.html_parser](self.decode(html_part), self.max_length)
+
+    @staticmethod
+    def decode(part: Message) -> str:
+        payload = part.get_payload(decode=True)
+        if not isinstance(payload, bytes):
+            return ''
+        try:
+            return payload.decode(part.get_content_charset() or 'utf-8', errors='replace')
+        except LookupError:
+            return payload.decode('utf-8', errors='replace')
+
+
+@lru_cache(maxsize=None)
+def get_body_extractor() -> BodyExtractor:
+    return BodyExtractor.from_env()
@@ -0,0 +1,196 @@
+"""
+Long running mode of `manage-emails`
+
+The credentials, the Gmail client, the database engine and the rules are set up once, then every `interval`
+seconds the new emails are loaded, the rules evaluated and the actions applied. The rules file is reloaded
+when it changes and the access token is refreshed on a background thread before it expires
+"""
+
+from __future__ import annotations
+
+import datetime
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from pydantic import ValidationError
+
+from email_reader.console import console
+from email_reader.database.engine import get_engine
+from email_reader.logics.filters import Rules
+from email_reader.manager import manage_emails
+from email_reader.metrics import metrics
+from email_reader.services.gmail import GmailService
+
+
+class RulesFile:
+    """Rules of a file, parsed again when its modification time or size changes"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._stat: Optional[tuple[int, int]] = None
+        self._rules: Optional[Rules] = None
+
+    def get(self) -> Rules:
+        """
+        The current rules. A file which no longer parses keeps the previous rules in use,
+        it is only an error when there are no previous rules
+        """
+        stat = self.path.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key == self._stat and self._rules is not None:
+            return self._rules
+
+        try:
+            rules = Rules.from_file(file=self.path)
+        except (ValidationError, ValueError) as e:
+            if self._rules is None:
+                raise
+            console.log(f"[red] Keeping the Previous Rules, {self.path} is Invalid {e} [/red]")
+        else:
+            if self._rules is not None:
+                console.log(f"Reloaded {len(rules.rules)} Rules From {self.path}")
+            self._rules = rules
+        self._stat = key
+        return self._rules  # type: ignore[return-value]
+
+
+class TokenRefresher:
+    """Refreshes the credentials on a daemon thread `margin` seconds before they expire"""
+
+    def __init__(self, credentials, margin: float = 300.0, check_interval: float = 30.0) -> None:
+        self.credentials = credentials
+        self.margin = margin
+        self.check_interval = check_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+
+    def start(self) -> None:
+        if self.credentials is not None:
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def expires_soon(self) -> bool:
+        expiry = getattr(self.credentials, 'expiry', None)
+        if expiry is None:
+            return False
+        # google-auth keeps the expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (expiry - now).total_seconds() < self.margin
+
+    def refresh(self) -> None:
+        from google.auth.transport.requests import Request
+
+        self.credentials.refresh(Request())
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            if not (self.expires_soon() and getattr(self.credentials, 'refresh_token', None)):
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                # Retried on the next check, the requests refresh the token themselves if it does expire
+                console.log(f"[yellow] Failed to Refresh the Access Token {e}")
+
+
+class EmailDaemon:
+    """Runs load, evaluate and act every `interval` seconds until stopped"""
+
+    def __init__(
+            self, service: GmailService, rules_file: Path, interval: float = 60.0, dry_run: bool = False,
+            metrics_file: Optional[Path] = None, sleep: Optional[Callable[[float], bool]] = None) -> None:
+        self.service = service
+        self.rules = RulesFile(rules_file)
+        self.interval = interval
+        self.dry_run = dry_run
+        self.metrics_file = metrics_file
+        self.iterations = 0
+        self.failures = 0
+        self._stop = threading.Event()
+        self._sleep = sleep or self._stop.wait
+
+    def stop(self, *args) -> None:
+        self._stop.set()
+
+    def run_once(self) -> bool:
+        """One load, evaluate and act cycle, failures are logged so that the next cycle still runs"""
+        self.iterations += 1
+        try:
+            manage_emails(self.service, self.rules.get(), dry_run=self.dry_run)
+        except Exception as e:
+            self.failures += 1
+            console.log(f"[red] Run {self.iterations} Failed {e!r} [/red]")
+            return False
+        finally:
+            if self.metrics_file:
+                metrics.write(self.metrics_file)
+        return True
+
+    def serve(self, max_iterations: Optional[int] = None) -> None:
+        # Fails at startup rather than on every run when the rules are invalid, and opens the database once
+        self.rules.get()
+        get_engine()
+        refresher = TokenRefresher(self.service.credentials)
+        refresher.start()
+
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                self.run_once()
+                if max_iterations is not None and self.iterations >= max_iterations:
+                    break
+                if self._sleep(max(0.0, self.interval - (time.monotonic() - started))):
+                    break
+        finally:
+            refresher.stop()
+
+
+def run():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Keep Loading Emails and Applying the Rules')
+    parser.add_argument(
+        '--rules', '-r',
+        help='Path for the Rules JSON File, Reloaded When It Changes',
+        type=Path, required=True
+    )
+    parser.add_argument(
+        '--credentials-file', '-c',
+        help='Path for the Client Secrets File Generated During Client App Creation',
+        type=Path, required=True
+    )
+    parser.add_argument(
+        '--interval',
+        help='Seconds Between the Start of Two Runs (Default 60)',
+        type=float, default=60.0
+    )
+    parser.add_argument(
+        '--dry-run',
+        help='Print the Changes the Rules Would Make Without Applying Them',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--metadata-only',
+        help='Load Only the Headers and Labels of the Emails, Bodies Are Fetched for the Rules Filtering on Them',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--metrics',
+        help='Rewrite the Metrics to This File After Every Run, as JSON When It Ends With .json, Prometheus Otherwise',
+        type=Path
+    )
+
+    args = parser.parse_args()
+
+    daemon = EmailDaemon(
+        GmailService.create(args.credentials_file, metadata_only=args.metadata_only), args.rules,
+        interval=args.interval, dry_run=args.dry_run, metrics_file=args.metrics
+    )
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.serve()
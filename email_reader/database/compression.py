@@ -0,0 +1,109 @@
+"""
+Compression of the stored email bodies
+
+Every stored body starts with a byte naming its codec, so bodies written with different codecs
+can live in the same table and the codec can be changed at any time. SQLite connections get an
+`email_body_text` function decoding them, which lets body filters run in SQL
+"""
+
+from __future__ import annotations
+
+import zlib
+from typing import Any, Callable, Optional
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Engine, String
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+zstd: Any
+try:
+    from compression import zstd  # type: ignore[import-not-found, no-redef]  # Python 3.14
+except ImportError:
+    try:
+        import zstandard as zstd  # type: ignore[import-not-found, no-redef]
+    except ImportError:
+        zstd = None
+
+SQL_FUNCTION = 'email_body_text'
+# Bodies shorter than this are stored as is, compressing them only adds the codec overhead
+MIN_COMPRESS_LENGTH = 128
+
+Codec = tuple[bytes, Callable[[bytes], bytes], Callable[[bytes], bytes]]
+
+CODECS: dict[str, Codec] = {
+    'none': (b'\x00', lambda data: data, lambda data: data),
+    'zlib': (b'\x01', lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if zstd is not None:
+    CODECS['zstd'] = (b'\x02', lambda data: zstd.compress(data, 3), zstd.decompress)
+
+DECOMPRESSORS = {prefix[0]: decompress for prefix, _, decompress in CODECS.values()}
+
+# Codec used to write the bodies of an engine, recorded when the engine is created
+_body_codecs: WeakKeyDictionary[Engine, str] = WeakKeyDictionary()
+
+
+def check_codec(codec: str) -> None:
+    if codec == 'zstd' and zstd is None:
+        raise ValueError('The zstd Body Codec Needs Python 3.14 or zstandard, Install email_reader[zstd]')
+    if codec not in CODECS:
+        raise ValueError(f'Unknown Body Codec {codec!r}, Expected One of {sorted({*CODECS, "zstd"})}')
+
+
+def register_body_codec(engine: Engine, codec: str) -> None:
+    check_codec(codec)
+    _body_codecs[engine] = codec
+
+
+def get_body_codec(engine: Engine) -> str:
+    return _body_codecs.get(engine, 'zlib')
+
+
+def compress_body(body: str, codec: str = 'zlib') -> bytes:
+    data = body.encode('utf-8')
+    if len(data) < MIN_COMPRESS_LENGTH:
+        codec = 'none'
+
+    prefix, compress, _ = CODECS[codec]
+    return prefix + compress(data)
+
+
+def decompress_body(content: Optional[bytes]) -> Optional[str]:
+    if content is None:
+        return None
+
+    decompress = DECOMPRESSORS.get(content[0])
+    if decompress is None:
+        raise ValueError(f'Unknown Body Codec Prefix {content[0]!r}')
+    return decompress(bytes(content[1:])).decode('utf-8')
+
+
+def register_sqlite_functions(dbapi_connection) -> None:
+    dbapi_connection.create_function(SQL_FUNCTION, 1, decompress_body, deterministic=True)
+
+
+class body_text(FunctionElement):
+    """Text of a stored body in SQL, only the `none` codec can be decoded outside of SQLite"""
+
+    type = String()
+    inherit_cache = True
+
+    def __init__(self, content) -> None:
+        super().__init__(content)
+
+
+@compiles(body_text)
+def compile_body_text(element, compiler, **kw) -> str:
+    # Bodies stored as is are read in SQL, only the compressed ones go through the Python function
+    content = compiler.process(element.clauses, **kw)
+    return (
+        f"CASE WHEN substr({content}, 1, 1) = x'{CODECS['none'][0].hex()}' THEN CAST(substr({content}, 2) AS TEXT) "
+        f"ELSE {SQL_FUNCTION}({content}) END"
+    )
+
+
+@compiles(body_text, 'postgresql')
+def compile_body_text_postgresql(element, compiler, **kw) -> str:
+    return f"convert_from(substring({compiler.process(element.clauses, **kw)} from 2), 'UTF8')"
+
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Literal, Optional, Union
+
+DEFAULT_DB_FILE = Path.home() / Path(".email_reader/emails.sqlite")
+
+
+@dataclass(frozen=True)
+class DatabaseConfig:
+    """
+    Database settings, read from the environment
+
+    EMAIL_READER_DB_URL              SQLAlchemy URL, defaults to a SQLite file at ~/.email_reader/emails.sqlite
+    EMAIL_READER_DB_POOL_SIZE        Connections kept in the pool (Default 5)
+    EMAIL_READER_DB_ECHO             `1` logs every statement, `debug` logs the result rows as well
+    EMAIL_READER_SQLITE_MMAP_SIZE    Bytes of the SQLite file memory mapped (Default 256 MiB)
+    EMAIL_READER_SQLITE_CACHE_SIZE   SQLite page cache in KiB (Default 64 MiB)
+    EMAIL_READER_DB_FTS              `1` keeps a SQLite FTS5 index of the subject and body for Contains filters
+    EMAIL_READER_BODY_CODEC          `zlib`, `zstd` or `none`, compression of the stored bodies (Default zlib)
+    DB_USE_INMEMORY                  `1` uses an in memory SQLite database, used by the test cases
+    """
+
+    url: str
+    pool_size: int = 5
+    echo: Union[bool, Literal['debug']] = False
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = 64 * 1024
+    search_index: bool = False
+    body_codec: str = 'zlib'
+
+    @property
+    def is_sqlite(self) -> bool:
+        return self.url.startswith('sqlite')
+
+    @property
+    def is_memory(self) -> bool:
+        return self.is_sqlite and (self.url in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in self.url)
+
+    @classmethod
+    def from_env(cls) -> DatabaseConfig:
+        url: Optional[str] = os.getenv('EMAIL_READER_DB_URL')
+
+        if os.getenv('DB_USE_INMEMORY', '') == '1':
+            url = 'sqlite:///:memory:'
+        elif not url:
+            url = cls.default_sqlite_url()
+
+        return cls(
+            url=url,
+            pool_size=int(os.getenv('EMAIL_READER_DB_POOL_SIZE', cls.pool_size)),
+            echo=cls.parse_echo(os.getenv('EMAIL_READER_DB_ECHO', '')),
+            sqlite_mmap_size=int(os.getenv('EMAIL_READER_SQLITE_MMAP_SIZE', cls.sqlite_mmap_size)),
+            sqlite_cache_size=int(os.getenv('EMAIL_READER_SQLITE_CACHE_SIZE', cls.sqlite_cache_size)),
+            search_index=os.getenv('EMAIL_READER_DB_FTS', '') == '1',
+            body_codec=os.getenv('EMAIL_READER_BODY_CODEC', cls.body_codec),
+        )
+
+    @staticmethod
+    def default_sqlite_url(db_file: Path = DEFAULT_DB_FILE) -> str:
+        db_file.parent.mkdir(parents=True, exist_ok=True)
+        return f'sqlite:///{db_file}'
+
+    @staticmethod
+    def parse_echo(value: str) -> Union[bool, Literal['debug']]:
+        value = value.strip().lower()
+        if value == 'debug':
+            return 'debug'
+        return value in ('1', 'true', 'yes')
@@ -1,30 +1,114 @@
 from __future__ import annotations
 
-import os
-from pathlib import Path
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import replace
+from typing import Any, Iterator, Optional
 
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
 
-from sqlalchemy.orm import sessionmaker
 from email_reader.database.base import Base
+from email_reader.database.compression import register_body_codec, register_sqlite_functions
+from email_reader.database.config import DatabaseConfig
+from email_reader.database.migrations import upgrade_schema
+from email_reader.database.search import create_search_index, register_engine
 import email_reader.database.tables  # noqa
 
+_engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
 
-def get_engine():
+# Database of the account being worked on, see `use_database`, None is the configured database
+_database_url: ContextVar[Optional[str]] = ContextVar('database_url', default=None)
+_account_engines: dict[str, Engine] = {}
 
-    engine_suffix = '/:memory:'
 
-    if not os.getenv('DB_USE_INMEMORY', '') == '1':
-        db_file = Path.home() / Path(".email_reader/emails.sqlite")
-        if not db_file.parent.is_dir():
-            os.mkdir(db_file.parent)
-        engine_suffix = f'/{db_file}'
+def create_engine_from_config(config: DatabaseConfig) -> Engine:
+    kwargs: dict[str, Any] = {'echo': config.echo}
 
-    engine = create_engine(f"sqlite://{engine_suffix}", echo=True)
+    if config.is_memory:
+        # A single connection shared by every thread, otherwise each thread would see its own empty database
+        kwargs.update(poolclass=StaticPool, connect_args={'check_same_thread': False})
+    else:
+        kwargs['pool_size'] = config.pool_size
 
-    Base.metadata.create_all(bind=engine)
+    engine = create_engine(config.url, **kwargs)
+
+    if config.is_sqlite:
+        event.listen(engine, 'connect', lambda dbapi_connection, _: set_sqlite_pragmas(dbapi_connection, config))
+        event.listen(engine, 'connect', lambda dbapi_connection, _: register_sqlite_functions(dbapi_connection))
+        register_body_codec(engine, config.body_codec)
+    else:
+        # Other databases can only decode uncompressed bodies in SQL
+        register_body_codec(engine, 'none')
+
+    with engine.begin() as connection:
+        Base.metadata.create_all(bind=connection)
+        upgrade_schema(connection)
+
+        if config.search_index:
+            create_search_index(connection)
+        else:
+            register_engine(connection)
 
     return engine
 
 
-SessionFactory = sessionmaker(bind=get_engine(), future=True)
+def set_sqlite_pragmas(dbapi_connection, config: DatabaseConfig) -> None:
+    cursor = dbapi_connection.cursor()
+    if not config.is_memory:
+        # Readers do not block the writer and commits only append to the log
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={config.sqlite_mmap_size:d}")
+    cursor.execute(f"PRAGMA cache_size=-{config.sqlite_cache_size:d}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def get_engine() -> Engine:
+    """
+    Engine of the configured database, or of the one selected by `use_database` in the current context,
+    created along with the schema on first use
+    """
+    global _engine
+
+    url = _database_url.get()
+    if url is not None:
+        with _engine_lock:
+            if url not in _account_engines:
+                _account_engines[url] = create_engine_from_config(replace(DatabaseConfig.from_env(), url=url))
+            return _account_engines[url]
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine_from_config(DatabaseConfig.from_env())
+    return _engine
+
+
+@contextmanager
+def use_database(url: str) -> Iterator[None]:
+    """
+    Sessions created in the current thread or task use the database at `url` until exiting,
+    which lets the accounts be synced in parallel each in their own database
+    """
+    token = _database_url.set(url)
+    try:
+        yield
+    finally:
+        _database_url.reset(token)
+
+
+class LazySessionFactory(sessionmaker[Session]):
+    """Binds every session to `get_engine()` when it is created instead of at import time"""
+
+    def __call__(self, **local_kw: Any) -> Session:
+        if self.kw.get('bind') is None and 'bind' not in local_kw:
+            local_kw['bind'] = get_engine()
+        return super().__call__(**local_kw)
+
+
+SessionFactory = LazySessionFactory(future=True)
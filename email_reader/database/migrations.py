@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+from sqlalchemy import Connection, case, exists, inspect, literal, select, text
+from sqlalchemy.sql.elements import TextClause
+
+from email_reader.database.base import Base
+from email_reader.database.compression import compress_body, get_body_codec
+
+
+def upgrade_schema(connection: Connection) -> None:
+    """
+    `create_all` only creates the missing tables, the columns and indexes added to a table
+    after it was created are added here. New columns have to be nullable or have a server default
+    """
+    move_email_bodies(connection)
+    inspector = inspect(connection)
+
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}"
+            if column.server_default is not None:
+                default = column.server_default.arg  # type: ignore[attr-defined]
+                ddl += f" DEFAULT {default.text if isinstance(default, TextClause) else repr(default)}"
+            if not column.nullable:
+                ddl += " NOT NULL"
+            connection.execute(text(ddl))
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(connection)
+
+    backfill_email_labels(connection)
+
+
+def move_email_bodies(connection: Connection, chunk_size: int = 1000) -> None:
+    """Compresses the bodies of a database created before `EmailBody` into its table and drops `email.body`"""
+
+    inspector = inspect(connection)
+    if not inspector.has_table('email') or 'body' not in {column['name'] for column in inspector.get_columns('email')}:
+        return
+
+    from email_reader.database.tables.email_body import EmailBody
+
+    codec = get_body_codec(connection.engine)
+    insert = EmailBody.__table__.insert()
+
+    rows = connection.execute(text("SELECT id, body FROM email WHERE id NOT IN (SELECT id FROM email_body)"))
+    for chunk in iter(lambda: rows.fetchmany(chunk_size), []):
+        connection.execute(insert, [{'id': msg_id, 'content': compress_body(body, codec)} for msg_id, body in chunk])
+
+    connection.execute(text("ALTER TABLE email DROP COLUMN body"))
+
+
+def backfill_email_labels(connection: Connection) -> None:
+    """
+    Stores the labels `mailbox` and `read` were derived from for the emails of a database created before
+    `EmailLabel`, the other labels come with the next full sync. Only done while no email has a label row
+    """
+
+    from email_reader.database.tables.email import Email, MailBox
+    from email_reader.database.tables.email_label import EmailLabel
+
+    email, email_label = Email.__table__, EmailLabel.__table__
+    has_labels = connection.scalar(select(exists().select_from(email_label)))
+    if has_labels or not connection.scalar(select(exists().select_from(email))):
+        return
+
+    insert = email_label.insert()
+    mailbox_label = case(*((email.c.mailbox == mailbox, mailbox.value) for mailbox in MailBox))
+    connection.execute(insert.from_select(['email_id', 'label_id'], select(email.c.id, mailbox_label)))
+    unread = select(email.c.id, literal('UNREAD')).where(email.c.read.is_(False))
+    connection.execute(insert.from_select(['email_id', 'label_id'], unread))
@@ -0,0 +1,129 @@
+"""
+Optional SQLite FTS5 index over the subject and body of the emails
+
+The index is a trigram FTS5 table, so `MATCH` finds any substring of 3 or more characters, case insensitively,
+the same as the `LIKE '%value%'` it replaces. It only does for ASCII values without the `%` and `_` wildcards of
+`LIKE`, which is case insensitive for ASCII only, see `can_search`. Its rows share the rowid of the email they index,
+run `rebuild_search_index` after a `VACUUM` as it can renumber the rowids of the email table.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Iterable, Optional
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import Connection, Engine, bindparam, column, exc, inspect, literal_column, select, table, text
+from sqlalchemy.orm import Session
+
+from email_reader.console import console
+from email_reader.database.compression import SQL_FUNCTION
+
+SEARCH_TABLE = 'email_fts'
+SEARCH_COLUMNS = ('subject', 'body')
+MIN_SEARCH_LENGTH = 3
+
+search_table = table(SEARCH_TABLE, column('rowid'), *(column(name) for name in SEARCH_COLUMNS))
+
+# Bodies are stored compressed in `email_body`, the SQL function decodes them
+SELECT_SEARCH_COLUMNS = (
+    f"SELECT email.rowid, email.subject, {SQL_FUNCTION}(email_body.content) "
+    "FROM email LEFT JOIN email_body ON email_body.id = email.id"
+)
+
+index_stmt = text(
+    f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCH_COLUMNS)}) {SELECT_SEARCH_COLUMNS} WHERE email.id IN :msg_ids"
+).bindparams(bindparam('msg_ids', expanding=True))
+
+unindex_stmt = text(
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN (SELECT rowid FROM email WHERE id IN :msg_ids)"
+).bindparams(bindparam('msg_ids', expanding=True))
+
+
+# Whether the database of an engine has the index, looked up once when the engine is created
+_search_index_engines: WeakKeyDictionary[Engine, bool] = WeakKeyDictionary()
+
+
+def create_search_index(connection: Connection) -> bool:
+    """Creates and fills the index if it does not exist yet, returns False when FTS5 is not available"""
+
+    if connection.dialect.name != 'sqlite':
+        return False
+
+    if not inspect(connection).has_table(SEARCH_TABLE):
+        try:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5({', '.join(SEARCH_COLUMNS)}, tokenize='trigram')"
+            ))
+        except exc.OperationalError as e:
+            console.log(f"[yellow] SQLite FTS5 With Trigram Tokenizer Is Not Available, Skipping Search Index {e}")
+            return False
+
+        rebuild_search_index(connection)
+
+    _search_index_engines[connection.engine] = True
+    return True
+
+
+def register_engine(connection: Connection) -> None:
+    """Records whether the database has the index, an index created by an earlier run is used as well"""
+    has_index = connection.dialect.name == 'sqlite' and inspect(connection).has_table(SEARCH_TABLE)
+    _search_index_engines[connection.engine] = has_index
+
+
+def rebuild_search_index(connection: Connection) -> None:
+    connection.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+    connection.execute(text(f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCH_COLUMNS)}) {SELECT_SEARCH_COLUMNS}"))
+
+
+def has_search_index(engine: Engine) -> bool:
+    return _search_index_engines.get(engine, False)
+
+
+def index_emails(session: Session, msg_ids: Iterable[str]) -> None:
+    """Re-indexes the emails after they have been inserted or updated"""
+    if not has_search_index(session.get_bind()):
+        return
+
+    params = {'msg_ids': list(msg_ids)}
+    session.execute(unindex_stmt, params)
+    session.execute(index_stmt, params)
+
+
+def unindex_emails(session: Session, msg_ids: Iterable[str]) -> None:
+    """Removes the emails from the index, has to run before the emails are deleted"""
+    if not has_search_index(session.get_bind()):
+        return
+
+    session.execute(unindex_stmt, {'msg_ids': list(msg_ids)})
+
+
+def can_search(field_name: str, field_value: str) -> bool:
+    """Whether `MATCH` finds the same emails as `LIKE '%field_value%'`"""
+    if field_name not in SEARCH_COLUMNS or len(field_value) < MIN_SEARCH_LENGTH:
+        return False
+    if not field_value.isascii() or '%' in field_value or '_' in field_value:
+        return False
+
+    from email_reader.database.engine import get_engine
+    return has_search_index(get_engine())
+
+
+def search_fragment(field_name: str, field_value: str) -> Optional[str]:
+    """
+    Longest part of `field_value` between the `LIKE` wildcards, every value `LIKE '%field_value%'` contains it
+    so `MATCH` on it narrows down the emails to compare. None when it is too short or there is no index
+    """
+    fragment = max(re.split('[%_]', field_value), key=len)
+    if field_name not in SEARCH_COLUMNS or len(fragment) < MIN_SEARCH_LENGTH:
+        return None
+
+    from email_reader.database.engine import get_engine
+    return fragment if has_search_index(get_engine()) else None
+
+
+def match_statement(field_name: str, field_value: str):
+    """`email.rowid IN (...)` of the emails whose `field_name` contains `field_value`"""
+    phrase = '"' + field_value.replace('"', '""') + '"'
+    matches = select(search_table.c.rowid).where(search_table.c[field_name].op('MATCH')(phrase))
+    return literal_column('email.rowid').in_(matches)
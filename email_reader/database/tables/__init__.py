@@ -3,3 +3,8 @@ Add Any Additional tables which you want to add in this class
 """
 
 from .email import Email  # noqa
+from .email_body import EmailBody  # noqa
+from .email_label import EmailLabel  # noqa
+from .label import Label  # noqa
+from .rule_state import RuleState  # noqa
+from .sync_state import SyncState  # noqa
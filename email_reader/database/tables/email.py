@@ -1,16 +1,29 @@
 from __future__ import annotations
 
 import datetime
-from email.message import EmailMessage
+from email.message import EmailMessage, Message
 from email.utils import parseaddr, parsedate_to_datetime
 from enum import Enum
-from typing import List, Optional
+from typing import Any, List, Optional
 
-from sqlalchemy import Text, func, select
-from sqlalchemy.orm import Mapped, mapped_column, Session
+from sqlalchemy import delete, func, or_, select, text, update
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
 
+from email_reader.body import BodyExtractor, get_body_extractor
 from email_reader.database.base import Base
-from bs4 import BeautifulSoup
+from email_reader.database.compression import body_text
+from email_reader.database.tables.email_body import EmailBody
+from email_reader.database.tables.email_label import EmailLabel
+from email_reader.database.search import index_emails, unindex_emails
+
+
+def parse_date(value: str) -> datetime.datetime:
+    """A `Date:` header as naive UTC, a `-0000` offset (no timezone known) is taken as UTC rather than local time"""
+    date = parsedate_to_datetime(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 
 class MailBox(Enum):
@@ -30,6 +43,11 @@ class MailBox(Enum):
                 pass
         return cls.Inbox
 
+    @property
+    def is_removable(self) -> bool:
+        """Sent and Draft are assigned by Gmail and cannot be removed from a message"""
+        return self not in (MailBox.Sent, MailBox.Draft)
+
     def get_movable_locations(self) -> List[MailBox]:
         if self == MailBox.Draft:
             return [MailBox.Trash]
@@ -50,57 +68,140 @@ class Email(Base):
     date: Mapped[datetime.datetime] = mapped_column(nullable=False, index=True)
     mailbox: Mapped[MailBox] = mapped_column(nullable=False)
     read: Mapped[bool] = mapped_column(nullable=False)
-    body: Mapped[str] = mapped_column(Text, nullable=False)
+    # Gmail threadId, every email of a conversation shares it. None for the emails loaded before it was stored
+    thread_id: Mapped[Optional[str]] = mapped_column(nullable=True, index=True)
+    # Number of the load which last wrote the email, see `SyncState.ingest_seq`
+    ingest_seq: Mapped[int] = mapped_column(nullable=False, server_default=text('0'), index=True)
+    # False for the emails loaded with `metadata_only`, until a rule needs their body, see `Email.store_bodies`
+    body_fetched: Mapped[bool] = mapped_column(nullable=False, server_default=text('true'))
+    # Only loaded when the body is read, see `EmailBody`
+    stored_body: Mapped[Optional[EmailBody]] = relationship(
+        lazy='select', cascade='all, delete-orphan', passive_deletes=True
+    )
+    # Every Gmail label of the email, `mailbox` and `read` only keep the ones they are derived from
+    stored_labels: Mapped[List[EmailLabel]] = relationship(
+        lazy='select', cascade='all, delete-orphan', passive_deletes=True
+    )
+
+    @hybrid_property
+    def body(self) -> Optional[str]:
+        return self.stored_body.text if self.stored_body is not None else None
+
+    @body.inplace.setter
+    def _body_setter(self, value: Optional[str]) -> None:
+        self.stored_body = EmailBody.from_text(value) if value is not None else None
+
+    @body.inplace.expression
+    @classmethod
+    def _body_expression(cls):
+        return select(body_text(EmailBody.content)).where(EmailBody.id == cls.id).scalar_subquery()
+
+    @property
+    def label_ids(self) -> List[str]:
+        return [label.label_id for label in self.stored_labels]
+
+    @label_ids.setter
+    def label_ids(self, value: List[str]) -> None:
+        self.stored_labels = [EmailLabel(label_id=label) for label in dict.fromkeys(value)]
 
     def __repr__(self) -> str:
         return f"Email(id={self.id!r}, from={self.from_email!r}, subject={self.subject!r})"
 
     @classmethod
-    def from_email_message(cls, email_message: EmailMessage, msg_id: str, labels: List[str]):
-
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                if "attachment" in content_disposition:
-                    continue
-
-                if content_type == "text/plain":
-                    body = part.get_payload(decode=True).decode()  # type: ignore
-                elif content_type == "text/html":
-                    body = "\n".join(
-                        BeautifulSoup(
-                            part.get_payload(decode=True).decode(), "html.parser"
-                        ).stripped_strings
-                    )
+    def from_email_message(
+            cls, email_message: EmailMessage, msg_id: str, labels: List[str],
+            extractor: Optional[BodyExtractor] = None, thread_id: Optional[str] = None):
+        return cls(**cls.row_from_email_message(email_message, msg_id, labels, extractor, thread_id))
 
-        else:
-            content_type = email_message.get_content_type()
-            if content_type == "text/html":
-                body = "\n".join(
-                    BeautifulSoup(
-                        email_message.get_payload(decode=True).decode(), "html.parser"
-                    ).stripped_strings
-                )
-            else:
-                body = email_message.get_payload(decode=True).decode()
-
-        from_name, from_email = parseaddr(email_message['From'])
-        to_name, to_email = parseaddr(email_message['To'])
-
-        return Email(
+    @classmethod
+    def row_from_email_message(
+            cls, email_message: EmailMessage, msg_id: str, labels: List[str],
+            extractor: Optional[BodyExtractor] = None, thread_id: Optional[str] = None) -> dict[str, Any]:
+        """
+        Column values of the email, used by the bulk ingestion path which does not build ORM instances.
+        The body is extracted with `extractor`, defaulting to the one configured in the environment
+        """
+
+        return dict(
+            **cls.row_from_headers(email_message, msg_id, labels, thread_id),
+            body=(extractor or get_body_extractor())(email_message),
+            body_fetched=True,
+        )
+
+    @classmethod
+    def row_from_headers(
+            cls, headers: Message, msg_id: str, labels: List[str], thread_id: Optional[str] = None) -> dict[str, Any]:
+        """Column values taken from the headers and the labels, everything but the body"""
+
+        from_name, from_email = parseaddr(headers['From'])
+        to_name, to_email = parseaddr(headers['To'])
+
+        return dict(
             id=msg_id,
+            thread_id=thread_id,
             from_name=from_name if from_name else None,
             from_email=from_email,
             to_name=to_name if to_name else None,
             to_email=to_email,
-            subject=email_message['Subject'],
-            date=parsedate_to_datetime(email_message['Date']),
-            mailbox=MailBox.from_labels(labels),
-            read='UNREAD' in labels,
-            body=body
+            subject=headers['Subject'],
+            date=parse_date(headers['Date']),
+            label_ids=list(labels),
+            **cls.state_from_labels(labels)
         )
 
+    @classmethod
+    def state_from_labels(cls, labels: List[str]) -> dict[str, Any]:
+        """Columns derived from the Gmail labelIds of a message"""
+        return dict(mailbox=MailBox.from_labels(labels), read='UNREAD' not in labels)
+
+    @classmethod
+    def bulk_upsert(cls, session: Session, rows: List[dict[str, Any]]) -> int:
+        """
+        Inserts or updates the rows with a single executemany of `INSERT ... ON CONFLICT(id) DO UPDATE`,
+        without a primary key lookup or an ORM instance per row
+        """
+        if not rows:
+            return 0
+
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert  # type: ignore[assignment]
+        else:
+            raise NotImplementedError(f'Bulk Upsert is not Supported for {dialect}')
+
+        table = cls.__table__
+        stmt = insert(table)
+        set_ = {column.name: stmt.excluded[column.name] for column in table.columns if not column.primary_key}
+        # Loading an email again with `metadata_only` keeps the body fetched earlier, messages never change
+        set_['body_fetched'] = or_(table.c.body_fetched, stmt.excluded.body_fetched)
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.id], set_=set_)
+        columns = set(table.columns.keys())
+        session.execute(stmt, [{key: value for key, value in row.items() if key in columns} for row in rows])
+        EmailBody.bulk_upsert(session, rows)
+        EmailLabel.bulk_replace(session, rows)
+        index_emails(session, [row['id'] for row in rows])
+        return len(rows)
+
+    @classmethod
+    def store_bodies(cls, session: Session, rows: List[dict[str, Any]]) -> None:
+        """Writes the `body` of rows fetched for emails loaded without it, leaving their other columns alone"""
+        if not rows:
+            return
+
+        msg_ids = [row['id'] for row in rows]
+        EmailBody.bulk_upsert(session, rows)
+        session.execute(update(cls).where(cls.id.in_(msg_ids)).values(body_fetched=True))
+        index_emails(session, msg_ids)
+
+    @classmethod
+    def bulk_delete(cls, session: Session, msg_ids: List[str]) -> None:
+        unindex_emails(session, msg_ids)
+        EmailBody.bulk_delete(session, msg_ids)
+        EmailLabel.bulk_delete(session, msg_ids)
+        session.execute(delete(cls).where(cls.id.in_(msg_ids)))
+
     @classmethod
     def get_last_updated_email_time(cls, session: Session) -> datetime.datetime:
         # Remove the dependency on SessionFactory
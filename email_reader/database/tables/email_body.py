@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+from typing import Any, List, Optional
+
+from sqlalchemy import ForeignKey, LargeBinary, delete, event
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from email_reader.database.base import Base
+from email_reader.database.compression import compress_body, decompress_body, get_body_codec
+
+
+class EmailBody(Base):
+    """
+    Compressed body of an email, kept out of the email table so that its rows stay narrow
+    and the queries which never look at the body do not read it from disk
+    """
+
+    __tablename__ = "email_body"
+
+    id: Mapped[str] = mapped_column(ForeignKey('email.id', ondelete='CASCADE'), primary_key=True)
+    content: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    # Text of a body created without a codec, compressed when it is flushed, see `compress_pending_bodies`
+    pending_text = None
+
+    def __repr__(self) -> str:
+        size = len(self.content) if self.content is not None else None
+        return f"EmailBody(id={self.id!r}, size={size!r})"
+
+    @property
+    def text(self) -> Optional[str]:
+        return self.pending_text if self.pending_text is not None else decompress_body(self.content)
+
+    @classmethod
+    def from_text(cls, text: str, codec: Optional[str] = None) -> EmailBody:
+        """Without a `codec` the body is compressed with the codec of the engine it is written to"""
+        if codec is not None:
+            return cls(content=compress_body(text, codec))
+
+        body = cls()
+        body.pending_text = text
+        return body
+
+    @classmethod
+    def bulk_upsert(cls, session: Session, rows: List[dict[str, Any]]) -> None:
+        """Compresses and writes the `body` of the email rows, see `Email.bulk_upsert`"""
+        codec = get_body_codec(session.get_bind())  # type: ignore[arg-type]
+        params = [
+            {'id': row['id'], 'content': compress_body(row['body'], codec)}
+            for row in rows if row.get('body') is not None
+        ]
+        if not params:
+            return
+
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert  # type: ignore[assignment]
+
+        stmt = insert(cls.__table__)
+        stmt = stmt.on_conflict_do_update(index_elements=[stmt.table.c.id], set_={'content': stmt.excluded.content})
+        session.execute(stmt, params)
+
+    @classmethod
+    def bulk_delete(cls, session: Session, msg_ids: List[str]) -> None:
+        session.execute(delete(cls).where(cls.id.in_(msg_ids)))
+
+
+@event.listens_for(Session, 'before_flush')
+def compress_pending_bodies(session: Session, flush_context, instances) -> None:
+    """Compresses the bodies set through `Email.body` with the codec of the session's engine"""
+    codec = get_body_codec(session.get_bind())  # type: ignore[arg-type]
+    for body in session.new:
+        if isinstance(body, EmailBody) and body.pending_text is not None:
+            body.content = compress_body(body.pending_text, codec)
+            body.pending_text = None
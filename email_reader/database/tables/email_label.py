@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Iterable, List, Mapping
+
+from sqlalchemy import ForeignKey, Index, delete, select
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from email_reader.database.base import Base
+
+
+class EmailLabel(Base):
+    """
+    Gmail labels of an email, one row per label id. The primary key finds the labels of an email
+    and `ix_email_label_label_id_email_id` the emails of a label without reading the email table
+    """
+
+    __tablename__ = "email_label"
+    __table_args__ = (Index('ix_email_label_label_id_email_id', 'label_id', 'email_id'),)
+
+    email_id: Mapped[str] = mapped_column(ForeignKey('email.id', ondelete='CASCADE'), primary_key=True)
+    label_id: Mapped[str] = mapped_column(primary_key=True)
+
+    def __repr__(self) -> str:
+        return f"EmailLabel(email_id={self.email_id!r}, label_id={self.label_id!r})"
+
+    @classmethod
+    def bulk_replace(cls, session: Session, rows: List[dict[str, Any]]) -> None:
+        """Replaces the labels of the email rows carrying `label_ids`, see `Email.bulk_upsert`"""
+        labels = {row['id']: row['label_ids'] for row in rows if row.get('label_ids') is not None}
+        if not labels:
+            return
+
+        cls.bulk_delete(session, list(labels))
+        cls.bulk_add(session, labels)
+
+    @classmethod
+    def bulk_add(cls, session: Session, labels: Mapping[str, Iterable[str]]) -> None:
+        """Adds the label ids by email id, the ones an email already has are left alone"""
+        params = [{'email_id': msg_id, 'label_id': label} for msg_id, ids in labels.items() for label in set(ids)]
+        if not params:
+            return
+
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert  # type: ignore[assignment]
+
+        session.execute(insert(cls.__table__).on_conflict_do_nothing(), params)
+
+    @classmethod
+    def bulk_remove(cls, session: Session, msg_ids: List[str], label_ids: Iterable[str]) -> None:
+        label_ids = list(label_ids)
+        if label_ids:
+            session.execute(delete(cls).where(cls.email_id.in_(msg_ids), cls.label_id.in_(label_ids)))
+
+    @classmethod
+    def bulk_delete(cls, session: Session, msg_ids: List[str]) -> None:
+        session.execute(delete(cls).where(cls.email_id.in_(msg_ids)))
+
+    @classmethod
+    def get_labels(cls, session: Session, msg_ids: List[str]) -> dict[str, set[str]]:
+        labels: dict[str, set[str]] = defaultdict(set)
+        for msg_id, label in session.execute(select(cls.email_id, cls.label_id).where(cls.email_id.in_(msg_ids))):
+            labels[msg_id].add(label)
+        return labels
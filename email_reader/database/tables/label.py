@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from typing import Any, Iterable
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from email_reader.database.base import Base
+
+
+class Label(Base):
+    """
+    Gmail label of the mailbox, `id` is what the messages and the API calls use and `name` what the user sees.
+    System labels (e.g. STARRED, IMPORTANT) have their id as their name. Refreshed from `labels().list`
+    before the rules which use labels are run
+    """
+
+    __tablename__ = "label"
+
+    id: Mapped[str] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(nullable=False, index=True)
+    type: Mapped[str] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"Label(id={self.id!r}, name={self.name!r})"
+
+    @classmethod
+    def sync(cls, session: Session, labels: Iterable[dict[str, Any]]) -> None:
+        """Replaces the stored labels with the `label` resources of the mailbox"""
+        labels = list(labels)
+        session.execute(delete(cls).where(cls.id.not_in([label['id'] for label in labels])))
+        for label in labels:
+            session.merge(cls(id=label['id'], name=label['name'], type=label.get('type', 'user')))
+
+    @classmethod
+    def get_ids(cls, session: Session) -> dict[str, str]:
+        """Label id by name and by id, so rules can refer to a label either way"""
+        ids: dict[str, str] = {}
+        for label_id, name in session.execute(select(cls.id, cls.name)):
+            ids[name] = label_id
+            ids[label_id] = label_id
+        return ids
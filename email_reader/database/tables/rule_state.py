@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+import datetime
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from email_reader.database.base import Base
+from email_reader.database.tables.sync_state import utcnow
+
+
+class RuleState(Base):
+    """
+    Processing watermark of a rule, keyed by the fingerprint of its conditions and actions.
+    Emails with an `ingest_seq` up to `watermark` have already been handled by the rule,
+    editing the rule changes its fingerprint so it starts again from the first email
+    """
+
+    __tablename__ = "rule_state"
+
+    fingerprint: Mapped[str] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(nullable=False)
+    watermark: Mapped[int] = mapped_column(nullable=False)
+    updated_at: Mapped[datetime.datetime] = mapped_column(nullable=False)
+
+    def __repr__(self) -> str:
+        return f"RuleState(name={self.name!r}, watermark={self.watermark!r})"
+
+    @classmethod
+    def get_watermarks(cls, session: Session, fingerprints: Iterable[str]) -> dict[str, int]:
+        stmt = select(cls.fingerprint, cls.watermark).where(cls.fingerprint.in_(list(fingerprints)))
+        return {fingerprint: watermark for fingerprint, watermark in session.execute(stmt)}
+
+    @classmethod
+    def set_watermark(cls, session: Session, fingerprint: str, name: str, watermark: int) -> None:
+        session.merge(cls(fingerprint=fingerprint, name=name, watermark=watermark, updated_at=utcnow()))
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import datetime
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Mapped, Session, mapped_column
+
+from email_reader.database.base import Base
+
+
+class SyncState(Base):
+    """
+    Sync cursor of a mailbox, `history_id` is the Gmail historyId up to which the local copy is in sync
+    and `ingest_seq` the number of the last load, stamped on every email it wrote
+    """
+
+    __tablename__ = "sync_state"
+
+    id: Mapped[str] = mapped_column(primary_key=True)
+    history_id: Mapped[Optional[str]] = mapped_column(nullable=True)
+    ingest_seq: Mapped[int] = mapped_column(nullable=False, server_default=text('0'))
+    updated_at: Mapped[datetime.datetime] = mapped_column(nullable=False)
+    # Listing of the mailbox in progress, kept until every listed email is written so that an interrupted
+    # sync resumes at the page of its last committed chunk, see `load_emails`. `listing_history_id` is
+    # the historyId captured before the listing started and `listing_ingest_seq` the load which started it
+    listing_history_id: Mapped[Optional[str]] = mapped_column(nullable=True)
+    listing_query: Mapped[Optional[str]] = mapped_column(nullable=True)
+    listing_page_token: Mapped[Optional[str]] = mapped_column(nullable=True)
+    listing_ingest_seq: Mapped[Optional[int]] = mapped_column(nullable=True)
+
+    def __repr__(self) -> str:
+        return f"SyncState(id={self.id!r}, history_id={self.history_id!r}, ingest_seq={self.ingest_seq!r})"
+
+    @classmethod
+    def get_or_create(cls, session: Session, user_id: str = 'me') -> SyncState:
+        state = session.get(cls, user_id)
+        if state is None:
+            state = cls(id=user_id, ingest_seq=0, updated_at=utcnow())
+            session.add(state)
+        return state
+
+    @classmethod
+    def get_history_id(cls, session: Session, user_id: str = 'me') -> Optional[str]:
+        state = session.get(cls, user_id)
+        return state.history_id if state else None
+
+    @classmethod
+    def set_history_id(cls, session: Session, history_id: Optional[str], user_id: str = 'me') -> None:
+        state = cls.get_or_create(session, user_id)
+        state.history_id = history_id
+        state.updated_at = utcnow()
+
+    @classmethod
+    def get_ingest_seq(cls, session: Session, user_id: str = 'me') -> int:
+        state = session.get(cls, user_id)
+        return state.ingest_seq if state else 0
+
+    @classmethod
+    def next_ingest_seq(cls, session: Session, user_id: str = 'me') -> int:
+        """Number of a new load, never reused even if every email of the previous loads is deleted"""
+        state = cls.get_or_create(session, user_id)
+        state.ingest_seq += 1
+        state.updated_at = utcnow()
+        return state.ingest_seq
+
+    @classmethod
+    def get_listing(cls, session: Session, user_id: str = 'me') -> Optional[SyncState]:
+        """The state of an unfinished listing, None when there is none"""
+        state = session.get(cls, user_id)
+        return state if state is not None and state.listing_history_id is not None else None
+
+    @classmethod
+    def start_listing(
+            cls, session: Session, history_id: str, query: Optional[str], ingest_seq: int,
+            user_id: str = 'me') -> SyncState:
+        state = cls.get_or_create(session, user_id)
+        state.listing_history_id = history_id
+        state.listing_query = query
+        state.listing_page_token = None
+        state.listing_ingest_seq = ingest_seq
+        state.updated_at = utcnow()
+        return state
+
+    @classmethod
+    def set_listing_page(cls, session: Session, page_token: Optional[str], user_id: str = 'me') -> None:
+        """Token of the first page which still has emails to write, None for the first page"""
+        state = cls.get_or_create(session, user_id)
+        state.listing_page_token = page_token
+        state.updated_at = utcnow()
+
+    @classmethod
+    def finish_listing(cls, session: Session, user_id: str = 'me') -> None:
+        """Moves the sync cursor to the historyId of the finished listing, the changes made since are synced next"""
+        state = cls.get_or_create(session, user_id)
+        state.history_id = state.listing_history_id
+        cls.clear_listing(session, user_id)
+
+    @classmethod
+    def clear_listing(cls, session: Session, user_id: str = 'me') -> None:
+        state = cls.get_or_create(session, user_id)
+        state.listing_history_id = state.listing_query = state.listing_page_token = None
+        state.listing_ingest_seq = None
+        state.updated_at = utcnow()
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
@@ -1,31 +1,463 @@
 from __future__ import annotations
 
+import time
+from collections import deque
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, Union, cast
 
 from rich.console import Console
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.orm import Session
 
-from email_reader.services.gmail import GmailService
+from email_reader.metrics import metrics
+from email_reader.services.gmail import (
+    GmailService, HistoryChanges, HistoryExpiredError, PageTokenExpiredError, after_query
+)
+from email_reader.services.ratelimit import USER_QUOTA_PER_SECOND
+from email_reader.utils import chunked
 
+if TYPE_CHECKING:
+    from argparse import Namespace
 
-def load_emails(service: GmailService, since_last_commit: bool = True) -> None:
+    from email_reader.accounts import Account
+    from email_reader.database.tables import SyncState
+    from email_reader.logics.evaluator import IngestRuleEvaluator
+    from email_reader.services.async_gmail import AsyncGmailService
 
-    from email_reader.database.tables.email import Email
+DEFAULT_CHUNK_SIZE = 500
+
+
+class UnfetchedEmailsError(Exception):
+    """Emails still failing with a retryable error after the retries, the sync cursor is left before them"""
+
+
+@metrics.timed('stage_seconds', stage='load')
+def load_emails(
+        service: GmailService, since_last_commit: bool = True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        evaluator: Optional[IngestRuleEvaluator] = None, resume: bool = True) -> int:
+    """
+    Streams emails from the service into the database, committing every `chunk_size` emails
+    so that memory usage stays flat regardless of the size of the mailbox
+
+    When a sync cursor is stored, only the history since the cursor is applied, a listing of the
+    mailbox is only done on the first sync, when the cursor has expired or when starting from beginning
+
+    Every chunk commit also records the listing page it got to, a listing interrupted by a crash,
+    an expired token or the quota is resumed from there by the next load unless `resume` is False,
+    see `get_resumable_listing`
+
+    Every committed chunk is passed to the `evaluator`, which queues the rule matches of the new emails
+
+    Emails the fetchers gave up on while Gmail kept failing are fetched again by the next load,
+    neither the history cursor nor the listing moves past them, see `check_fetched`
+    """
+
+    from email_reader.database.tables import Email, SyncState
     from email_reader.database.engine import SessionFactory
 
     console = Console()
+    service.clear_unfetched_ids()
 
     with SessionFactory() as session:
 
-        if since_last_commit:
-            emails = service.get_emails(Email.get_last_updated_email_time(session))
+        listing = get_resumable_listing(session, since_last_commit, resume)
+        history_id = SyncState.get_history_id(session) if since_last_commit else None
+        full_sync = not since_last_commit
+        ingest_seq = SyncState.next_ingest_seq(session)
+        session.commit()
+
+        if listing is None and history_id:
+            try:
+                return sync_history(service, session, history_id, chunk_size, ingest_seq, evaluator)
+            except HistoryExpiredError:
+                console.log("Sync Cursor Has Expired, Running a Full Sync")
+                full_sync = True
+
+        resumed = listing is not None
+        if listing is None:
+            # Captured before listing, so that changes made during the listing are replayed by the next sync
+            after = None if full_sync else Email.get_last_updated_email_time(session)
+            listing = SyncState.start_listing(session, service.get_history_id(), after_query(after), ingest_seq)
+            session.commit()
         else:
-            emails = service.get_emails()
+            console.log("Resuming the Interrupted Listing of the Mailbox")
+
+        checkpoint = ListingCheckpoint(session, listing, service, resumed)
+        rows = service.get_email_rows_by_ids(checkpoint.list_ids())
+        total = write_emails(session, rows, chunk_size, ingest_seq, evaluator, checkpoint)
+
+        check_fetched(service)
+        SyncState.finish_listing(session)
+        session.commit()
+        console.log(f"Added {total} Emails")
+
+    return total
+
+
+def load_accounts(
+        accounts: list[Account], parallel: int = 4, since_last_commit: bool = True,
+        chunk_size: int = DEFAULT_CHUNK_SIZE, service_class: type[GmailService] = GmailService, resume: bool = True,
+        **service_kwargs) -> dict[str, Union[int, Exception]]:
+    """
+    Loads every account into its own database, `parallel` accounts at a time, see `run_accounts`.
+    The services are created one at a time beforehand, as authorizing a new account opens the browser
+    """
+
+    from email_reader.accounts import run_accounts
+
+    services = {
+        account.name: service_class.create(account.credentials_file, account.get_token_file(), **service_kwargs)
+        for account in accounts
+    }
+    return run_accounts(
+        accounts, lambda account: load_emails(services[account.name], since_last_commit, chunk_size, resume=resume),
+        parallel
+    )
+
+
+def sync_history(
+        service: GmailService, session: Session, history_id: str, chunk_size: int, ingest_seq: int,
+        evaluator: Optional[IngestRuleEvaluator] = None) -> int:
+    changes: HistoryChanges = service.get_history_changes(history_id)
+
+    apply_history_changes(session, changes, chunk_size, ingest_seq, evaluator)
+    total = write_emails(session, service.get_email_rows_by_ids(changes.added), chunk_size, ingest_seq, evaluator)
+    check_fetched(service)
+    finish_history_sync(session, history_id, changes, total)
+
+    return total
+
+
+def apply_history_changes(
+        session: Session, changes: HistoryChanges, chunk_size: int, ingest_seq: int,
+        evaluator: Optional[IngestRuleEvaluator] = None) -> None:
+    """
+    Deletes and relabels the emails locally, the added emails are left to the caller to fetch.
+    The emails whose labels changed are passed to the `evaluator` as they are marked as changed
+    """
+
+    from email_reader.database.tables import Email
+
+    for msg_ids in chunked(changes.deleted, chunk_size):
+        Email.bulk_delete(session, msg_ids)
+
+    # Relabeled emails may never have been loaded, so a plain executemany rather than an ORM bulk update.
+    # Label changes made by our own actions are already applied locally and do not mark the email as changed
+    table = Email.__table__
+    stmt = update(table).where(
+        table.c.id == bindparam('msg_id'),
+        or_(table.c.mailbox != bindparam('new_mailbox'), table.c.read != bindparam('new_read'))
+    ).values(mailbox=bindparam('new_mailbox'), read=bindparam('new_read'), ingest_seq=ingest_seq)
+    for relabeled in chunked(changes.relabeled.items(), chunk_size):
+        params = []
+        for msg_id, labels in relabeled:
+            state = Email.state_from_labels(labels)
+            params.append({'msg_id': msg_id, 'new_mailbox': state['mailbox'], 'new_read': state['read']})
+        session.execute(stmt, params)
+        relabel_emails(session, dict(relabeled), ingest_seq)
+
+    if evaluator is not None:
+        # Rules look at the emails loaded since they last ran, which includes these, see `get_evaluated_rules`
+        stmt = select(*Email.__table__.columns, Email.body.label('body')).where(Email.ingest_seq == ingest_seq)
+        for rows in chunked(session.execute(stmt).mappings(), chunk_size):
+            evaluator(rows)
+
+
+def relabel_emails(session: Session, labels: dict[str, list[str]], ingest_seq: int) -> None:
+    """
+    Replaces the stored labels of the emails whose labels changed, including the ones which leave the mailbox
+    and the read state alone like STARRED or a user label, and marks those emails as changed
+    """
+
+    from email_reader.database.tables import Email, EmailLabel
+
+    msg_ids = list(labels)
+    stored = EmailLabel.get_labels(session, msg_ids)
+    loaded = set(session.scalars(select(Email.id).where(Email.id.in_(msg_ids))))
+    changed = [msg_id for msg_id in msg_ids if msg_id in loaded and set(labels[msg_id]) != stored.get(msg_id, set())]
+    if not changed:
+        return
+
+    EmailLabel.bulk_replace(session, [{'id': msg_id, 'label_ids': labels[msg_id]} for msg_id in changed])
+    session.execute(update(Email).where(Email.id.in_(changed)).values(ingest_seq=ingest_seq))
 
-        for email_message in emails:
-            session.merge(email_message)
 
+def check_fetched(service: Union[GmailService, AsyncGmailService]) -> None:
+    """
+    Raises when the fetchers gave up on emails, before the cursor moves past them. The history sync
+    is then replayed from the same cursor and the listing resumed from the page of the first of them
+    """
+    unfetched = service.unfetched_ids
+    if unfetched:
+        raise UnfetchedEmailsError(f"{len(unfetched)} Emails Could Not Be Fetched, The Next Load Fetches Them Again")
+
+
+def finish_history_sync(session: Session, history_id: str, changes: HistoryChanges, total: int) -> None:
+    from email_reader.database.tables import SyncState
+
+    SyncState.set_history_id(session, changes.history_id)
+    session.commit()
+    Console().log(
+        f"Added {total} Emails, Deleted {len(changes.deleted)} Emails, "
+        f"Relabeled {len(changes.relabeled)} Emails Since History {history_id}"
+    )
+
+
+def load_bodies(
+        service: GmailService, session: Session, msg_ids: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Fetches and stores the bodies of emails loaded with `metadata_only`, committing every `chunk_size` emails"""
+
+    from email_reader.database.tables import Email
+
+    total = 0
+    for chunk in chunked(service.get_body_rows(msg_ids), chunk_size):
+        Email.store_bodies(session, chunk)
         session.commit()
-        console.log(f"Added {len(emails)} Emails")
+        total += len(chunk)
+
+    Console().log(f"Fetched the Bodies of {total} Emails")
+    return total
+
+
+def write_emails(
+        session: Session, rows: Iterable[dict[str, Any]], chunk_size: int, ingest_seq: int,
+        evaluator: Optional[IngestRuleEvaluator] = None, checkpoint: Optional[ListingCheckpoint] = None) -> int:
+    """Upserts the email rows in chunks of `chunk_size`, committing after each chunk"""
+
+    writer = ChunkWriter(session, ingest_seq, evaluator, checkpoint)
+    for chunk in chunked(rows, chunk_size):
+        writer.write(chunk)
+    return writer.finish()
+
+
+def get_resumable_listing(session: Session, since_last_commit: bool, resume: bool = True) -> Optional[SyncState]:
+    """
+    The interrupted listing to resume, if any. A full sync only resumes a full listing, an interrupted
+    incremental one (listing the emails `after:` the last one) is started over as a full listing.
+    A listing which is not resumed is dropped, a later load would otherwise resume it and move
+    the sync cursor back to the historyId it captured
+    """
+    from email_reader.database.tables import SyncState
+
+    listing = SyncState.get_listing(session)
+    if listing is None:
+        return None
+    if resume and (since_last_commit or listing.listing_query is None):
+        return listing
+
+    SyncState.clear_listing(session)
+    return None
+
+
+class ListingCheckpoint:
+    """
+    Keeps the page token of the listed ids until their emails are written, so that every chunk commit
+    records the first listing page which is not entirely written. The fetchers keep the listing order,
+    the page of the last written email is that page, unless an earlier page has emails the fetchers
+    gave up on. On resume the emails already written by the interrupted load are skipped
+
+    Gmail rejects page tokens which are too old, the listing then starts over from the first page
+    """
+
+    def __init__(
+            self, session: Session, listing: SyncState, service: Union[GmailService, AsyncGmailService],
+            resumed: bool = False) -> None:
+        self.session = session
+        self.service = service
+        self.query = listing.listing_query
+        self.page_token = listing.listing_page_token
+        self.started_seq = listing.listing_ingest_seq if resumed else None
+        self._pages: deque[tuple[Optional[str], set[str]]] = deque()
+
+    def list_ids(self) -> Iterator[str]:
+        """Ids of the listing from its stored page on"""
+        service = cast(GmailService, self.service)
+        try:
+            yield from self.track(service.list_message_pages(self.query, self.page_token))
+        except PageTokenExpiredError:
+            self.restart()
+            yield from self.track(service.list_message_pages(self.query))
+
+    async def list_ids_async(self) -> AsyncIterator[str]:
+        service = cast('AsyncGmailService', self.service)
+        try:
+            async for msg_id in self.track_async(service.list_message_pages(self.query, self.page_token)):
+                yield msg_id
+        except PageTokenExpiredError:
+            self.restart()
+            async for msg_id in self.track_async(service.list_message_pages(self.query)):
+                yield msg_id
+
+    def track(self, pages: Iterable[tuple[Optional[str], list[str]]]) -> Iterator[str]:
+        for page_token, msg_ids in pages:
+            yield from self._add_page(page_token, msg_ids)
+
+    async def track_async(self, pages: AsyncIterable[tuple[Optional[str], list[str]]]) -> AsyncIterator[str]:
+        async for page_token, msg_ids in pages:
+            for msg_id in self._add_page(page_token, msg_ids):
+                yield msg_id
+
+    def restart(self) -> None:
+        Console().log(f"Listing Page {self.page_token} Has Expired, Starting the Listing Over")
+
+    def save(self, chunk: list[dict[str, Any]]) -> None:
+        """Records the page to resume at, committed along with the chunk"""
+        from email_reader.database.tables import SyncState
+
+        last_id = chunk[-1]['id']
+        unfetched = self.service.unfetched_ids
+        while len(self._pages) > 1 and last_id not in self._pages[0][1] and self._pages[0][1].isdisjoint(unfetched):
+            self._pages.popleft()
+        if self._pages and self._pages[0][0] != self.page_token:
+            self.page_token = self._pages[0][0]
+            SyncState.set_listing_page(self.session, self.page_token)
+
+    def _add_page(self, page_token: Optional[str], msg_ids: list[str]) -> list[str]:
+        from email_reader.database.tables import Email
+
+        if msg_ids and self.started_seq is not None:
+            written = set(self.session.scalars(
+                select(Email.id).where(Email.id.in_(msg_ids), Email.ingest_seq >= self.started_seq)
+            ))
+            msg_ids = [msg_id for msg_id in msg_ids if msg_id not in written]
+        self._pages.append((page_token, set(msg_ids)))
+        return msg_ids
+
+
+class ChunkWriter:
+    """Writes the chunks of rows of a load, shared by the sync and async loaders"""
+
+    def __init__(
+            self, session: Session, ingest_seq: int, evaluator: Optional[IngestRuleEvaluator] = None,
+            checkpoint: Optional[ListingCheckpoint] = None) -> None:
+        self.session = session
+        self.ingest_seq = ingest_seq
+        self.evaluator = evaluator
+        self.checkpoint = checkpoint
+        self.console = Console()
+        self.total = 0
+        self.write_time = 0.0
+
+    def write(self, chunk: list[dict[str, Any]]) -> None:
+        from email_reader.database.tables import Email
+
+        started = time.perf_counter()
+        for row in chunk:
+            row['ingest_seq'] = self.ingest_seq
+        written = Email.bulk_upsert(self.session, chunk)
+        if self.checkpoint is not None:
+            self.checkpoint.save(chunk)
+        self.session.commit()
+        elapsed = time.perf_counter() - started
+
+        self.total += written
+        self.write_time += elapsed
+        metrics.inc('emails_written_total', written)
+        metrics.observe('db_write_seconds', elapsed)
+        self.console.log(f"Committed {self.total} Emails So Far")
+
+        if self.evaluator is not None:
+            self.evaluator(chunk)
+
+    def finish(self) -> int:
+        if self.total:
+            rate = self.total / max(self.write_time, 1e-9)
+            self.console.log(f"Wrote {self.total} Emails in {self.write_time:.2f}s ({rate:.0f} Emails/s)")
+        return self.total
+
+
+@metrics.timed('stage_seconds', stage='load')
+async def load_emails_async(
+        service: AsyncGmailService, since_last_commit: bool = True, chunk_size: int = DEFAULT_CHUNK_SIZE,
+        evaluator: Optional[IngestRuleEvaluator] = None, resume: bool = True) -> int:
+    """`load_emails` for an `AsyncGmailService`, the database writes run on the event loop between fetches"""
+
+    from email_reader.database.tables import Email, SyncState
+    from email_reader.database.engine import SessionFactory
+
+    console = Console()
+    service.clear_unfetched_ids()
+
+    with SessionFactory() as session:
+
+        listing = get_resumable_listing(session, since_last_commit, resume)
+        history_id = SyncState.get_history_id(session) if since_last_commit else None
+        full_sync = not since_last_commit
+        ingest_seq = SyncState.next_ingest_seq(session)
+        session.commit()
+
+        if listing is None and history_id:
+            try:
+                changes = await service.get_history_changes(history_id)
+            except HistoryExpiredError:
+                console.log("Sync Cursor Has Expired, Running a Full Sync")
+                full_sync = True
+            else:
+                apply_history_changes(session, changes, chunk_size, ingest_seq, evaluator)
+                rows = service.get_email_rows_by_ids(changes.added)
+                total = await write_emails_async(session, rows, chunk_size, ingest_seq, evaluator)
+                check_fetched(service)
+                finish_history_sync(session, history_id, changes, total)
+                return total
+
+        resumed = listing is not None
+        if listing is None:
+            after = None if full_sync else Email.get_last_updated_email_time(session)
+            listing = SyncState.start_listing(session, await service.get_history_id(), after_query(after), ingest_seq)
+            session.commit()
+        else:
+            console.log("Resuming the Interrupted Listing of the Mailbox")
+
+        checkpoint = ListingCheckpoint(session, listing, service, resumed)
+        rows = service.get_email_rows_by_ids(checkpoint.list_ids_async())
+        total = await write_emails_async(session, rows, chunk_size, ingest_seq, evaluator, checkpoint)
+
+        check_fetched(service)
+        SyncState.finish_listing(session)
+        session.commit()
+        console.log(f"Added {total} Emails")
+
+    return total
+
+
+async def load_bodies_async(
+        service: AsyncGmailService, session: Session, msg_ids: Iterable[str],
+        chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    from email_reader.database.tables import Email
+
+    total = 0
+    chunk: list[dict[str, Any]] = []
+    async for row in service.get_body_rows(msg_ids):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            Email.store_bodies(session, chunk)
+            session.commit()
+            total += len(chunk)
+            chunk = []
+
+    Email.store_bodies(session, chunk)
+    session.commit()
+    total += len(chunk)
+
+    Console().log(f"Fetched the Bodies of {total} Emails")
+    return total
+
+
+async def write_emails_async(
+        session: Session, rows: AsyncIterable[dict[str, Any]], chunk_size: int, ingest_seq: int,
+        evaluator: Optional[IngestRuleEvaluator] = None, checkpoint: Optional[ListingCheckpoint] = None) -> int:
+    writer = ChunkWriter(session, ingest_seq, evaluator, checkpoint)
+    chunk: list[dict[str, Any]] = []
+
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            writer.write(chunk)
+            chunk = []
+
+    if chunk:
+        writer.write(chunk)
+    return writer.finish()
 
 
 def run():
@@ -44,8 +476,113 @@ def run():
         type=Path
     )
 
+    parser.add_argument(
+        '--no-resume',
+        help='Start the Listing of the Mailbox Over Instead of Resuming an Interrupted One',
+        action='store_false', dest='resume'
+    )
+
+    parser.add_argument(
+        '--chunk-size',
+        help='Number of Emails Written to the Database per Commit',
+        type=int, default=DEFAULT_CHUNK_SIZE
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        help='Number of Messages Fetched per Gmail Batch Request (Max 100)',
+        type=int, default=100
+    )
+
+    parser.add_argument(
+        '--concurrency',
+        help='Number of Gmail Batch Requests Kept in Flight',
+        type=int, default=4
+    )
+
+    parser.add_argument(
+        '--quota',
+        help='Gmail Quota Units Spent per Second, Lowered Automatically When Gmail Throttles the Requests',
+        type=float, default=USER_QUOTA_PER_SECOND
+    )
+
+    parser.add_argument(
+        '--parse-processes',
+        help='Number of Processes Parsing the Fetched Emails, 0 Parses Them on the Main Process',
+        type=int, default=0
+    )
+
+    parser.add_argument(
+        '--async',
+        help='Fetch Each Email With Its Own Request on an Event Loop Instead of Batches, Needs email_reader[async]',
+        action='store_true', dest='use_async'
+    )
+
+    parser.add_argument(
+        '--metadata-only',
+        help='Fetch Only the Headers and Labels of the Emails, Their Bodies Are Fetched When a Rule Needs Them',
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--metrics',
+        help='Write the Metrics of the Run to This File, as JSON When It Ends With .json, Prometheus Text Otherwise',
+        type=Path
+    )
+
+    parser.add_argument(
+        '--accounts',
+        help='Path for an Accounts JSON File, Each Account is Loaded Into Its Own Database',
+        type=Path
+    )
+
+    parser.add_argument(
+        '--parallel',
+        help='Number of Accounts Loaded at the Same Time',
+        type=int, default=4
+    )
+
     args = parser.parse_args()
+    if args.accounts and args.use_async:
+        parser.error('--accounts Cannot Be Used With --async')
+
+    try:
+        load_from_args(args)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
 
-    service = GmailService.create(args.credentials_file)
 
-    load_emails(service, args.from_beginning)
+def load_from_args(args: Namespace) -> None:
+    if args.accounts:
+        from email_reader.accounts import Accounts
+
+        accounts = Accounts.from_file(args.accounts).accounts
+        load_accounts(
+            accounts, args.parallel, args.from_beginning, args.chunk_size, batch_size=args.batch_size,
+            concurrency=args.concurrency, parse_processes=args.parse_processes, units_per_second=args.quota,
+            metadata_only=args.metadata_only, resume=args.resume
+        )
+        return
+
+    if args.use_async:
+        import asyncio
+
+        from email_reader.services.async_gmail import AsyncGmailService
+
+        async def load() -> None:
+            # As many messages in flight as the batches would have
+            async with AsyncGmailService.create(
+                    args.credentials_file, concurrency=args.batch_size * args.concurrency,
+                    units_per_second=args.quota, metadata_only=args.metadata_only) as service:
+                await load_emails_async(service, args.from_beginning, args.chunk_size, resume=args.resume)
+
+        asyncio.run(load())
+        return
+
+    service = GmailService.create(
+        args.credentials_file, batch_size=args.batch_size, concurrency=args.concurrency,
+        parse_processes=args.parse_processes, units_per_second=args.quota, metadata_only=args.metadata_only
+    )
+
+    load_emails(service, args.from_beginning, args.chunk_size, resume=args.resume)
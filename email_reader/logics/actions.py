@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterator, Iterator, Mapping, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import Session
+
+from email_reader.database.tables import EmailLabel
+from email_reader.database.tables.email import Email, MailBox
+from email_reader.services.gmail import GmailService
+from email_reader.utils import chunked
+
+if TYPE_CHECKING:
+    from email_reader.services.async_gmail import AsyncGmailService
+
+
+@dataclass(frozen=True)
+class LabelChange:
+    """
+    Gmail label change of an action along with the local columns it results in,
+    emails sharing the same change are modified together with `batchModify`, or a whole thread at once
+    """
+
+    add_labels: tuple[str, ...] = ()
+    remove_labels: tuple[str, ...] = ()
+    mailbox: Optional[MailBox] = None
+    read: Optional[bool] = None
+
+    @property
+    def column_values(self) -> dict[str, Any]:
+        values: dict[str, Any] = {}
+        if self.mailbox is not None:
+            values['mailbox'] = self.mailbox
+        if self.read is not None:
+            values['read'] = self.read
+        return values
+
+    @property
+    def is_trash(self) -> bool:
+        """Only moves to the trash, which `threads().trash` does for a whole thread"""
+        return self.mailbox == MailBox.Trash and self.read is None
+
+
+def split_threads(
+        session: Session, msg_ids: list[str], threads: Optional[Mapping[str, str]],
+        limit: int) -> tuple[dict[str, list[str]], list[str]]:
+    """
+    Takes the threads out of `msg_ids` which have every one of their stored emails in them, when modifying them
+    by thread takes no more calls than `batchModify`. `threads` maps the ids to the thread of the emails
+    a conversation level rule matched, the only ones whose whole thread is meant to change.
+    Returns the ids by thread and the ids left to `batchModify`
+    """
+    threads = threads or {}
+    by_thread: dict[str, list[str]] = defaultdict(list)
+    for msg_id in msg_ids:
+        if msg_id in threads:
+            by_thread[threads[msg_id]].append(msg_id)
+    if not by_thread:
+        return {}, msg_ids
+
+    stored = dict(session.execute(
+        select(Email.thread_id, func.count()).where(Email.thread_id.in_(by_thread)).group_by(Email.thread_id)
+    ).all())
+    whole_threads = {thread_id: ids for thread_id, ids in by_thread.items() if stored.get(thread_id) == len(ids)}
+    rest = [msg_id for msg_id in msg_ids if threads.get(msg_id) not in whole_threads]
+
+    if len(whole_threads) + batch_modify_calls(len(rest), limit) > batch_modify_calls(len(msg_ids), limit):
+        return {}, msg_ids
+    return whole_threads, rest
+
+
+def batch_modify_calls(count: int, limit: int) -> int:
+    return -(-count // limit)
+
+
+def apply_label_changes(
+        service: GmailService, session: Session, changes: Mapping[LabelChange, list[str]],
+        threads: Optional[Mapping[str, str]] = None) -> Iterator[tuple[list[str], LabelChange, Optional[str]]]:
+    """
+    Sends every label change as `batchModify` calls of up to `batch_modify_limit` ids and
+    mirrors each successful call to the local emails with a single UPDATE.
+    Whole threads are sent with `threads().modify` or `threads().trash` instead, see `split_threads`.
+    Yields the ids of every call along with the error if the call failed
+    """
+
+    for change, msg_ids in changes.items():
+        whole_threads, msg_ids = split_threads(session, msg_ids, threads, service.batch_modify_limit)
+        for thread_id, thread_msg_ids in whole_threads.items():
+            if change.is_trash:
+                processed, error = service.trash_thread(thread_id)
+            else:
+                processed, error = service.modify_thread(thread_id, change.add_labels, change.remove_labels)
+            if processed:
+                mirror_label_change(session, thread_msg_ids, change)
+            yield thread_msg_ids, change, error
+
+        for chunk in chunked(msg_ids, service.batch_modify_limit):
+            processed, error = service.batch_modify(chunk, change.add_labels, change.remove_labels)
+            if processed:
+                mirror_label_change(session, chunk, change)
+            yield chunk, change, error
+
+
+async def apply_label_changes_async(
+        service: AsyncGmailService, session: Session, changes: Mapping[LabelChange, list[str]],
+        threads: Optional[Mapping[str, str]] = None) -> AsyncIterator[tuple[list[str], LabelChange, Optional[str]]]:
+    """`apply_label_changes` sending every call at once, yields them as they complete"""
+
+    async def modify(chunk: list[str], change: LabelChange) -> tuple[list[str], LabelChange, Optional[str]]:
+        processed, error = await service.batch_modify(chunk, change.add_labels, change.remove_labels)
+        if processed:
+            mirror_label_change(session, chunk, change)
+        return chunk, change, error
+
+    async def modify_thread(
+            thread_id: str, thread_msg_ids: list[str],
+            change: LabelChange) -> tuple[list[str], LabelChange, Optional[str]]:
+        if change.is_trash:
+            processed, error = await service.trash_thread(thread_id)
+        else:
+            processed, error = await service.modify_thread(thread_id, change.add_labels, change.remove_labels)
+        if processed:
+            mirror_label_change(session, thread_msg_ids, change)
+        return thread_msg_ids, change, error
+
+    requests = []
+    for change, msg_ids in changes.items():
+        whole_threads, msg_ids = split_threads(session, msg_ids, threads, service.batch_modify_limit)
+        requests += [modify_thread(thread_id, ids, change) for thread_id, ids in whole_threads.items()]
+        requests += [modify(chunk, change) for chunk in chunked(msg_ids, service.batch_modify_limit)]
+
+    for request in asyncio.as_completed(requests):
+        yield await request
+
+
+def mirror_label_change(session: Session, msg_ids: list[str], change: LabelChange) -> None:
+    """Applies a successful label change to the local emails with a single UPDATE, and to their labels"""
+    if change.column_values:
+        session.execute(update(Email).where(Email.id.in_(msg_ids)).values(**change.column_values))
+    EmailLabel.bulk_remove(session, msg_ids, change.remove_labels)
+    EmailLabel.bulk_add(session, {msg_id: change.add_labels for msg_id in msg_ids})
+    session.commit()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from typing import Any, Iterable, Iterator, Mapping
+
+from email_reader.logics.filters import FilterRule, Rules
+from email_reader.logics.planner import EmailPlan, RulePlanner
+
+EMAIL_COLUMNS = ('id', 'thread_id', 'from_email', 'date', 'mailbox', 'read')
+
+
+class IngestRuleEvaluator:
+    """
+    Evaluates the rules on every email as the loader writes it, so the actions for new emails are
+    planned in the same pass instead of querying the database afterwards
+
+    Rules with a relative date (e.g. older than 7 days) can start matching a stored email just by time
+    passing, they are left in `scanned_rules` to be run against the database as before. So are the rules
+    filtering on the body when the emails are loaded `without_bodies`, their bodies are fetched first,
+    the conversation level rules, which depend on the other emails of the thread, and the rules on labels,
+    whose names are resolved by the label table
+    """
+
+    def __init__(self, rules: Rules, without_bodies: bool = False) -> None:
+        def is_scanned(rule: FilterRule) -> bool:
+            conditions = rule.conditions
+            return (
+                conditions.is_time_dependent or conditions.is_thread_scoped or rule.uses_labels
+                or (without_bodies and conditions.uses_body)
+            )
+
+        self.rules = [rule for rule in rules.rules if not is_scanned(rule)]
+        self.scanned_rules = [rule for rule in rules.rules if is_scanned(rule)]
+        self.planner = RulePlanner(Rules(rules=self.rules))
+        self._predicates = [rule.conditions.get_predicate() for rule in self.rules]
+        self._matches: dict[str, tuple[dict[str, Any], list[int]]] = {}
+
+    def __call__(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        for row in rows:
+            matched = [index for index, predicate in enumerate(self._predicates) if predicate(row)]
+            if matched:
+                self._matches[row['id']] = ({column: row[column] for column in EMAIL_COLUMNS}, matched)
+            else:
+                # The email may have been loaded again in the same run and no longer match
+                self._matches.pop(row['id'], None)
+
+    @property
+    def match_count(self) -> int:
+        return len(self._matches)
+
+    def matches(self) -> Iterator[tuple[dict[str, Any], list[int]]]:
+        """Emails which matched any of the rules, along with the indices of the rules they matched"""
+        yield from self._matches.values()
+
+    def plans(self) -> Iterator[EmailPlan]:
+        for email, matched in self.matches():
+            yield self.planner.plan_email(email, matched)
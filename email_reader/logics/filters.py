@@ -1,31 +1,68 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
+import operator
+import re
 from enum import Enum
 from pathlib import Path
-from typing import Literal, Optional, Type, cast
+from typing import Any, Callable, Iterable, Literal, Mapping, Optional, Type, cast
 
 from dateutil.relativedelta import relativedelta
 from pydantic import BaseModel, model_validator
+from sqlalchemy import and_, or_, select, true
 from sqlalchemy.types import DateTime, String
 
 from email_reader.database.base import Base
+from email_reader.database.search import can_search, match_statement, search_fragment
+from email_reader.database.tables import EmailLabel, Label
 from email_reader.database.tables.email import Email, MailBox
-from email_reader.services.gmail import EmailAction, GmailService
+from email_reader.logics.actions import LabelChange
+from email_reader.services.gmail import EmailAction
+
+# Labels standing for the folder or the read state, changed by the other actions
+RESERVED_LABELS = {mailbox.value for mailbox in MailBox} | {'UNREAD'}
 
 
 class StringFilters(Enum):
     Contains = "contains"
     DoesNotContain = "does_not_contain"
     Equals = "__eq__"
-    DoesNotEqual = "__neq__"
+    DoesNotEqual = "__ne__"
 
     def get_statement(self, model: Type[Base], field_name: str, field_value: str):
+        is_containment = self in (StringFilters.Contains, StringFilters.DoesNotContain)
+        if is_containment and model is Email and can_search(field_name, field_value):
+            # Served by the full text index instead of scanning every row with LIKE
+            matches = match_statement(field_name, field_value)
+            return matches if self == StringFilters.Contains else and_(has_value(field_name), ~matches)
+
         field = getattr(model, field_name)
+        fragment = search_fragment(field_name, field_value) if is_containment and model is Email else None
+        if fragment is not None:
+            # Only the emails the index finds are compared with LIKE, which decompresses their body
+            matches = match_statement(field_name, fragment)
+            if self == StringFilters.Contains:
+                return and_(matches, field.contains(field_value))
+            return and_(has_value(field_name), or_(~matches, ~field.contains(field_value)))
+
         if self == StringFilters.DoesNotContain:
             return ~field.contains(field_value)
         return getattr(field, self.value)(field_value)
 
+    def get_predicate(self, field_value: str) -> Callable[[Optional[str]], bool]:
+        """
+        Python equivalent of `get_statement` on SQLite, where LIKE is case insensitive for ASCII only
+        and `%`/`_` in the value are wildcards. A NULL column never matches, negated or not
+        """
+        if self in (StringFilters.Contains, StringFilters.DoesNotContain):
+            pattern = like_to_regex(field_value)
+            negate = self == StringFilters.DoesNotContain
+            return lambda value: value is not None and (pattern.search(value) is None) == negate
+
+        compare = getattr(operator, self.value.strip('_'))
+        return lambda value: value is not None and compare(value, field_value)
+
 
 class DatetimeFilters(Enum):
     GreaterThan = "__gt__"
@@ -35,9 +72,21 @@ class DatetimeFilters(Enum):
         field = getattr(model, field_name)
         return getattr(field, self.value)(self.field_value_parser(field_value))
 
+    def get_predicate(self, field_value: str) -> Callable[[Optional[datetime.datetime]], bool]:
+        compare = getattr(operator, self.value.strip('_'))
+        dt = self.field_value_parser(field_value)
+        return lambda value: value is not None and compare(value, dt)
+
+    @classmethod
+    def is_relative(cls, field_value: str) -> bool:
+        """Relative values move with the current time, so a stored email can start matching without changing"""
+        return field_value.endswith(('d', 'days', 'm', 'months'))
+
     @classmethod
     def field_value_parser(cls, field_value: str) -> datetime.datetime:
-        now = datetime.datetime.now()
+        # Email dates are stored as naive UTC
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        dt = None
 
         if field_value.endswith('d') or field_value.endswith('days'):
             dt = now - relativedelta(days=int(field_value.split('d')[0].strip()))
@@ -45,7 +94,7 @@ class DatetimeFilters(Enum):
             dt = now - relativedelta(months=int(field_value.split('m')[0].strip()))
         else:
             try:
-                dt = datetime.datetime.strptime("%Y-%m-%dT%H:%M:%S", field_value)
+                dt = datetime.datetime.strptime(field_value, "%Y-%m-%dT%H:%M:%S")
             except ValueError:
                 pass
 
@@ -63,17 +112,66 @@ class DatetimeFilters(Enum):
         return dt
 
 
+class LabelFilters(Enum):
+    """Predicates of the `labels` field, the value is the name or the id of a Gmail label"""
+
+    Contains = "contains_label"
+    DoesNotContain = "does_not_contain_label"
+
+    def get_statement(self, model: Type[Base], field_name: str, field_value: str):
+        # Both subqueries are index lookups, the email table is only read for the emails carrying the label
+        label_ids = select(Label.id).where(or_(Label.id == field_value, Label.name == field_value))
+        labelled = model.id.in_(select(EmailLabel.email_id).where(EmailLabel.label_id.in_(label_ids)))  # type: ignore
+        return labelled if self == LabelFilters.Contains else ~labelled
+
+    def get_predicate(
+            self, field_value: str,
+            label_ids: Optional[Mapping[str, str]] = None) -> Callable[[Optional[Iterable[str]]], bool]:
+        """
+        Python equivalent of `get_statement` over the label ids of an email, `label_ids` resolves the label names
+        like the label table does, see `Label.get_ids`, without it the value is taken as a label id
+        """
+        label_id = label_ids.get(field_value) if label_ids is not None else field_value
+        if self == LabelFilters.Contains:
+            return lambda labels: label_id in (labels or ())
+        return lambda labels: label_id not in (labels or ())
+
+
+def has_value(field_name: str):
+    """Whether the email has a value for `field_name`, a missing one matches no filter as `NOT LIKE` is NULL on it"""
+    if field_name == 'body':
+        # Without decompressing the body
+        return Email.stored_body.has()
+    return getattr(Email, field_name).is_not(None)
+
+
+def like_to_regex(value: str) -> re.Pattern:
+    """Regex matching the same strings as SQLite's `LIKE '%value%'`"""
+    pattern = ''.join(
+        '.*' if char == '%' else '.' if char == '_' else re.escape(char) for char in value
+    )
+    return re.compile(pattern, re.ASCII | re.IGNORECASE | re.DOTALL)
+
+
 class FilterCondition(BaseModel):
 
     class Rule(BaseModel):
         field: str
-        predicate: StringFilters | DatetimeFilters
+        predicate: StringFilters | DatetimeFilters | LabelFilters
         value: str
 
         @model_validator(mode='before')
         def parse_rule(cls, data: dict) -> dict:
             field_name = data['field']
             filter_string = data['predicate']
+            if field_name == 'labels':
+                try:
+                    data['predicate'] = LabelFilters[filter_string]
+                except KeyError:
+                    avalable_filters = " or ".join([f"'{f.name}'" for f in LabelFilters])
+                    raise ValueError(f"Filter Condition {filter_string} not support for Labels, Use {avalable_filters}")
+                return data
+
             from email_reader.database.tables.email import Email
             field = getattr(Email, field_name)
             if isinstance(field.type, String):
@@ -86,8 +184,6 @@ class FilterCondition(BaseModel):
                         f"Filter Condition {filter_string} not support for String, Use {avalable_filters}"
                     )
 
-                DatetimeFilters.field_value_parser(data['value'])
-
             elif isinstance(field.type, DateTime):
                 try:
                     data['predicate'] = DatetimeFilters[filter_string]
@@ -97,6 +193,8 @@ class FilterCondition(BaseModel):
                     raise ValueError(
                         f"Filter Condition {filter_string} not support for DateTime, Use {avalable_filters}"
                     )
+
+                DatetimeFilters.field_value_parser(data['value'])
             else:
                 raise ValueError("Only String Fields and DateTime Fields are Supported in Filters")
 
@@ -105,13 +203,83 @@ class FilterCondition(BaseModel):
         def get_statement(self):
             return self.predicate.get_statement(Email, self.field, self.value)
 
+        def get_predicate(self, label_ids: Optional[Mapping[str, str]] = None) -> Callable[[Mapping[str, Any]], bool]:
+            if isinstance(self.predicate, LabelFilters):
+                # Emails carry their labels as `label_ids`, see `Email.row_from_headers`
+                label_predicate = self.predicate.get_predicate(self.value, label_ids)
+                return lambda email: label_predicate(email.get('label_ids'))
+
+            field_predicate = self.predicate.get_predicate(self.value)
+            return lambda email: field_predicate(email.get(self.field))
+
+        @property
+        def is_time_dependent(self) -> bool:
+            return isinstance(self.predicate, DatetimeFilters) and DatetimeFilters.is_relative(self.value)
+
+        @property
+        def uses_body(self) -> bool:
+            return self.field == 'body'
+
+        @property
+        def uses_labels(self) -> bool:
+            return self.field == 'labels'
+
     operator: Literal['ANY', "ALL"]
     rules: list[FilterCondition.Rule]
+    # With `thread` every email of a conversation matches as soon as one of its emails does
+    scope: Literal['message', 'thread'] = 'message'
+
+    def get_statement(self):
+        stmts = [r.get_statement() for r in self.rules]
+        condition = or_(*stmts) if self.operator == "ANY" else and_(*stmts)
+        if self.scope == 'thread':
+            # Not correlated, the subquery reads the email table on its own. Emails without a thread only match alone
+            matching_threads = select(Email.thread_id).where(condition, Email.thread_id.is_not(None)).correlate(None)
+            condition = or_(condition, Email.thread_id.in_(matching_threads))
+        return condition
+
+    def get_predicate(self, label_ids: Optional[Mapping[str, str]] = None) -> Callable[[Mapping[str, Any]], bool]:
+        """
+        Compiles the condition to a Python predicate over the column values of an email,
+        `label_ids` resolves the label names of the conditions on labels, see `LabelFilters.get_predicate`
+        """
+        predicates = [r.get_predicate(label_ids) for r in self.rules]
+        combine = any if self.operator == "ANY" else all
+        return lambda email: combine(predicate(email) for predicate in predicates)
+
+    @property
+    def is_time_dependent(self) -> bool:
+        return any(r.is_time_dependent for r in self.rules)
+
+    @property
+    def is_thread_scoped(self) -> bool:
+        return self.scope == 'thread'
+
+    @property
+    def uses_body(self) -> bool:
+        return any(r.uses_body for r in self.rules)
+
+    @property
+    def uses_labels(self) -> bool:
+        return any(r.uses_labels for r in self.rules)
+
+    def get_body_candidates_statement(self):
+        """
+        Emails whose body decides whether they match, None when the condition does not look at the body.
+        For ALL those matching the other rules, for ANY every email as a body rule alone can match
+        """
+        if not self.uses_body:
+            return None
+        if self.operator == "ANY":
+            return true()
+        return and_(true(), *(r.get_statement() for r in self.rules if not r.uses_body))
 
 
 class FilterAction(BaseModel):
     type: EmailAction
     folder: Optional[MailBox] = None
+    # Name or id of the Gmail label of `add_label` and `remove_label`
+    label: Optional[str] = None
 
     @model_validator(mode='after')
     def require_folder_for_move(self) -> FilterAction:
@@ -119,18 +287,56 @@ class FilterAction(BaseModel):
             raise ValueError("`folder` must be provided when `type` is MoveMessage")
         return self
 
+    @model_validator(mode='after')
+    def require_label_for_labels(self) -> FilterAction:
+        if not self.is_label_action:
+            return self
+        if self.label is None:
+            raise ValueError(f"`label` must be provided when `type` is {self.type.name}")
+        if self.label in RESERVED_LABELS:
+            raise ValueError(f"Use `move_message`, `mark_as_read` or `mark_as_unread` to Change {self.label}")
+        return self
+
+    @property
+    def is_label_action(self) -> bool:
+        return self.type in (EmailAction.AddLabel, EmailAction.RemoveLabel)
+
     def __repr__(self) -> str:
         if self.type == EmailAction.MoveMessage:
             return f"A:{self.type.name}->{self.folder}"
+        if self.is_label_action:
+            return f"A:{self.type.name}->{self.label}"
         return f"A:{self.type.name}"
 
-    def process_action(self, msg_id: str, gmail_service: GmailService) -> tuple[bool, Optional[str]]:
-        if self.type == EmailAction.MarkAsRead or self.type == EmailAction.MarkAsUnread:
-            return gmail_service.alter_email_read_state(msg_id, self.type)
+    def get_label_change(
+            self, mailbox: MailBox,
+            label_ids: Optional[Mapping[str, str]] = None) -> tuple[Optional[LabelChange], Optional[str]]:
+        """
+        Label change which applies this action to an email currently in `mailbox`,
+        no change and no error means there is nothing to do for the email.
+        `label_ids` resolves the label of the label actions, see `Label.get_ids`, without it the label is used as is
+        """
+        if self.is_label_action:
+            label_id = label_ids.get(cast(str, self.label)) if label_ids is not None else self.label
+            if label_id is None:
+                return None, "LabelNotFound"
+            if self.type == EmailAction.AddLabel:
+                return LabelChange(add_labels=(label_id,)), None
+            return LabelChange(remove_labels=(label_id,)), None
+        elif self.type == EmailAction.MarkAsRead:
+            return LabelChange(remove_labels=('UNREAD',), read=True), None
+        elif self.type == EmailAction.MarkAsUnread:
+            return LabelChange(add_labels=('UNREAD',), read=False), None
         elif self.type == EmailAction.MoveMessage:
-            return gmail_service.move_email(msg_id, cast(MailBox, self.folder))
+            folder = cast(MailBox, self.folder)
+            if mailbox == folder:
+                return None, None
+            if folder not in mailbox.get_movable_locations():
+                return None, "CannotMoveEmail"
+            remove_labels = (mailbox.value,) if mailbox.is_removable else ()
+            return LabelChange(add_labels=(folder.value,), remove_labels=remove_labels, mailbox=folder), None
         else:
-            return False, "Unsupported Action"
+            return None, "Unsupported Action"
 
 
 class FilterRule(BaseModel):
@@ -138,6 +344,23 @@ class FilterRule(BaseModel):
     conditions: FilterCondition
     actions: list[FilterAction]
 
+    @property
+    def uses_labels(self) -> bool:
+        return self.conditions.uses_labels or any(action.is_label_action for action in self.actions)
+
+    @property
+    def fingerprint(self) -> str:
+        """Changes whenever the conditions or the actions change, renaming the rule keeps it"""
+        # The fields added after the first rules were written are left out while unset,
+        # so the rules written before them keep their watermarks
+        exclude: dict[str, Any] = {
+            'actions': {index: {'label'} for index, action in enumerate(self.actions) if action.label is None}
+        }
+        if not self.conditions.is_thread_scoped:
+            exclude['conditions'] = {'scope'}
+        dump = self.model_dump_json(include={'conditions', 'actions'}, exclude=exclude)
+        return hashlib.sha256(dump.encode()).hexdigest()
+
 
 class Rules(BaseModel):
     rules: list[FilterRule]
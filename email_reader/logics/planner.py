@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence, cast
+
+from sqlalchemy import and_, case, false, func, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from email_reader.database.tables import EmailLabel
+from email_reader.database.tables.email import Email, MailBox
+from email_reader.logics.actions import LabelChange
+from email_reader.logics.filters import FilterAction, FilterRule, Rules
+from email_reader.metrics import metrics
+
+
+@dataclass
+class EmailPlan:
+    """
+    Target state of an email once the actions of every rule it matched are applied in rule order.
+    Repeated actions collapse into one and for conflicting ones the last rule wins
+    """
+
+    email: dict[str, Any]
+    rules: list[int] = field(default_factory=list)
+    # Whether a matched rule is conversation level, then every email of the thread is in the plans
+    thread_scoped: bool = False
+    read: Optional[bool] = None
+    mailbox: Optional[MailBox] = None
+    # Whether each label changed by a label action ends up on the email
+    labels: dict[str, bool] = field(default_factory=dict)
+    actions: list[FilterAction] = field(default_factory=list)
+    errors: list[tuple[FilterAction, str]] = field(default_factory=list)
+
+    @property
+    def target_mailbox(self) -> MailBox:
+        return self.mailbox if self.mailbox is not None else self.email['mailbox']
+
+    def add_action(self, action: FilterAction, label_ids: Optional[Mapping[str, str]] = None) -> None:
+        change, error = action.get_label_change(self.target_mailbox, label_ids)
+        if error is not None:
+            self.errors.append((action, error))
+            return
+
+        if change is not None:
+            if change.read is not None:
+                self.read = change.read
+            if change.mailbox is not None:
+                self.mailbox = change.mailbox
+            if action.is_label_action:
+                self.labels.update({label: True for label in change.add_labels})
+                self.labels.update({label: False for label in change.remove_labels})
+
+        if action not in self.actions:
+            self.actions.append(action)
+
+    @property
+    def label_change(self) -> Optional[LabelChange]:
+        """Label change taking the email from its current state to the target one, None when already there"""
+        add_labels: list[str] = []
+        remove_labels: list[str] = []
+        current_mailbox: MailBox = self.email['mailbox']
+        mailbox = None
+
+        if self.mailbox is not None and self.mailbox != current_mailbox:
+            mailbox = self.mailbox
+            add_labels.append(mailbox.value)
+            if current_mailbox.is_removable:
+                remove_labels.append(current_mailbox.value)
+
+        # Emails already in the target state are left out, on steady state runs that is most of them
+        read = self.read if self.read is not None and self.read != self.email['read'] else None
+        if read is True:
+            remove_labels.append('UNREAD')
+        elif read is False:
+            add_labels.append('UNREAD')
+
+        current_labels = set(self.email.get('label_ids') or ())
+        for label, present in self.labels.items():
+            if present and label not in current_labels:
+                add_labels.append(label)
+            elif not present and label in current_labels:
+                remove_labels.append(label)
+
+        if not add_labels and not remove_labels:
+            return None
+        return LabelChange(tuple(add_labels), tuple(remove_labels), mailbox=mailbox, read=read)
+
+
+class RulePlanner:
+    """
+    Compiles every rule into a single query over the email table which returns, for each email
+    matching any of the rules, a flag per rule telling whether it matched
+
+    A rule with a watermark only matches the emails loaded after it, see `RuleState`, along with the
+    emails sharing a thread with them for the conversation level rules
+    """
+
+    def __init__(
+            self, rules: Rules, watermarks: Optional[Sequence[Optional[int]]] = None,
+            label_ids: Optional[Mapping[str, str]] = None) -> None:
+        self.rules = rules.rules
+        self.watermarks = list(watermarks) if watermarks is not None else [None] * len(self.rules)
+        self.label_ids = label_ids
+
+    def get_statement(self):
+        conditions = []
+        for rule, watermark in zip(self.rules, self.watermarks):
+            condition = rule.conditions.get_statement()
+            if watermark is not None:
+                condition = and_(loaded_since(rule, watermark), condition)
+            conditions.append(condition)
+
+        rule_columns = [
+            case((condition, True), else_=False).label(f'rule_{index}') for index, condition in enumerate(conditions)
+        ]
+        columns = [Email.id, Email.thread_id, Email.from_email, Email.date, Email.mailbox, Email.read]
+        if any(action.is_label_action for rule in self.rules for action in rule.actions):
+            # The current labels, to leave out the emails which already have or lack the label
+            columns.append(
+                select(func.aggregate_strings(EmailLabel.label_id, ' ')).where(EmailLabel.email_id == Email.id)
+                .scalar_subquery().label('label_ids')
+            )
+        stmt = select(*columns, *rule_columns).where(or_(false(), *conditions))
+
+        thread_scoped = any(rule.conditions.is_thread_scoped for rule in self.rules)
+        if self.watermarks and None not in self.watermarks and not thread_scoped:
+            # Lets the database range scan the ingest_seq index instead of reading the whole table
+            stmt = stmt.where(Email.ingest_seq > min(cast(list[int], self.watermarks)))
+        return stmt
+
+    def get_missing_bodies_statement(self):
+        """
+        Ids of the emails loaded without their body which a rule filtering on the body could match,
+        None when no rule looks at the body
+        """
+        conditions = []
+        for rule, watermark in zip(self.rules, self.watermarks):
+            condition = rule.conditions.get_body_candidates_statement()
+            if condition is None:
+                continue
+            if watermark is not None:
+                condition = and_(loaded_since(rule, watermark), condition)
+            conditions.append(condition)
+
+        if not conditions:
+            return None
+        return select(Email.id).where(Email.body_fetched.is_(False), or_(*conditions))
+
+    def plan(self, session: Session) -> Iterator[EmailPlan]:
+        for email, matched in self.matches(session):
+            yield self.plan_email(email, matched)
+
+    def matches(self, session: Session) -> Iterator[tuple[dict[str, Any], list[int]]]:
+        """Emails matching any of the rules, along with the indices of the rules they match"""
+        if not self.rules:
+            return
+
+        started = time.perf_counter()
+        rows = session.execute(self.get_statement()).mappings().all()
+        metrics.observe('rule_query_seconds', time.perf_counter() - started)
+
+        for row in rows:
+            matched = [index for index in range(len(self.rules)) if row[f'rule_{index}']]
+            email = {column: row[column] for column in ('id', 'thread_id', 'from_email', 'date', 'mailbox', 'read')}
+            email['label_ids'] = (row.get('label_ids') or '').split()
+            yield email, matched
+
+    def plan_email(self, email: dict[str, Any], matched_rules: Iterable[int]) -> EmailPlan:
+        plan = EmailPlan(email=email, rules=sorted(matched_rules))
+        plan.thread_scoped = any(self.rules[index].conditions.is_thread_scoped for index in plan.rules)
+        for index in plan.rules:
+            metrics.inc('rule_matches_total', rule=self.rules[index].name)
+            for action in self.rules[index].actions:
+                plan.add_action(action, self.label_ids)
+        return plan
+
+
+def loaded_since(rule: FilterRule, watermark: int):
+    """
+    Emails loaded after the watermark. For a conversation level rule also the older emails of their threads,
+    a new reply can make the whole thread match
+    """
+    condition = Email.ingest_seq > watermark
+    if not rule.conditions.is_thread_scoped:
+        return condition
+
+    threads = aliased(Email)
+    updated_threads = select(threads.thread_id).where(threads.ingest_seq > watermark, threads.thread_id.is_not(None))
+    return or_(condition, Email.thread_id.in_(updated_threads))
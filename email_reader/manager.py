@@ -1,71 +1,496 @@
 from __future__ import annotations
 
+from collections import defaultdict
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Union, cast
 
-from sqlalchemy import and_, or_, select
+from sqlalchemy.orm import Session
 
 from email_reader.console import console
-from email_reader.logics.filters import Rules
-from email_reader.database.tables.email import Email
+from email_reader.logics.actions import LabelChange, apply_label_changes, apply_label_changes_async
+from email_reader.logics.evaluator import IngestRuleEvaluator
+from email_reader.logics.filters import FilterAction, FilterRule, Rules
+from email_reader.logics.planner import EmailPlan, RulePlanner
 from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Label, RuleState, SyncState
+from email_reader.metrics import metrics
 from email_reader.services.gmail import GmailService
 
+if TYPE_CHECKING:
+    from argparse import Namespace
 
-def process_emails(service: GmailService, rules_filepath: Path) -> None:
+    from email_reader.accounts import Account
+    from email_reader.services.async_gmail import AsyncGmailService
 
-    rules = Rules.from_file(file=rules_filepath)
-    failed_actions = []
-    succeded_actions = []
+
+@dataclass
+class ActionReport:
+    succeded_actions: list[tuple[str, FilterAction]] = field(default_factory=list)
+    failed_actions: list[tuple[str, FilterAction, Optional[str]]] = field(default_factory=list)
+    unchanged_actions: list[tuple[str, FilterAction]] = field(default_factory=list)
+
+    def print(self) -> None:
+        for email_string, action, error in self.failed_actions:
+            console.print(f'[red] Failed to Process Email {email_string}[/] {action=} {error=}')
+        for email_string, action in self.succeded_actions:
+            console.print(f'[green] Succeded in Email {email_string} {action=}')
+        if self.unchanged_actions:
+            console.print(f'{len(self.unchanged_actions)} Actions Skipped as the Emails Were Already Up To Date')
+
+
+@metrics.timed('stage_seconds', stage='process')
+def process_emails(
+        service: GmailService, rules_filepath: Optional[Path] = None, rules: Optional[Rules] = None,
+        use_watermarks: bool = True, dry_run: bool = False, evaluator: Optional[IngestRuleEvaluator] = None,
+        previous_ingest_seq: Optional[int] = None) -> None:
+    """
+    Runs the rules against the email table in a single query and applies the planned actions
+
+    Each rule only looks at the emails loaded since it last ran successfully, rules which are up to date
+    are skipped and the query is not run at all when every rule is. Rules with relative dates, and every rule
+    when `use_watermarks` is False, look at the whole table
+
+    The matches of the `evaluator` which ran during the load that followed `previous_ingest_seq` are merged in,
+    its rules which were up to date before that load are left out of the query, see `plan_rules`
+
+    With `dry_run` the plan is printed instead of being applied and the watermarks are left alone
+    """
+
+    if rules is None:
+        rules = Rules.from_file(file=rules_filepath)  # type: ignore[arg-type]
+    report = ActionReport()
 
     with SessionFactory() as session:
-        for rule in rules.rules:
-            stmts = [r.get_statement() for r in rule.conditions.rules]
-            query = or_(*stmts) if rule.conditions.operator == "ANY" else and_(*stmts)
-            stmt = select(Email.id, Email.from_email, Email.date).where(query)
-            emails = session.execute(stmt).mappings().all()
-
-            for email in emails:
-                for action in rule.actions:
-                    action_processed, error = action.process_action(email['id'], service)
-                    email_string = (
-                        f"{email['id']}: From: {email['from_email']}, "
-                        f"Date:{email['date']:%Y-%m-%d %H:%m}"
-                    )
-                    if action_processed:
-                        succeded_actions.append((email_string, action))
-                    else:
-                        failed_actions.append((email_string, action, error))
-
-    for email_string, action, error in failed_actions:
-        console.print(f'[red] Failed to Process Email {email_string}[/] {action=} {error=}')
-    for email_string, action in succeded_actions:
-        console.print(f'[green] Succeded in Email {email_string} {action=}')
+        ingest_seq = SyncState.get_ingest_seq(session)
+        evaluated = get_evaluated_rules(session, evaluator, previous_ingest_seq)
+        pending = get_pending_rules(session, rules, ingest_seq, use_watermarks, evaluated)
+
+        if pending:
+            if any(rule.uses_labels for rule, _ in pending):
+                Label.sync(session, service.list_labels())
+
+            msg_ids = get_missing_bodies(session, pending)
+            if msg_ids:
+                from email_reader.loader import load_bodies
+
+                load_bodies(service, session, msg_ids)
+
+        if pending or evaluated:
+            plans = plan_rules(session, rules, pending, evaluator if evaluated else None)
+            if dry_run:
+                print_plans(service, plans)
+                return
+
+            failed_rules = execute_plans(service, session, plans, report)
+            set_rule_watermarks(session, get_processed_rules(rules, pending, evaluated, failed_rules), ingest_seq)
+            session.commit()
+
+    report.print()
+
+
+@metrics.timed('stage_seconds', stage='process')
+async def process_emails_async(
+        service: AsyncGmailService, rules_filepath: Optional[Path] = None, rules: Optional[Rules] = None,
+        use_watermarks: bool = True, dry_run: bool = False, evaluator: Optional[IngestRuleEvaluator] = None,
+        previous_ingest_seq: Optional[int] = None) -> None:
+    """`process_emails` for an `AsyncGmailService`, the `batchModify` calls of the plan are sent concurrently"""
+
+    if rules is None:
+        rules = Rules.from_file(file=rules_filepath)  # type: ignore[arg-type]
+    report = ActionReport()
+
+    with SessionFactory() as session:
+        ingest_seq = SyncState.get_ingest_seq(session)
+        evaluated = get_evaluated_rules(session, evaluator, previous_ingest_seq)
+        pending = get_pending_rules(session, rules, ingest_seq, use_watermarks, evaluated)
+
+        if pending:
+            if any(rule.uses_labels for rule, _ in pending):
+                Label.sync(session, await service.list_labels())
+
+            msg_ids = get_missing_bodies(session, pending)
+            if msg_ids:
+                from email_reader.loader import load_bodies_async
+
+                await load_bodies_async(service, session, msg_ids)
+
+        if pending or evaluated:
+            plans = plan_rules(session, rules, pending, evaluator if evaluated else None)
+            if dry_run:
+                print_plans(service, plans)
+                return
+
+            failed_rules = await execute_plans_async(service, session, plans, report)
+            set_rule_watermarks(session, get_processed_rules(rules, pending, evaluated, failed_rules), ingest_seq)
+            session.commit()
+
+    report.print()
+
+
+def get_pending_rules(
+        session: Session, rules: Rules, ingest_seq: int, use_watermarks: bool = True,
+        evaluated: Optional[list[FilterRule]] = None) -> list[tuple[FilterRule, Optional[int]]]:
+    """Rules which have not processed every email yet, along with their watermark, other than the `evaluated` ones"""
+    watermarks = get_rule_watermarks(session, rules.rules) if use_watermarks else {}
+    evaluated_ids = {id(rule) for rule in evaluated or ()}
+    return [
+        (rule, watermarks.get(index)) for index, rule in enumerate(rules.rules)
+        if (watermarks.get(index) is None or cast(int, watermarks.get(index)) < ingest_seq)
+        and id(rule) not in evaluated_ids
+    ]
+
+
+def get_evaluated_rules(
+        session: Session, evaluator: Optional[IngestRuleEvaluator],
+        previous_ingest_seq: Optional[int]) -> list[FilterRule]:
+    """Rules of the evaluator which were up to date before the load, it saw every email they have not processed"""
+    if evaluator is None or previous_ingest_seq is None:
+        return []
+    watermarks = get_rule_watermarks(session, evaluator.rules)
+    return [rule for index, rule in enumerate(evaluator.rules) if watermarks.get(index) == previous_ingest_seq]
+
+
+def plan_rules(
+        session: Session, rules: Rules, pending: list[tuple[FilterRule, Optional[int]]],
+        evaluator: Optional[IngestRuleEvaluator] = None) -> list[EmailPlan]:
+    """
+    One plan per email with every rule it matched, in the query over the `pending` rules or in the `evaluator`
+    while loading, so that the actions apply in rule order and the last rule wins whichever of them matched
+    """
+    positions = {id(rule): index for index, rule in enumerate(rules.rules)}
+    emails: dict[str, dict[str, Any]] = {}
+    matched: dict[str, set[int]] = defaultdict(set)
+
+    def add_matches(source_rules: list[FilterRule], matches) -> None:
+        for email, indices in matches:
+            # The query runs after the load, its copy of the email is the current one
+            emails[email['id']] = email
+            matched[email['id']].update(positions[id(source_rules[index])] for index in indices)
+
+    if evaluator is not None:
+        add_matches(evaluator.rules, evaluator.matches())
+    if pending:
+        planner = RulePlanner(Rules(rules=[rule for rule, _ in pending]), [watermark for _, watermark in pending])
+        add_matches(planner.rules, planner.matches(session))
+
+    label_ids = Label.get_ids(session) if any(rule.uses_labels for rule, _ in pending) else None
+    planner = RulePlanner(rules, label_ids=label_ids)
+    return [planner.plan_email(email, matched[msg_id]) for msg_id, email in emails.items()]
+
+
+def get_processed_rules(
+        rules: Rules, pending: list[tuple[FilterRule, Optional[int]]], evaluated: list[FilterRule],
+        failed_rules: set[int]) -> list[FilterRule]:
+    """Rules which are up to date once the plans are executed, all but those which had an email fail"""
+    processed = {id(rule) for rule, _ in pending} | {id(rule) for rule in evaluated}
+    return [rule for index, rule in enumerate(rules.rules) if id(rule) in processed and index not in failed_rules]
+
+
+def get_missing_bodies(session: Session, pending: list[tuple[FilterRule, Optional[int]]]) -> list[str]:
+    """Emails loaded with `metadata_only` whose body has to be fetched before the pending rules can run"""
+    planner = RulePlanner(Rules(rules=[rule for rule, _ in pending]), [watermark for _, watermark in pending])
+    stmt = planner.get_missing_bodies_statement()
+    return list(session.scalars(stmt)) if stmt is not None else []
+
+
+def get_rule_watermarks(session: Session, rules: list[FilterRule]) -> dict[int, int]:
+    """Watermark of each rule by its index, rules with relative dates never get one"""
+    stored = RuleState.get_watermarks(session, [rule.fingerprint for rule in rules])
+    return {
+        index: stored[rule.fingerprint] for index, rule in enumerate(rules)
+        if rule.fingerprint in stored and not rule.conditions.is_time_dependent
+    }
+
+
+def set_rule_watermarks(session: Session, rules: list[FilterRule], ingest_seq: int) -> None:
+    for rule in rules:
+        if not rule.conditions.is_time_dependent:
+            RuleState.set_watermark(session, rule.fingerprint, rule.name, ingest_seq)
+
+
+def group_changes(plans: list[EmailPlan]) -> tuple[dict[LabelChange, list[str]], list[EmailPlan]]:
+    """Ids of the emails needing each label change, along with the plans of the emails already in their target state"""
+
+    changes: dict[LabelChange, list[str]] = defaultdict(list)
+    unchanged: list[EmailPlan] = []
+
+    for plan in plans:
+        change = plan.label_change
+        if change is not None:
+            changes[change].append(plan.email['id'])
+        else:
+            unchanged.append(plan)
+
+    return changes, unchanged
+
+
+def execute_plans(
+        service: GmailService, session: Session, plans: list[EmailPlan], report: ActionReport) -> set[int]:
+    """
+    Groups the emails by the label change they need and sends each group with `batchModify`, or by thread
+    for the threads a conversation level rule matched, returns the rules which had an email fail to be modified
+    """
+
+    execution = PlanExecution(plans, report)
+    for msg_ids, _, error in apply_label_changes(service, session, execution.changes, execution.threads):
+        execution.record(msg_ids, error)
+    return execution.failed_rules
+
+
+async def execute_plans_async(
+        service: AsyncGmailService, session: Session, plans: list[EmailPlan], report: ActionReport) -> set[int]:
+    execution = PlanExecution(plans, report)
+    async for msg_ids, _, error in apply_label_changes_async(service, session, execution.changes, execution.threads):
+        execution.record(msg_ids, error)
+    return execution.failed_rules
+
+
+class PlanExecution:
+    """Label changes of the plans and the outcome of their actions, as the calls complete"""
+
+    def __init__(self, plans: list[EmailPlan], report: ActionReport) -> None:
+        self.changes, unchanged = group_changes(plans)
+        self.plans_by_id = {plan.email['id']: plan for plan in plans}
+        # Emails whose whole thread a conversation level rule matched, see `split_threads`
+        self.threads = {
+            plan.email['id']: plan.email['thread_id']
+            for plan in plans if plan.thread_scoped and plan.email.get('thread_id')
+        }
+        self.report = report
+        self.failed_rules: set[int] = set()
+
+        for plan in plans:
+            for action, error in plan.errors:
+                report.failed_actions.append((get_email_string(plan.email), action, error))
+
+        for plan in unchanged:
+            for action in plan.actions:
+                report.unchanged_actions.append((get_email_string(plan.email), action))
+
+        metrics.inc('actions_total', sum(len(plan.errors) for plan in plans), result='failed')
+        metrics.inc('actions_total', sum(len(plan.actions) for plan in unchanged), result='unchanged')
+
+    def record(self, msg_ids: list[str], error: Optional[str]) -> None:
+        actions = sum(len(self.plans_by_id[msg_id].actions) for msg_id in msg_ids)
+        metrics.inc('actions_total', actions, result='failed' if error is not None else 'succeeded')
+
+        for msg_id in msg_ids:
+            plan = self.plans_by_id[msg_id]
+            if error is not None:
+                self.failed_rules.update(plan.rules)
+            for action in plan.actions:
+                if error is None:
+                    self.report.succeded_actions.append((get_email_string(plan.email), action))
+                else:
+                    self.report.failed_actions.append((get_email_string(plan.email), action, error))
+
+
+def print_plans(service: Union[GmailService, AsyncGmailService], plans: list[EmailPlan]) -> None:
+    """Prints the label changes the plans would make without calling the API or touching the database"""
+
+    from rich.table import Table
+
+    changes, unchanged = group_changes(plans)
+
+    table = Table(title='Planned Changes')
+    table.add_column('Add Labels')
+    table.add_column('Remove Labels')
+    table.add_column('Emails', justify='right')
+    table.add_column('API Calls', justify='right')
+
+    api_calls = 0
+    for change, msg_ids in changes.items():
+        calls = -(-len(msg_ids) // service.batch_modify_limit)
+        api_calls += calls
+        table.add_row(', '.join(change.add_labels), ', '.join(change.remove_labels), str(len(msg_ids)), str(calls))
+
+    console.print(table)
+
+    for plan in plans:
+        change = plan.label_change
+        if change is not None:
+            console.print(
+                f'[yellow] Would Change Email {get_email_string(plan.email)}[/] '
+                f'add={list(change.add_labels)} remove={list(change.remove_labels)}'
+            )
+        for action, error in plan.errors:
+            console.print(f'[red] Would Fail to Process Email {get_email_string(plan.email)}[/] {action=} {error=}')
+
+    console.print(
+        f'{len(plans)} Emails Matched, {len(plans) - len(unchanged)} To Change With {api_calls} API Calls, '
+        f'{len(unchanged)} Already Up To Date'
+    )
+
+
+def get_email_string(email: dict) -> str:
+    return f"{email['id']}: From: {email['from_email']}, Date:{email['date']:%Y-%m-%d %H:%M}"
 
 
 def run():
     from argparse import ArgumentParser
 
-    from email_reader.loader import load_emails
-
     parser = ArgumentParser(description='Actions To Take on Emails')
     parser.add_argument(
         '--rules', '-r',
-        help='Path for the Rules JSON File',
-        type=Path, required=True
+        help='Path for the Rules JSON File, Required Unless Every Account Has Its Own',
+        type=Path
     )
     parser.add_argument(
         '--credentials-file', '-c',
-        help='Path for the Client Secrets File Generated During Client App Creation',
-        type=Path,
-        required=True
+        help='Path for the Client Secrets File Generated During Client App Creation, Required Without --accounts',
+        type=Path
     )
     parser.add_argument('--load-emails', '-load', help='Updates Emails from Gmail', action='store_false')
+    parser.add_argument(
+        '--rescan',
+        help='Apply the Rules to Every Stored Email Instead of Only the Ones Loaded Since Each Rule Last Ran',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--dry-run',
+        help='Print the Changes the Rules Would Make Without Applying Them',
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--async',
+        help='Use Concurrent Requests on an Event Loop Instead of Threads, Needs email_reader[async]',
+        action='store_true', dest='use_async'
+    )
+
+    parser.add_argument(
+        '--metadata-only',
+        help='Load Only the Headers and Labels of the Emails, Bodies Are Fetched for the Rules Filtering on Them',
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--metrics',
+        help='Write the Metrics of the Run to This File, as JSON When It Ends With .json, Prometheus Text Otherwise',
+        type=Path
+    )
+
+    parser.add_argument(
+        '--accounts',
+        help='Path for an Accounts JSON File, Each Account Has Its Own Database and Can Have Its Own Rules',
+        type=Path
+    )
+    parser.add_argument(
+        '--parallel',
+        help='Number of Accounts Managed at the Same Time',
+        type=int, default=4
+    )
 
     args = parser.parse_args()
+    if args.accounts and args.use_async:
+        parser.error('--accounts Cannot Be Used With --async')
+    if not args.accounts and not (args.rules and args.credentials_file):
+        parser.error('--rules and --credentials-file Are Required Without --accounts')
+
+    try:
+        manage_from_args(args)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+
+
+def manage_from_args(args: Namespace) -> None:
+    if args.accounts:
+        from email_reader.accounts import Accounts
 
-    gmail_service = GmailService.create(args.credentials_file)
+        accounts = Accounts.from_file(args.accounts).accounts
+        manage_accounts(
+            accounts, args.rules, args.parallel, args.load_emails, args.rescan, args.dry_run,
+            metadata_only=args.metadata_only
+        )
+        return
+
+    rules = Rules.from_file(file=args.rules)
+
+    if args.use_async:
+        import asyncio
+
+        asyncio.run(manage_emails_async(
+            args.credentials_file, rules, args.load_emails, args.rescan, args.dry_run, args.metadata_only
+        ))
+        return
+
+    service = GmailService.create(args.credentials_file, metadata_only=args.metadata_only)
+    manage_emails(service, rules, args.load_emails, args.rescan, args.dry_run)
+
+
+def manage_emails(
+        gmail_service: GmailService, rules: Rules, load: bool = True, rescan: bool = False,
+        dry_run: bool = False) -> None:
+    from email_reader.loader import load_emails
 
-    if args.load_emails:
+    evaluator, previous_ingest_seq = None, None
+    if load and not rescan:
+        # Rules are evaluated on the new emails as they are loaded, the table is only queried
+        # for rules with relative dates and rules which are new, edited or failed last time
+        evaluator = IngestRuleEvaluator(rules, without_bodies=gmail_service.metadata_only)
+        with SessionFactory() as session:
+            previous_ingest_seq = SyncState.get_ingest_seq(session)
+        load_emails(service=gmail_service, evaluator=evaluator)
+
+    elif load:
         load_emails(service=gmail_service)
 
-    process_emails(gmail_service, args.rules)
+    process_emails(
+        gmail_service, rules=rules, use_watermarks=not rescan, dry_run=dry_run, evaluator=evaluator,
+        previous_ingest_seq=previous_ingest_seq
+    )
+
+
+def manage_accounts(
+        accounts: list[Account], rules_file: Optional[Path] = None, parallel: int = 4, load: bool = True,
+        rescan: bool = False, dry_run: bool = False, service_class: type[GmailService] = GmailService,
+        **service_kwargs) -> dict[str, Optional[Exception]]:
+    """
+    `manage_emails` for every account in its own database, `parallel` accounts at a time, with the rules
+    of the account or those of `rules_file`. Returns the exception of each account which failed
+    """
+
+    from email_reader.accounts import run_accounts
+
+    rules: dict[str, Rules] = {}
+    for account in accounts:
+        if account.rules_file is None and rules_file is None:
+            raise ValueError(f'No Rules File for Account {account.name}')
+        rules[account.name] = Rules.from_file(file=cast(Path, account.rules_file or rules_file))
+
+    # A new account opens the browser to be authorized, so the services are not created in parallel
+    services = {
+        account.name: service_class.create(account.credentials_file, account.get_token_file(), **service_kwargs)
+        for account in accounts
+    }
+
+    results = run_accounts(
+        accounts, lambda account: manage_emails(services[account.name], rules[account.name], load, rescan, dry_run),
+        parallel
+    )
+    return {name: result if isinstance(result, Exception) else None for name, result in results.items()}
+
+
+async def manage_emails_async(
+        credentials_file: Path, rules: Rules, load: bool = True, rescan: bool = False, dry_run: bool = False,
+        metadata_only: bool = False) -> None:
+    from email_reader.loader import load_emails_async
+    from email_reader.services.async_gmail import AsyncGmailService
+
+    async with AsyncGmailService.create(credentials_file, metadata_only=metadata_only) as gmail_service:
+        evaluator, previous_ingest_seq = None, None
+        if load and not rescan:
+            evaluator = IngestRuleEvaluator(rules, without_bodies=gmail_service.metadata_only)
+            with SessionFactory() as session:
+                previous_ingest_seq = SyncState.get_ingest_seq(session)
+            await load_emails_async(gmail_service, evaluator=evaluator)
+
+        elif load:
+            await load_emails_async(gmail_service)
+
+        await process_emails_async(
+            gmail_service, rules=rules, use_watermarks=not rescan, dry_run=dry_run, evaluator=evaluator,
+            previous_ingest_seq=previous_ingest_seq
+        )
@@ -0,0 +1,196 @@
+"""
+Counters and latency histograms of the loader, the rule processing and the Gmail requests
+
+Every process has a single registry, `metrics`, which the instrumented code records into. It can be written
+as a JSON summary or in the Prometheus text format, `--metrics FILE` of the commands writes it when they exit
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Iterator, Sequence, TypeVar
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+PREFIX = 'email_reader_'
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'gmail_requests_total': 'Gmail API requests, every message of a batch counts as one',
+    'gmail_request_seconds': 'Latency of the Gmail API round trips, a batch is a single round trip',
+    'gmail_request_errors_total': 'Failed Gmail API requests, by HTTP status or exception type',
+    'gmail_fetched_bytes_total': 'Bytes of the raw messages fetched from Gmail',
+    'emails_parsed_total': 'Emails parsed from their raw message',
+    'email_parse_seconds_total': 'Time spent parsing emails, summed over the parsing processes',
+    'emails_written_total': 'Emails upserted into the database',
+    'db_write_seconds': 'Time to upsert and commit a chunk of emails',
+    'rule_matches_total': 'Emails matched by each rule',
+    'rule_query_seconds': 'Time to run the rule query over the email table',
+    'actions_total': 'Rule actions by result, unchanged actions had nothing to do',
+    'stage_seconds': 'Time spent in each stage of the loader and the manager',
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+@dataclass
+class Histogram:
+    buckets: Sequence[float] = DEFAULT_BUCKETS
+    counts: list[int] = field(init=False)
+    count: int = 0
+    sum: float = 0.0
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the quantile, the largest bucket when it is past the last one"""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Thread safe registry of counters and histograms keyed by name and labels"""
+
+    def __init__(self) -> None:
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels: dict[str, Any]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = self._labels(labels)
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._labels(labels)
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def value(self, name: str, **labels: Any) -> float:
+        return self.counters.get(name, {}).get(self._labels(labels), 0)
+
+    def histogram(self, name: str, **labels: Any) -> Histogram:
+        return self.histograms.get(name, {}).get(self._labels(labels)) or Histogram()
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name: str, **labels: Any) -> Callable[[F], F]:
+        """Decorator observing the duration of every call of a function or coroutine function"""
+
+        def decorator(function: F) -> F:
+            if asyncio.iscoroutinefunction(function):
+                @wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name, **labels):
+                        return await function(*args, **kwargs)
+                return async_wrapper  # type: ignore[return-value]
+
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            return wrapper  # type: ignore[return-value]
+
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_json(self) -> dict[str, Any]:
+        with self._lock:
+            counters = {
+                name: [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+                for name, series in self.counters.items()
+            }
+            histograms = {
+                name: [
+                    {
+                        'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                        'mean': histogram.sum / histogram.count if histogram.count else 0.0,
+                        'p50': histogram.quantile(0.5), 'p99': histogram.quantile(0.99),
+                    }
+                    for labels, histogram in series.items()
+                ]
+                for name, series in self.histograms.items()
+            }
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self) -> str:
+        lines: list[str] = []
+
+        def header(name: str, kind: str) -> None:
+            if name in HELP:
+                lines.append(f'# HELP {PREFIX}{name} {HELP[name]}')
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                header(name, 'counter')
+                for labels, value in series.items():
+                    lines.append(f'{PREFIX}{name}{format_labels(labels)} {value:g}')
+
+            for name, histograms in sorted(self.histograms.items()):
+                header(name, 'histogram')
+                for labels, histogram in histograms.items():
+                    cumulative = 0
+                    for bound, count in zip([*histogram.buckets, float('inf')], histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                        lines.append(f'{PREFIX}{name}_bucket{format_labels((*labels, ("le", le)))} {cumulative}')
+                    lines.append(f'{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum:g}')
+                    lines.append(f'{PREFIX}{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: Path) -> None:
+        """Writes a JSON summary when `path` ends with .json, the Prometheus text format otherwise"""
+        if path.suffix == '.json':
+            path.write_text(json.dumps(self.to_json(), indent=2))
+        else:
+            path.write_text(self.to_prometheus())
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')) for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+metrics = Metrics()
@@ -0,0 +1,410 @@
+"""
+Asyncio variant of `GmailService`, calling the Gmail REST API with httpx
+
+A single event loop keeps up to `concurrency` requests in flight, each message is fetched with its own
+request instead of a batch, so there is no thread or httplib2 connection per request. Needs the `async` extra
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import time
+from collections import deque
+from json import loads
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, ClassVar, Deque, Iterable, Mapping, Optional, Union
+
+import httplib2
+import httpx
+from googleapiclient.errors import HttpError
+from sqlalchemy import select, update
+
+from email_reader.console import console
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables.email import Email, MailBox
+from email_reader.metrics import metrics
+from email_reader.services.gauth import GoogleAuth
+from email_reader.services.gmail import (
+    EmailAction, GmailService, HistoryChanges, HistoryExpiredError, MockGmailService, PageTokenExpiredError,
+    after_query
+)
+from email_reader.services.parser import (
+    METADATA_HEADERS, RawMessage, parse_message_row, parse_metadata_row, record_parse, resource_size
+)
+from email_reader.services.ratelimit import USER_QUOTA_PER_SECOND, AsyncRequestScheduler, is_retryable
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me/'
+
+
+class AsyncGmailService:
+    batch_modify_limit: ClassVar[int] = GmailService.batch_modify_limit
+
+    def __init__(
+            self, auth: Optional[GoogleAuth], concurrency: int = 100,
+            units_per_second: Optional[float] = USER_QUOTA_PER_SECOND,
+            client: Optional[httpx.AsyncClient] = None, metadata_only: bool = False) -> None:
+
+        self._credentials = auth.credentials if auth is not None else None
+        self._client = client or httpx.AsyncClient(
+            base_url=GMAIL_API_URL, timeout=60, limits=httpx.Limits(max_connections=concurrency)
+        )
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self.concurrency = concurrency
+        self.metadata_only = metadata_only
+        self.scheduler = AsyncRequestScheduler(units_per_second=units_per_second, concurrency=concurrency)
+        # Messages skipped as they could not be fetched, see `BatchFetcher`
+        self.failed_ids: dict[str, str] = {}
+        self.unfetched_ids: dict[str, str] = {}
+
+    @classmethod
+    def create(cls, credentials_file: Optional[Path], token_file: Optional[Path] = None, **kwargs):
+        return AsyncGmailService(GoogleAuth(credentials_file, token_file), **kwargs)
+
+    async def __aenter__(self) -> AsyncGmailService:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    async def _headers(self) -> dict[str, str]:
+        if self._credentials is None:
+            return {}
+
+        if not self._credentials.valid:
+            if self._refresh_lock is None:
+                self._refresh_lock = asyncio.Lock()
+            async with self._refresh_lock:
+                if not self._credentials.valid:
+                    from google.auth.transport.requests import Request
+                    await asyncio.to_thread(self._credentials.refresh, Request())
+
+        return {'Authorization': f'Bearer {self._credentials.token}'}
+
+    async def _request(
+            self, method: str, http_method: str, path: str,
+            params: Optional[Mapping[str, Any]] = None, json: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        """Sends the request through the scheduler, failures are raised as `HttpError` like the sync service"""
+
+        async def send() -> dict[str, Any]:
+            try:
+                response = await self._client.request(
+                    http_method, path, params=params, json=json, headers=await self._headers()
+                )
+            except httpx.TransportError as e:
+                raise ConnectionError(str(e)) from e
+
+            if response.status_code >= 400:
+                raise HttpError(httplib2.Response({'status': response.status_code}), response.content, uri=path)
+            return response.json() if response.content else {}
+
+        return await self.scheduler.async_call(method, send)
+
+    async def list_message_ids(self, query: Optional[str] = None, page_size: int = 500) -> AsyncIterator[str]:
+        async for _, msg_ids in self.list_message_pages(query, page_size=page_size):
+            for msg_id in msg_ids:
+                yield msg_id
+
+    async def list_message_pages(
+            self, query: Optional[str] = None, page_token: Optional[str] = None,
+            page_size: int = 500) -> AsyncIterator[tuple[Optional[str], list[str]]]:
+        params: dict[str, Any] = {'maxResults': page_size}
+        if query:
+            params['q'] = query
+        if page_token:
+            params['pageToken'] = page_token
+
+        while True:
+            try:
+                results = await self._request('messages.list', 'GET', 'messages', params=params)
+            except HttpError as e:
+                if e.status_code == 400 and page_token and params.get('pageToken') == page_token:
+                    raise PageTokenExpiredError(f'Page token {page_token} is no longer valid') from e
+                raise
+            yield params.get('pageToken'), [msg['id'] for msg in results.get('messages', [])]
+
+            next_page_token = results.get('nextPageToken')
+            if not next_page_token:
+                break
+            params['pageToken'] = next_page_token
+
+    async def get_emails(self, after: Optional[datetime.datetime] = None) -> AsyncIterator[Email]:
+        async for row in self.get_email_rows(after):
+            yield Email(**row)
+
+    async def get_email_rows(self, after: Optional[datetime.datetime] = None) -> AsyncIterator[dict[str, Any]]:
+        async for row in self.get_email_rows_by_ids(self.list_message_ids(after_query(after))):
+            yield row
+
+    def clear_unfetched_ids(self) -> None:
+        self.unfetched_ids.clear()
+
+    async def get_email_rows_by_ids(
+            self, msg_ids: Union[Iterable[str], AsyncIterable[str]]) -> AsyncIterator[dict[str, Any]]:
+        """
+        Yields the rows in the order of `msg_ids`, keeping up to `concurrency` messages in flight.
+        Messages which could not be fetched are skipped and recorded in `failed_ids`, or in `unfetched_ids`
+        when they still failed with a retryable error after the retries of the scheduler.
+        With `metadata_only` only the headers and labels are fetched, the rows have no body
+        """
+        async for row in self._get_rows(msg_ids, self.metadata_only):
+            yield row
+
+    async def get_body_rows(
+            self, msg_ids: Union[Iterable[str], AsyncIterable[str]]) -> AsyncIterator[dict[str, Any]]:
+        """Rows of the whole messages, bodies included, whether the service is `metadata_only` or not"""
+        async for row in self._get_rows(msg_ids, False):
+            yield row
+
+    async def _get_rows(
+            self, msg_ids: Union[Iterable[str], AsyncIterable[str]], metadata: bool) -> AsyncIterator[dict[str, Any]]:
+        pending: Deque[asyncio.Task[Optional[dict[str, Any]]]] = deque()
+        try:
+            async for msg_id in iterate(msg_ids):
+                if len(pending) >= self.concurrency:
+                    row = await pending.popleft()
+                    if row is not None:
+                        yield row
+                pending.append(asyncio.create_task(self._get_email_row(msg_id, metadata)))
+
+            while pending:
+                row = await pending.popleft()
+                if row is not None:
+                    yield row
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _get_email_row(self, msg_id: str, metadata: bool = False) -> Optional[dict[str, Any]]:
+        params: dict[str, Any] = {'format': 'raw'}
+        if metadata:
+            params = {'format': 'metadata', 'metadataHeaders': list(METADATA_HEADERS)}
+
+        try:
+            full_message = await self._request('messages.get', 'GET', f'messages/{msg_id}', params=params)
+        except (HttpError, OSError) as e:
+            console.log(f"[red] Failed to Fetch Email {msg_id=} {e} [/red]")
+            (self.unfetched_ids if is_retryable(e) else self.failed_ids)[msg_id] = str(e)
+            return None
+
+        metrics.inc('gmail_fetched_bytes_total', resource_size(full_message))
+        started = time.perf_counter()
+        if metadata:
+            row = parse_metadata_row(full_message)
+        else:
+            row = parse_message_row(RawMessage.from_resource(full_message))
+        record_parse(1, time.perf_counter() - started)
+        return row
+
+    async def get_email(self, msg_id: str) -> Email:
+        full_message = await self._request('messages.get', 'GET', f'messages/{msg_id}', params={'format': 'raw'})
+        return Email(**parse_message_row(RawMessage.from_resource(full_message)))
+
+    async def list_labels(self) -> list[dict[str, Any]]:
+        return (await self._request('labels.list', 'GET', 'labels')).get('labels', [])
+
+    async def get_history_id(self) -> str:
+        return (await self._request('getProfile', 'GET', 'profile'))['historyId']
+
+    async def get_history_changes(self, start_history_id: str) -> HistoryChanges:
+        params: dict[str, Any] = {
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            'maxResults': 500,
+        }
+        changes = HistoryChanges(history_id=start_history_id)
+
+        while True:
+            try:
+                results = await self._request('history.list', 'GET', 'history', params=params)
+            except HttpError as e:
+                if e.status_code == 404:
+                    raise HistoryExpiredError(f'History {start_history_id} is no longer available') from e
+                raise
+
+            for record in results.get('history', []):
+                changes.add_record(record)
+            changes.history_id = results.get('historyId', changes.history_id)
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+            params['pageToken'] = page_token
+
+        return changes
+
+    async def alter_email_read_state(self, msg_id: str, action: EmailAction) -> tuple[bool, Optional[str]]:
+        is_read = (action == EmailAction.MarkAsRead)
+
+        with SessionFactory() as session:
+            read = session.scalar(select(Email.read).where(Email.id == msg_id))
+            if read is None:
+                return False, "EmailNotFound"
+
+            if read == is_read:
+                return True, None
+
+            labels = ['UNREAD']
+            body = dict(addLabelIds=[] if is_read else labels, removeLabelIds=labels if is_read else [])
+            try:
+                await self._request('messages.modify', 'POST', f'messages/{msg_id}/modify', json=body)
+            except HttpError as e:
+                console.log(f"[red] When Altering Email {msg_id=}, {action=} {e} [/red]")
+                return False, str(e)
+
+            session.execute(update(Email).where(Email.id == msg_id).values(read=is_read))
+            session.commit()
+
+        return True, None
+
+    async def batch_modify(
+            self, msg_ids: list[str], add_labels: Iterable[str] = (),
+            remove_labels: Iterable[str] = ()) -> tuple[bool, Optional[str]]:
+
+        if len(msg_ids) > self.batch_modify_limit:
+            raise ValueError(f'batchModify Accepts at Most {self.batch_modify_limit} Ids')
+
+        body = dict(ids=msg_ids, addLabelIds=list(add_labels), removeLabelIds=list(remove_labels))
+        try:
+            await self._request('messages.batchModify', 'POST', 'messages/batchModify', json=body)
+        except HttpError as e:
+            console.log(f"[red] When Modifying {len(msg_ids)} Emails {add_labels=}, {remove_labels=} {e} [/red]")
+            return False, str(e)
+
+        return True, None
+
+    async def modify_thread(
+            self, thread_id: str, add_labels: Iterable[str] = (),
+            remove_labels: Iterable[str] = ()) -> tuple[bool, Optional[str]]:
+
+        body = dict(addLabelIds=list(add_labels), removeLabelIds=list(remove_labels))
+        try:
+            await self._request('threads.modify', 'POST', f'threads/{thread_id}/modify', json=body)
+        except HttpError as e:
+            console.log(f"[red] When Modifying Thread {thread_id=} {add_labels=}, {remove_labels=} {e} [/red]")
+            return False, str(e)
+
+        return True, None
+
+    async def trash_thread(self, thread_id: str) -> tuple[bool, Optional[str]]:
+        try:
+            await self._request('threads.trash', 'POST', f'threads/{thread_id}/trash')
+        except HttpError as e:
+            console.log(f"[red] When Trashing Thread {thread_id=} {e} [/red]")
+            return False, str(e)
+
+        return True, None
+
+    async def move_email(self, msg_id: str, to_location: MailBox) -> tuple[bool, Optional[str]]:
+
+        with SessionFactory() as session:
+            mailbox = session.scalar(select(Email.mailbox).where(Email.id == msg_id))
+            if mailbox is None:
+                return False, "EmailNotFound"
+
+            if mailbox == to_location:
+                console.log("From and To Locations are same, Skipping")
+                return True, None
+
+            if to_location not in mailbox.get_movable_locations():
+                console.log(f"Cannot Move Email {msg_id} From {mailbox} To Location {to_location}")
+                return False, "CannotMoveEmail"
+
+            try:
+                if to_location == MailBox.Trash:
+                    await self._request('messages.trash', 'POST', f'messages/{msg_id}/trash')
+                else:
+                    body = dict(addLabelIds=[to_location.value], removeLabelIds=[mailbox.value])
+                    await self._request('messages.modify', 'POST', f'messages/{msg_id}/modify', json=body)
+            except HttpError as e:
+                console.log(f"[red] When Moving Message {msg_id=}, {to_location=}, {mailbox=} {e} [/red]")
+                return False, str(e)
+
+            session.execute(update(Email).where(Email.id == msg_id).values(mailbox=to_location))
+            session.commit()
+
+        return True, None
+
+
+class AsyncMockGmailService(AsyncGmailService):
+    """
+    Serves the REST API from the data of `MockGmailService.Service` through an httpx mock transport,
+    every request takes `latency` seconds without blocking the event loop
+    """
+
+    def __init__(
+            self, auth: Optional[GoogleAuth] = None, emails: Optional[Mapping[str, dict[str, Any]]] = None,
+            latency: float = 0.0, concurrency: int = 100, units_per_second: Optional[float] = None,
+            metadata_only: bool = False) -> None:
+
+        if emails is None:
+            emails = MockGmailService.read_emails_file()
+
+        self._service = MockGmailService.Service(emails)
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        client = httpx.AsyncClient(base_url=GMAIL_API_URL, transport=httpx.MockTransport(self.handle))
+        super().__init__(
+            None, concurrency=concurrency, units_per_second=units_per_second, client=client, metadata_only=metadata_only
+        )
+        self.scheduler.backoff = 0
+
+    @classmethod
+    def create(cls, credentials_file: Optional[Path], token_file: Optional[Path] = None, **kwargs):
+        return AsyncMockGmailService(**kwargs)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            self._service.wait()
+            return httpx.Response(200, json=self.route(request))
+        except HttpError as e:
+            return httpx.Response(e.status_code, json={'error': {'code': e.status_code, 'message': e.reason}})
+        finally:
+            self.in_flight -= 1
+
+    def route(self, request: httpx.Request) -> dict[str, Any]:
+        service = self._service
+        path = request.url.path.split('/users/me/', 1)[1].split('/')
+        params = request.url.params
+        body = loads(request.content) if request.content else {}
+        page = dict(pageToken=params.get('pageToken'), maxResults=int(params.get('maxResults', 100)))
+
+        if path == ['profile']:
+            return service.getProfile().run()
+        if path == ['labels']:
+            return service.labels().list().run()
+        if path == ['history']:
+            return service.list_history(startHistoryId=params['startHistoryId'], **page).run()
+        if path == ['messages']:
+            return service.list(**page).run()
+        if path == ['messages', 'batchModify']:
+            return service.batchModify(body=body).run()
+        if path[0] == 'threads':
+            if path[2] == 'trash':
+                return service.trash_thread(path[1]).run()
+            return service.modify_thread(path[1], body=body).run()
+        if len(path) == 2:
+            return service.get(
+                path[1], format=params.get('format', 'raw'), metadataHeaders=params.get_list('metadataHeaders')
+            ).run()
+        if path[2] == 'trash':
+            return service.trash(path[1]).run()
+        return service.modify(path[1], body=body).run()
+
+
+async def iterate(items: Union[Iterable[str], AsyncIterable[str]]) -> AsyncIterator[str]:
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
@@ -0,0 +1,72 @@
+"""
+Discovery document of the Gmail API, read and parsed once per process
+
+`build('gmail', 'v1')` reads and parses the whole document every time a client is built, and the releases of
+google-api-python-client which do not ship the documents download it on every start. The document is taken
+from the package when it ships one, otherwise from a copy cached on disk which is downloaded again once a week
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Optional
+
+from email_reader.database.config import DEFAULT_DB_FILE
+
+DISCOVERY_DIR = DEFAULT_DB_FILE.parent / 'discovery'
+DISCOVERY_URL = 'https://{api}.googleapis.com/$discovery/rest?version={version}'
+MAX_CACHE_AGE = 7 * 24 * 60 * 60
+
+
+def packaged_document(api: str, version: str) -> Optional[str]:
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        return None
+    return get_static_doc(api, version)
+
+
+def download_document(api: str, version: str) -> str:
+    import httplib2
+
+    response, content = httplib2.Http().request(DISCOVERY_URL.format(api=api, version=version))
+    if response.status >= 400:
+        raise ConnectionError(f'Failed to Download the {api} {version} Discovery Document, Status {response.status}')
+    return content.decode()
+
+
+def cached_document(api: str, version: str, cache_dir: Path = DISCOVERY_DIR) -> str:
+    """
+    The copy cached in `cache_dir`, downloaded when it is missing or older than a week.
+    A stale copy is kept in use when the download fails
+    """
+    cache_file = cache_dir / f'{api}.{version}.json'
+    if cache_file.exists() and time.time() - cache_file.stat().st_mtime < MAX_CACHE_AGE:
+        return cache_file.read_text()
+
+    try:
+        document = download_document(api, version)
+    except Exception:
+        if cache_file.exists():
+            return cache_file.read_text()
+        raise
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_file.write_text(document)
+    return document
+
+
+@lru_cache(maxsize=None)
+def get_discovery_document(api: str = 'gmail', version: str = 'v1') -> dict[str, Any]:
+    """Parsed once and shared by the clients, which only read it"""
+    return json.loads(packaged_document(api, version) or cached_document(api, version))
+
+
+def build_service(credentials: Any, api: str = 'gmail', version: str = 'v1') -> Any:
+    """Same as `build(api, version, credentials=credentials)` without reading the discovery document again"""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(get_discovery_document(api, version), credentials=credentials)
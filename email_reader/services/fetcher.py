@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, ClassVar, Deque, Iterable, Iterator, Optional
+
+from email_reader.console import console
+from email_reader.metrics import metrics
+from email_reader.services.parser import METADATA_HEADERS, resource_size
+from email_reader.services.ratelimit import error_status, is_retryable, is_throttled
+from email_reader.utils import chunked
+
+if TYPE_CHECKING:
+    from email_reader.services.gmail import GmailService
+
+
+class BatchFetcher:
+    """
+    Fetches messages through Gmail batch HTTP requests of up to `max_batch_size` sub requests,
+    keeping `concurrency` batches in flight. Sub requests which fail with a retryable error are
+    retried individually with exponential backoff, the rest of the batch is not fetched again.
+    Batches go through the scheduler of the service, which spends the quota of every sub request
+
+    Messages failing with an error which is not retryable, e.g. deleted since they were listed, are skipped
+    and recorded in `failed_ids`. The ones still failing with a retryable error once the retries are spent
+    are skipped as well but recorded in `unfetched_ids`, the loader does not move the sync cursor past them
+    """
+
+    max_batch_size: ClassVar[int] = 100
+
+    def __init__(
+            self, service: GmailService, batch_size: int = 100, concurrency: int = 4,
+            max_retries: int = 3, backoff: float = 0.5, message_format: str = 'raw') -> None:
+
+        if not 1 <= batch_size <= self.max_batch_size:
+            raise ValueError(f'Batch size must be between 1 and {self.max_batch_size}')
+        if concurrency < 1:
+            raise ValueError('Concurrency must be at least 1')
+
+        self.service = service
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.message_format = message_format
+        self.failed_ids: dict[str, str] = {}
+        self.unfetched_ids: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, msg_ids: Iterable[str]) -> Iterator[dict[str, Any]]:
+        """Yields the message resources in the order of `msg_ids`, skipping the ones that could not be fetched"""
+
+        if self.concurrency == 1:
+            for chunk in chunked(msg_ids, self.batch_size):
+                yield from self._fetch_batch(chunk)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='gmail-fetch') as executor:
+            pending: Deque[Future[list[dict[str, Any]]]] = deque()
+
+            for chunk in chunked(msg_ids, self.batch_size):
+                while len(pending) >= self.concurrency:
+                    yield from pending.popleft().result()
+                pending.append(executor.submit(self._fetch_batch, chunk))
+
+            while pending:
+                yield from pending.popleft().result()
+
+    def _fetch_batch(self, msg_ids: list[str]) -> list[dict[str, Any]]:
+        responses: dict[str, dict[str, Any]] = {}
+        remaining = list(msg_ids)
+
+        for attempt in range(self.max_retries + 1):
+            failed: dict[str, Exception] = {}
+
+            def callback(request_id: str, response: Optional[dict[str, Any]], exception: Optional[Exception]):
+                if exception is not None:
+                    failed[request_id] = exception
+                    metrics.inc('gmail_request_errors_total', method='messages.get', status=error_status(exception))
+                elif response is not None:
+                    responses[request_id] = response
+
+            scheduler = self.service.scheduler
+            try:
+                with scheduler.slot('messages.get', len(remaining)):
+                    self._execute_batch(remaining, callback)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                failed = {msg_id: e for msg_id in remaining if msg_id not in responses}
+
+            if any(is_throttled(error) for error in failed.values()):
+                scheduler.on_throttled()
+            else:
+                scheduler.on_success()
+
+            retryable = [msg_id for msg_id, error in failed.items() if is_retryable(error)]
+            for msg_id, error in failed.items():
+                if msg_id not in retryable:
+                    self._record_failure(msg_id, error)
+
+            if not retryable:
+                break
+
+            if attempt == self.max_retries:
+                for msg_id in retryable:
+                    self._record_failure(msg_id, failed[msg_id], retryable=True)
+                break
+
+            # Full jitter keeps the concurrent batches from retrying in lock step
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            remaining = retryable
+
+        metrics.inc('gmail_fetched_bytes_total', sum(resource_size(response) for response in responses.values()))
+        return [responses[msg_id] for msg_id in msg_ids if msg_id in responses]
+
+    def _execute_batch(self, msg_ids: list[str], callback) -> None:
+        service = self.service._service
+        batch = service.new_batch_http_request(callback=callback)
+        kwargs: dict[str, Any] = {'format': self.message_format}
+        if self.message_format == 'metadata':
+            kwargs['metadataHeaders'] = list(METADATA_HEADERS)
+
+        for msg_id in msg_ids:
+            batch.add(service.users().messages().get(userId='me', id=msg_id, **kwargs), request_id=msg_id)
+
+        batch.execute(http=self.service.thread_http())
+
+    def _record_failure(self, msg_id: str, error: Exception, retryable: bool = False) -> None:
+        if retryable:
+            console.log(f"[red] Gave Up Fetching Email {msg_id=} After {self.max_retries} Retries {error} [/red]")
+        else:
+            console.log(f"[red] Failed to Fetch Email {msg_id=} {error} [/red]")
+        with self._lock:
+            (self.unfetched_ids if retryable else self.failed_ids)[msg_id] = str(error)
@@ -1,11 +1,10 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import ClassVar, Optional
+from typing import TYPE_CHECKING, ClassVar, Optional
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 
 class GoogleAuth:
@@ -13,18 +12,24 @@ class GoogleAuth:
     token_filename: ClassVar[Path] = Path('token.json')
     credentials: Optional[Credentials] = None
 
-    def __init__(self, credentials_file: Optional[Path]) -> None:
-        self.credentials = self.get_credentials(credentials_file)
+    def __init__(self, credentials_file: Optional[Path], token_file: Optional[Path] = None) -> None:
+        self.credentials = self.get_credentials(credentials_file, token_file)
 
     @classmethod
-    def get_credentials(cls, credentials_file: Optional[Path] = None) -> Credentials:
+    def get_credentials(cls, credentials_file: Optional[Path] = None, token_file: Optional[Path] = None) -> Credentials:
+        """The token is kept in `token_file`, by default `token.json` next to the credentials file"""
+        # The google auth modules are imported on use, the ones refreshing or authorizing a token pull in
+        # requests and oauthlib which take longer to import than the rest of the startup
+        from google.oauth2.credentials import Credentials
+
         if not credentials_file:
             raise FileNotFoundError('Credentials File Not Found')
 
         credentials = None
         credentials_folder = Path(credentials_file).parent
 
-        token_file = Path(credentials_folder) / cls.token_filename
+        if token_file is None:
+            token_file = Path(credentials_folder) / cls.token_filename
 
         if token_file.exists():
             credentials = Credentials.from_authorized_user_file(
@@ -33,20 +38,25 @@ class GoogleAuth:
 
         if credentials:
             if credentials.expired and credentials.refresh_token:
+                from google.auth.transport.requests import Request
+
                 credentials.refresh(Request())
             return credentials
 
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file(
                 credentials_file.absolute().as_posix(),
                 cls.scopes
             )
             credentials = flow.run_local_server(port=0)
+            token_file.parent.mkdir(parents=True, exist_ok=True)
             token_file.write_text(credentials.to_json())
             return credentials
 
 
 class MockGoogleAuth(GoogleAuth):
 
-    def __init__(self, credentials_file: Optional[Path] = None) -> None:
+    def __init__(self, credentials_file: Optional[Path] = None, token_file: Optional[Path] = None) -> None:
         pass
@@ -4,123 +4,370 @@ import base64
 import csv
 import datetime
 import os
-from email import message, message_from_bytes
+import threading
+import time
+from dataclasses import dataclass, field
+from email.parser import BytesHeaderParser
 from enum import Enum
+from itertools import islice
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Any, List, Optional, cast
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Iterable, Iterator, Mapping, Optional, Union
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from sqlalchemy import select, update
 
 from email_reader.console import console
 from email_reader.database.engine import SessionFactory
 from email_reader.database.tables.email import Email, MailBox
+from email_reader.services.fetcher import BatchFetcher
+from email_reader.services.discovery import build_service
 from email_reader.services.gauth import GoogleAuth, MockGoogleAuth
+from email_reader.services.parser import MessageParser, RawMessage, parse_message_row, parse_metadata_row
+from email_reader.services.ratelimit import USER_QUOTA_PER_SECOND, RequestScheduler
+
+if TYPE_CHECKING:
+    import httplib2
 
 
 class EmailAction(Enum):
     MarkAsRead = 'mark_as_read'
     MarkAsUnread = 'mark_as_unread'
     MoveMessage = 'move_message'
+    AddLabel = 'add_label'
+    RemoveLabel = 'remove_label'
+
+
+# Labels of every mailbox, their id is their name
+SYSTEM_LABELS = ('INBOX', 'SPAM', 'TRASH', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT')
+
+
+def after_query(after: Optional[datetime.datetime]) -> Optional[str]:
+    """Search query of the messages received after `after`, None lists every message"""
+    if after and after > datetime.datetime.min:
+        # Dates are stored as naive UTC, `after:` expects epoch seconds
+        return f"after:{int(after.replace(tzinfo=datetime.timezone.utc).timestamp())}"
+    return None
+
+
+class HistoryExpiredError(Exception):
+    """The stored historyId is too old for `history().list`, a full sync is needed"""
+
+
+class PageTokenExpiredError(Exception):
+    """The stored page token of an interrupted listing is rejected by `messages().list`"""
+
+
+@dataclass
+class HistoryChanges:
+    """Net effect of the mailbox history since a historyId, the last record of a message wins"""
+
+    history_id: str
+    added: set[str] = field(default_factory=set)
+    deleted: set[str] = field(default_factory=set)
+    relabeled: dict[str, list[str]] = field(default_factory=dict)
+
+    def add_record(self, record: dict[str, Any]) -> None:
+        for added in record.get('messagesAdded', []):
+            msg_id = added['message']['id']
+            self.added.add(msg_id)
+            self.deleted.discard(msg_id)
+            self.relabeled.pop(msg_id, None)
+
+        for deleted in record.get('messagesDeleted', []):
+            msg_id = deleted['message']['id']
+            self.deleted.add(msg_id)
+            self.added.discard(msg_id)
+            self.relabeled.pop(msg_id, None)
+
+        for changed in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+            message = changed['message']
+            if message['id'] not in self.added and message['id'] not in self.deleted:
+                # labelIds of the history record are the full set of labels after the change
+                self.relabeled[message['id']] = message.get('labelIds', [])
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.added or self.deleted or self.relabeled)
 
 
 class GmailService:
-    def __init__(self, auth: GoogleAuth):
-        self._service = build('gmail', 'v1', credentials=auth.credentials)
+    batch_modify_limit: ClassVar[int] = 1000
+
+    def __init__(
+            self, auth: GoogleAuth, batch_size: int = 100, concurrency: int = 4, parse_processes: int = 0,
+            units_per_second: Optional[float] = USER_QUOTA_PER_SECOND, metadata_only: bool = False):
+        self._credentials = auth.credentials
+        self._service = build_service(auth.credentials)
+        self._local = threading.local()
+        self.scheduler = RequestScheduler(units_per_second=units_per_second, concurrency=concurrency)
+        self.metadata_only = metadata_only
+        self.fetcher = BatchFetcher(self, batch_size=batch_size, concurrency=concurrency)
+        self.metadata_fetcher = BatchFetcher(
+            self, batch_size=batch_size, concurrency=concurrency, message_format='metadata'
+        )
+        self.parser = MessageParser(processes=parse_processes)
 
     @classmethod
-    def create(cls, credentials_file: Optional[Path]):
-        return GmailService(GoogleAuth(credentials_file))
+    def create(cls, credentials_file: Optional[Path], token_file: Optional[Path] = None, **kwargs):
+        return GmailService(GoogleAuth(credentials_file, token_file), **kwargs)
+
+    @property
+    def credentials(self):
+        return self._credentials
+
+    @property
+    def unfetched_ids(self) -> dict[str, str]:
+        """Messages the fetchers gave up on while they were failing with a retryable error"""
+        return {**self.fetcher.unfetched_ids, **self.metadata_fetcher.unfetched_ids}
+
+    def clear_unfetched_ids(self) -> None:
+        self.fetcher.unfetched_ids.clear()
+        self.metadata_fetcher.unfetched_ids.clear()
+
+    def thread_http(self) -> Optional[httplib2.Http]:
+        """httplib2 is not thread safe, so every fetch thread gets its own authorized connection"""
+        if self._credentials is None:
+            return None
+
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+
+            http = self._local.http = AuthorizedHttp(self._credentials, http=httplib2.Http())
+        return http
+
+    def list_message_ids(self, query: Optional[str] = None, page_size: int = 500) -> Iterator[str]:
+        """Walks the `messages().list` pages lazily, yielding one message id at a time"""
+        for _, msg_ids in self.list_message_pages(query, page_size=page_size):
+            yield from msg_ids
+
+    def list_message_pages(
+            self, query: Optional[str] = None, page_token: Optional[str] = None,
+            page_size: int = 500) -> Iterator[tuple[Optional[str], list[str]]]:
+        """
+        Walks the `messages().list` pages lazily, starting at `page_token`.
+        Yields the ids of every page along with the token it was listed with, None for the first page
+        """
+        kwargs: dict[str, Any] = {'maxResults': page_size}
+        if query:
+            kwargs['q'] = query
+        if page_token:
+            kwargs['pageToken'] = page_token
+
+        while True:
+            request = self._service.users().messages().list(userId='me', **kwargs)
+            try:
+                results = self.scheduler.execute('messages.list', request)
+            except HttpError as e:
+                if e.status_code == 400 and page_token and kwargs.get('pageToken') == page_token:
+                    raise PageTokenExpiredError(f'Page token {page_token} is no longer valid') from e
+                raise
+            yield kwargs.get('pageToken'), [msg['id'] for msg in results.get('messages', [])]
+
+            next_page_token = results.get('nextPageToken')
+            if not next_page_token:
+                break
+            kwargs['pageToken'] = next_page_token
+
+    def get_emails(self, after: Optional[datetime.datetime] = None) -> Iterator[Email]:
+        for row in self.get_email_rows(after):
+            yield Email(**row)
+
+    def get_emails_by_ids(self, msg_ids: Iterable[str]) -> Iterator[Email]:
+        for row in self.get_email_rows_by_ids(msg_ids):
+            yield Email(**row)
+
+    def get_email_rows(self, after: Optional[datetime.datetime] = None) -> Iterator[dict[str, Any]]:
+        """Same as `get_emails`, but yields the column values instead of `Email` instances"""
+        yield from self.get_email_rows_by_ids(self.list_message_ids(after_query(after)))
+
+    def get_email_rows_by_ids(self, msg_ids: Iterable[str]) -> Iterator[dict[str, Any]]:
+        """
+        Fetches the messages in batches on the fetcher threads and parses them with the parser,
+        in worker processes when `parse_processes` is set. Both stages only keep a bounded number
+        of batches in flight, so the rows are produced as fast as the caller writes them
+
+        With `metadata_only` only the headers and labels are fetched, the rows have no body
+        """
+        if self.metadata_only:
+            for resource in self.metadata_fetcher.fetch(msg_ids):
+                yield parse_metadata_row(resource)
+            return
+
+        yield from self.get_body_rows(msg_ids)
+
+    def get_body_rows(self, msg_ids: Iterable[str]) -> Iterator[dict[str, Any]]:
+        """Rows of the whole messages, bodies included, whether the service is `metadata_only` or not"""
+        yield from self.parser.parse(self.fetcher.fetch(msg_ids))
+
+    def list_labels(self) -> list[dict[str, Any]]:
+        """`label` resources of the mailbox, system labels included"""
+        return self.scheduler.execute('labels.list', self._service.users().labels().list(userId='me')).get('labels', [])
+
+    def get_history_id(self) -> str:
+        """Current historyId of the mailbox"""
+        return self.scheduler.execute('getProfile', self._service.users().getProfile(userId='me'))['historyId']
+
+    def get_history_changes(self, start_history_id: str) -> HistoryChanges:
+        kwargs: dict[str, Any] = {
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            'maxResults': 500,
+        }
+        changes = HistoryChanges(history_id=start_history_id)
+
+        while True:
+            try:
+                request = self._service.users().history().list(userId='me', **kwargs)
+                results = self.scheduler.execute('history.list', request)
+            except HttpError as e:
+                if e.status_code == 404:
+                    raise HistoryExpiredError(f'History {start_history_id} is no longer available') from e
+                raise
 
-    def get_emails(self, after: Optional[datetime.datetime] = None) -> List[Email]:
-        kwargs: dict[str, Any] = {}
+            for record in results.get('history', []):
+                changes.add_record(record)
+            changes.history_id = results.get('historyId', changes.history_id)
 
-        if after and after > datetime.datetime.min:
-            kwargs['q'] = f"after:{int(after.timestamp() * 1000)}"
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+            kwargs['pageToken'] = page_token
 
-        results = self._service.users().messages().list(userId='me', **kwargs).execute()
-        return [self.get_email(msg['id']) for msg in results.get('messages', [])]
+        return changes
 
     def get_email(self, msg_id: str) -> Email:
 
-        full_message = self._service.users().messages().get(userId='me', id=msg_id, format='raw').execute()
+        request = self._service.users().messages().get(userId='me', id=msg_id, format='raw')
+        full_message = self.scheduler.execute('messages.get', request)
+        return self.parse_message(full_message)
 
-        email_message = cast(
-            message.EmailMessage, message_from_bytes(base64.urlsafe_b64decode(full_message['raw']))
-        )
-        return Email.from_email_message(
-            email_message=email_message, msg_id=msg_id,
-            labels=full_message.get('labelIds', [])
-        )
+    @classmethod
+    def parse_message(cls, full_message: dict[str, Any]) -> Email:
+        return Email(**cls.parse_message_row(full_message))
+
+    @staticmethod
+    def parse_message_row(full_message: dict[str, Any]) -> dict[str, Any]:
+        return parse_message_row(RawMessage.from_resource(full_message))
 
     def alter_email_read_state(
             self, msg_id: str, action: EmailAction) -> tuple[bool, Optional[str]]:
 
-        email = None
+        is_read = (action == EmailAction.MarkAsRead)
 
         with SessionFactory() as session:
-            email = session.get(Email, msg_id)
-            if not email:
+            read = session.scalar(select(Email.read).where(Email.id == msg_id))
+            if read is None:
                 return False, "EmailNotFound"
 
-        add_label_id, remove_label_id = [], []
-        if action == EmailAction.MarkAsRead:
-            remove_label_id = ['UNREAD']
-        elif action == EmailAction.MarkAsUnread:
-            add_label_id = ['UNREAD']
+            if read == is_read:
+                return True, None
+
+            add_label_id, remove_label_id = [], []
+            if action == EmailAction.MarkAsRead:
+                remove_label_id = ['UNREAD']
+            elif action == EmailAction.MarkAsUnread:
+                add_label_id = ['UNREAD']
+
+            try:
+                message = self.scheduler.execute('messages.modify', self._service.users().messages().modify(
+                    userId='me', id=msg_id,
+                    body=dict(addLabelIds=add_label_id, removeLabelIds=remove_label_id)
+                ))
+
+            except HttpError as e:
+                console.log(f"[red] When Altering Email {msg_id=}, {action=} {e} [/red]")
+                return False, str(e)
+
+            if message:
+                session.execute(update(Email).where(Email.id == message['id']).values(read=is_read))
+                session.commit()
+
+        return message is not None, None
+
+    def batch_modify(
+            self, msg_ids: list[str], add_labels: Iterable[str] = (),
+            remove_labels: Iterable[str] = ()) -> tuple[bool, Optional[str]]:
+        """Applies the same label change to up to `batch_modify_limit` messages in a single request"""
+
+        if len(msg_ids) > self.batch_modify_limit:
+            raise ValueError(f'batchModify Accepts at Most {self.batch_modify_limit} Ids')
 
         try:
-            message = self._service.users().messages().modify(
-                userId='me', id=msg_id,
-                body=dict(addLabelIds=add_label_id, removeLabelIds=remove_label_id)
-            ).execute()
+            self.scheduler.execute('messages.batchModify', self._service.users().messages().batchModify(
+                userId='me',
+                body=dict(ids=msg_ids, addLabelIds=list(add_labels), removeLabelIds=list(remove_labels))
+            ))
 
         except HttpError as e:
-            console.log(f"[red] When Altering Email {msg_id=}, {action=}, {email} {e} [/red]")
+            console.log(f"[red] When Modifying {len(msg_ids)} Emails {add_labels=}, {remove_labels=} {e} [/red]")
             return False, str(e)
 
-        if message:
-            with SessionFactory() as session:
-                is_read = (action == EmailAction.MarkAsRead)
-                session.query(Email).filter(Email.id == message['id']).update({Email.read: is_read})
-                session.commit()
+        return True, None
 
-        return message is not None, None
+    def modify_thread(
+            self, thread_id: str, add_labels: Iterable[str] = (),
+            remove_labels: Iterable[str] = ()) -> tuple[bool, Optional[str]]:
+        """Applies the label change to every message of the thread in a single request"""
+
+        try:
+            self.scheduler.execute('threads.modify', self._service.users().threads().modify(
+                userId='me', id=thread_id, body=dict(addLabelIds=list(add_labels), removeLabelIds=list(remove_labels))
+            ))
+
+        except HttpError as e:
+            console.log(f"[red] When Modifying Thread {thread_id=} {add_labels=}, {remove_labels=} {e} [/red]")
+            return False, str(e)
+
+        return True, None
+
+    def trash_thread(self, thread_id: str) -> tuple[bool, Optional[str]]:
+
+        try:
+            self.scheduler.execute('threads.trash', self._service.users().threads().trash(userId='me', id=thread_id))
+
+        except HttpError as e:
+            console.log(f"[red] When Trashing Thread {thread_id=} {e} [/red]")
+            return False, str(e)
+
+        return True, None
 
     def move_email(self, msg_id: str, to_location: MailBox) -> tuple[bool, Optional[str]]:
 
         with SessionFactory() as session:
 
-            current_email = session.get(Email, msg_id)
-            if not current_email:
+            mailbox = session.scalar(select(Email.mailbox).where(Email.id == msg_id))
+            if mailbox is None:
                 return False, "EmailNotFound"
 
-            movable_locations = current_email.mailbox.get_movable_locations()
+            movable_locations = mailbox.get_movable_locations()
 
-            if current_email.mailbox == to_location:
+            if mailbox == to_location:
                 console.log("From and To Locations are same, Skipping")
                 return True, None
 
             if to_location not in movable_locations:
-                console.log(f"Cannot Move Email {msg_id} To Location {to_location}, {current_email}")
+                console.log(f"Cannot Move Email {msg_id} From {mailbox} To Location {to_location}")
                 return False, "CannotMoveEmail"
 
             try:
                 if to_location == MailBox.Trash:
-                    message = self._service.users().messages().trash(userId='me', id=msg_id).execute()
+                    request = self._service.users().messages().trash(userId='me', id=msg_id)
+                    message = self.scheduler.execute('messages.trash', request)
                 else:
-                    message = self._service.users().messages().modify(
+                    message = self.scheduler.execute('messages.modify', self._service.users().messages().modify(
                         userId='me', id=msg_id,
-                        body=dict(addLabelIds=[to_location.value], removeLabelIds=[current_email.mailbox.value])
-                    ).execute()
+                        body=dict(addLabelIds=[to_location.value], removeLabelIds=[mailbox.value])
+                    ))
 
             except HttpError as e:
-                console.log(f"[red] When Moving Message {msg_id=}, {to_location=}, {current_email} {e} [/red]")
+                console.log(f"[red] When Moving Message {msg_id=}, {to_location=}, {mailbox=} {e} [/red]")
                 return False, str(e)
 
             if message:
-                session.query(Email).filter(Email.id == message['id']).update({Email.mailbox: to_location})
+                session.execute(update(Email).where(Email.id == message['id']).values(mailbox=to_location))
                 session.commit()
 
         return message is not None, None
@@ -128,9 +375,69 @@ class GmailService:
 
 class MockGmailService(GmailService):
 
+    class Batch:
+        def __init__(self, service: MockGmailService.Service, callback) -> None:
+            self._service = service
+            self._callback = callback
+            self._requests: list[tuple[str, Any]] = []
+
+        def add(self, request, request_id: str) -> None:
+            self._requests.append((request_id, request))
+
+        def execute(self, http=None) -> None:
+            # A batch costs a single round trip, whatever the number of sub requests
+            self._service.wait()
+            for request_id, request in self._requests:
+                try:
+                    response, exception = request.run(), None
+                except HttpError as e:
+                    response, exception = None, e
+                self._callback(request_id, response, exception)
+
     class Service:
-        def __init__(self, data):
+        def __init__(self, data, latency: Union[float, Callable[[], float]] = 0.0):
             self._data = data
+            # Seconds per round trip, or a function drawing them for every round trip
+            self.latency = latency
+            self.transient_failures: dict[str, int] = {}
+            # Number of the next requests answered with 429, batch requests included
+            self.throttled_requests = 0
+            self.round_trips = 0
+            self._lock = threading.Lock()
+            self._history: list[dict[str, Any]] = []
+            self._history_id = 1
+            self._oldest_history_id = 1
+            # Iterators over the data continuing at the next page token, so listing stays linear
+            self._cursors: dict[int, Iterator[str]] = {}
+            self._labels = {label: {'id': label, 'name': label, 'type': 'system'} for label in SYSTEM_LABELS}
+
+        @staticmethod
+        def error(status: int, content: bytes) -> HttpError:
+            import httplib2
+
+            return HttpError(httplib2.Response({'status': status}), content)
+
+        def wait(self) -> None:
+            with self._lock:
+                self.round_trips += 1
+                throttled = self.throttled_requests > 0
+                if throttled:
+                    self.throttled_requests -= 1
+            latency = self.latency() if callable(self.latency) else self.latency
+            if latency:
+                time.sleep(latency)
+            if throttled:
+                raise self.error(429, b'Too Many Requests')
+
+        def request(self, run) -> SimpleNamespace:
+            """`execute` is a round trip of its own, `run` is used when the request is part of a batch"""
+            def execute():
+                self.wait()
+                return run()
+            return SimpleNamespace(execute=execute, run=run)
+
+        def new_batch_http_request(self, callback=None):
+            return MockGmailService.Batch(self, callback)
 
         def users(self):
             return self
@@ -138,22 +445,177 @@ class MockGmailService(GmailService):
         def messages(self, *args, **kwargs):
             return self
 
-        def list(self, *args, **kwargs):
-            return SimpleNamespace(execute=lambda: {
-                'messages': [{'id': msg_id} for msg_id in self._data]
-            })
+        def history(self, *args, **kwargs):
+            return SimpleNamespace(list=self.list_history)
+
+        def threads(self, *args, **kwargs):
+            return SimpleNamespace(modify=self.modify_thread, trash=self.trash_thread)
+
+        def labels(self, *args, **kwargs):
+            return SimpleNamespace(list=self.list_labels)
+
+        def list_labels(self, *args, **kwargs):
+            return self.request(lambda: {'labels': list(self._labels.values())})
+
+        def add_label(self, label_id: str, name: str) -> None:
+            self._labels[label_id] = {'id': label_id, 'name': name, 'type': 'user'}
+
+        def getProfile(self, *args, **kwargs):
+            return self.request(lambda: {'historyId': str(self._history_id)})
+
+        def record_history(self, change_type: str, msg_id: str) -> None:
+            self._history_id += 1
+            message = {'id': msg_id, 'labelIds': list(self._data.get(msg_id, {}).get('labelIds', []))}
+            self._history.append({'id': str(self._history_id), change_type: [{'message': message}]})
+
+        def add_message(self, row: dict[str, Any]) -> None:
+            self._data[row['id']] = row
+            self.record_history('messagesAdded', row['id'])
+
+        def delete_message(self, msg_id: str) -> None:
+            del self._data[msg_id]
+            self.record_history('messagesDeleted', msg_id)
+
+        def expire_history(self) -> None:
+            self._oldest_history_id = self._history_id + 1
+
+        def list_history(self, *args, startHistoryId: str, maxResults: int = 100,
+                         pageToken: Optional[str] = None, **kwargs):
+            def run():
+                if int(startHistoryId) < self._oldest_history_id:
+                    raise self.error(404, b'Requested entity was not found.')
+                records = [record for record in self._history if int(record['id']) > int(startHistoryId)]
+                start = int(pageToken) if pageToken else 0
+                response: dict[str, Any] = {
+                    'history': records[start:start + maxResults], 'historyId': str(self._history_id)
+                }
+                if start + maxResults < len(records):
+                    response['nextPageToken'] = str(start + maxResults)
+                return response
+            return self.request(run)
+
+        def list(self, *args, maxResults: int = 100, pageToken: Optional[str] = None, **kwargs):
+            def run():
+                if pageToken and not pageToken.isdigit():
+                    raise self.error(400, b'Invalid pageToken')
+                start = int(pageToken) if pageToken else 0
+                cursor = self._cursors.pop(start, None) or islice(self._data, start, None)
+                try:
+                    msg_ids = [*islice(cursor, maxResults)]
+                except RuntimeError:
+                    # The data changed size since the previous page
+                    cursor = islice(self._data, start, None)
+                    msg_ids = [*islice(cursor, maxResults)]
+
+                response: dict[str, Any] = {'messages': [{'id': msg_id} for msg_id in msg_ids]}
+                if start + maxResults < len(self._data):
+                    self._cursors[start + maxResults] = cursor
+                    response['nextPageToken'] = str(start + maxResults)
+                return response
+            return self.request(run)
+
+        def change_labels(self, msg_id: str, add_labels: list[str], remove_labels: list[str]) -> dict[str, Any]:
+            row = self._data.get(msg_id)
+            if row is None:
+                raise self.error(404, b'Not Found')
+            labels = [label for label in row.get('labelIds', []) if label not in remove_labels]
+            row['labelIds'] = labels + [label for label in add_labels if label not in labels]
+            # Mappings generating their rows, like the benchmark mailboxes, only keep what is assigned
+            self._data[msg_id] = row
+            if add_labels:
+                self.record_history('labelsAdded', msg_id)
+            if remove_labels:
+                self.record_history('labelsRemoved', msg_id)
+            return {'id': msg_id, 'labelIds': row['labelIds']}
+
+        def batchModify(self, *args, body: dict[str, Any], **kwargs):
+            def run():
+                for msg_id in body['ids']:
+                    self.change_labels(msg_id, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+                return {}
+            return self.request(run)
 
         def trash(self, id: str, *args, **kwargs):
-            return SimpleNamespace(execute=lambda: {'id': id})
-
-        def modify(self, id: str, *args, **kwargs):
-            return SimpleNamespace(execute=lambda: {'id': id})
-
-        def get(self, id: str, *args, **kwargs):
-            return SimpleNamespace(execute=lambda: self._data[id])
+            return self.request(lambda: self.change_labels(id, ['TRASH'], []))
+
+        def modify(self, id: str, *args, body: Optional[dict[str, Any]] = None, **kwargs):
+            body = body or {}
+            return self.request(
+                lambda: self.change_labels(id, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            )
+
+        def thread_message_ids(self, thread_id: str) -> list[str]:
+            msg_ids = [msg_id for msg_id, row in self._data.items() if row.get('threadId') == thread_id]
+            if not msg_ids:
+                raise self.error(404, b'Not Found')
+            return msg_ids
+
+        def modify_thread(self, id: str, *args, body: Optional[dict[str, Any]] = None, **kwargs):
+            body = body or {}
+
+            def run():
+                msg_ids = self.thread_message_ids(id)
+                for msg_id in msg_ids:
+                    self.change_labels(msg_id, body.get('addLabelIds', []), body.get('removeLabelIds', []))
+                return {'id': id, 'messages': [{'id': msg_id} for msg_id in msg_ids]}
+            return self.request(run)
+
+        def trash_thread(self, id: str, *args, **kwargs):
+            return self.modify_thread(id, body={'addLabelIds': ['TRASH']})
+
+        def get(self, id: str, *args, format: str = 'raw', metadataHeaders: Optional[list[str]] = None, **kwargs):
+            def run():
+                with self._lock:
+                    failures_left = self.transient_failures.get(id, 0)
+                    if failures_left:
+                        self.transient_failures[id] = failures_left - 1
+                if failures_left:
+                    raise self.error(503, b'Backend Error')
+                if id not in self._data:
+                    raise self.error(404, b'Not Found')
+                if format == 'metadata':
+                    return self.metadata(self._data[id], metadataHeaders or [])
+                return self._data[id]
+            return self.request(run)
+
+        @staticmethod
+        def metadata(message: dict[str, Any], header_names: list[str]) -> dict[str, Any]:
+            """The `format=metadata` resource of a stored `format=raw` one"""
+            headers = BytesHeaderParser().parsebytes(base64.urlsafe_b64decode(message['raw']))
+            wanted = {name.lower() for name in header_names}
+            return {
+                'id': message['id'], 'threadId': message.get('threadId'), 'labelIds': message.get('labelIds') or [],
+                'payload': {'headers': [
+                    {'name': name, 'value': value} for name, value in headers.items()
+                    if not wanted or name.lower() in wanted
+                ]},
+            }
+
+    def __init__(
+            self, auth: MockGoogleAuth, emails: Optional[Mapping[str, dict[str, Any]]] = None,
+            latency: Union[float, Callable[[], float]] = 0.0, batch_size: int = 100, concurrency: int = 4,
+            parse_processes: int = 0, units_per_second: Optional[float] = None, metadata_only: bool = False) -> None:
+
+        if emails is None:
+            emails = self.read_emails_file()
+
+        self._credentials = None
+        self._service = MockGmailService.Service(emails, latency=latency)  # type: ignore
+        self._local = threading.local()
+        self.scheduler = RequestScheduler(units_per_second=units_per_second, concurrency=concurrency, backoff=0)
+        self.metadata_only = metadata_only
+        self.fetcher = BatchFetcher(self, batch_size=batch_size, concurrency=concurrency)
+        self.metadata_fetcher = BatchFetcher(
+            self, batch_size=batch_size, concurrency=concurrency, message_format='metadata'
+        )
+        self.parser = MessageParser(processes=parse_processes)
 
-    def __init__(self, auth: MockGoogleAuth) -> None:
+    @classmethod
+    def create(cls, credentials_file: Optional[Path], token_file: Optional[Path] = None, **kwargs):
+        return MockGmailService(MockGoogleAuth(None), **kwargs)
 
+    @staticmethod
+    def read_emails_file() -> dict[str, dict[str, Any]]:
         email_file_path = os.getenv('PY_EMAIL_FILE_PATH')
         if not email_file_path:
             raise ValueError('Need Email File Path to Run Tests')
@@ -164,8 +626,4 @@ class MockGmailService(GmailService):
             for row in reader:
                 emails_for_test[row['id']] = row
 
-        self._service = MockGmailService.Service(emails_for_test)  # type: ignore
-
-    @classmethod
-    def create(cls, credentials_file: Optional[Path]):
-        return MockGmailService(MockGoogleAuth(None))
+        return emails_for_test
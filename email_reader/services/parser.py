@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import base64
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from email import message, message_from_bytes
+from typing import Any, Deque, Iterable, Iterator, NamedTuple, Optional, cast
+
+from email_reader.body import BodyExtractor, get_body_extractor
+from email_reader.database.tables.email import Email
+from email_reader.metrics import metrics
+from email_reader.utils import chunked
+
+
+# Headers requested with `format=metadata`, the ones the email columns are taken from
+METADATA_HEADERS = ('From', 'To', 'Subject', 'Date')
+
+
+class RawMessage(NamedTuple):
+    """The parts of a `format=raw` message resource needed to parse it, small and cheap to pickle"""
+
+    id: str
+    raw: str
+    label_ids: tuple[str, ...]
+    thread_id: Optional[str] = None
+
+    @classmethod
+    def from_resource(cls, full_message: dict[str, Any]) -> RawMessage:
+        return cls(
+            full_message['id'], full_message['raw'], tuple(full_message.get('labelIds') or ()),
+            full_message.get('threadId')
+        )
+
+
+def parse_message_row(raw_message: RawMessage, extractor: Optional[BodyExtractor] = None) -> dict[str, Any]:
+    email_message = cast(message.EmailMessage, message_from_bytes(base64.urlsafe_b64decode(raw_message.raw)))
+    return Email.row_from_email_message(
+        email_message=email_message, msg_id=raw_message.id, labels=list(raw_message.label_ids),
+        extractor=extractor, thread_id=raw_message.thread_id
+    )
+
+
+def parse_metadata_row(resource: dict[str, Any]) -> dict[str, Any]:
+    """Row of a `format=metadata` message resource, its body is left to be fetched when a rule needs it"""
+    headers = message.Message()
+    for header in resource.get('payload', {}).get('headers', []):
+        headers[header['name']] = header['value']
+
+    return dict(
+        **Email.row_from_headers(
+            headers, resource['id'], list(resource.get('labelIds') or ()), resource.get('threadId')
+        ),
+        body=None,
+        body_fetched=False,
+    )
+
+
+def resource_size(resource: dict[str, Any]) -> int:
+    """Characters of the message in a `format=raw` or `format=metadata` resource"""
+    if 'raw' in resource:
+        return len(resource['raw'] or '')
+    headers = resource.get('payload', {}).get('headers', [])
+    return sum(len(header['name']) + len(header['value']) for header in headers)
+
+
+def parse_message_rows(
+        raw_messages: list[RawMessage], extractor: BodyExtractor) -> tuple[list[dict[str, Any]], float]:
+    """
+    Runs in the worker processes, a whole chunk per task to keep the pickling overhead low.
+    Returns the time spent parsing along with the rows, the metrics of the workers are not collected
+    """
+    started = time.perf_counter()
+    rows = [parse_message_row(raw_message, extractor) for raw_message in raw_messages]
+    return rows, time.perf_counter() - started
+
+
+class MessageParser:
+    """
+    Decodes and parses raw message resources into email rows. With `processes` the parsing runs in
+    a process pool, keeping at most `max_pending` chunks of `chunk_size` messages queued so that memory
+    stays bounded when the fetching outpaces the parsing or the database writes
+    """
+
+    def __init__(
+            self, processes: int = 0, chunk_size: int = 50, max_pending: Optional[int] = None,
+            extractor: Optional[BodyExtractor] = None) -> None:
+
+        if processes < 0:
+            raise ValueError('Processes must be at least 0')
+        if chunk_size < 1:
+            raise ValueError('Chunk size must be at least 1')
+
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * max(processes, 1)
+        self.extractor = extractor
+
+    def parse(self, full_messages: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+        """Yields the rows in the order of `full_messages`"""
+
+        extractor = self.extractor or get_body_extractor()
+        raw_messages = (RawMessage.from_resource(full_message) for full_message in full_messages)
+
+        if not self.processes:
+            for raw_message in raw_messages:
+                started = time.perf_counter()
+                row = parse_message_row(raw_message, extractor)
+                record_parse(1, time.perf_counter() - started)
+                yield row
+            return
+
+        # The fetcher threads are running, forking them could leave a lock held in the children
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+        with ProcessPoolExecutor(max_workers=self.processes, mp_context=context) as executor:
+            pending: Deque[Future[tuple[list[dict[str, Any]], float]]] = deque()
+
+            for chunk in chunked(raw_messages, self.chunk_size):
+                while len(pending) >= self.max_pending:
+                    yield from collect_rows(pending.popleft())
+                pending.append(executor.submit(parse_message_rows, chunk, extractor))
+
+            while pending:
+                yield from collect_rows(pending.popleft())
+
+
+def collect_rows(future: Future[tuple[list[dict[str, Any]], float]]) -> list[dict[str, Any]]:
+    rows, seconds = future.result()
+    record_parse(len(rows), seconds)
+    return rows
+
+
+def record_parse(count: int, seconds: float) -> None:
+    metrics.inc('emails_parsed_total', count)
+    metrics.inc('email_parse_seconds_total', seconds)
@@ -0,0 +1,278 @@
+"""
+Scheduling of the Gmail API requests
+
+Every request goes through a `RequestScheduler`, which spends its quota units from a token bucket
+refilled at the per user quota, keeps at most `concurrency` requests in flight and retries the
+retryable failures with exponential backoff. Throttling responses halve both the concurrency and the
+rate, which then grow back additively with every successful request, so that the throughput settles
+just under the quota actually granted instead of alternating between bursts and failures
+"""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+from googleapiclient.errors import HttpError
+
+from email_reader.console import console
+from email_reader.metrics import metrics
+
+T = TypeVar('T')
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'messages.trash': 5,
+    'threads.modify': 10,
+    'threads.trash': 10,
+    'history.list': 2,
+    'labels.list': 1,
+    'getProfile': 1,
+}
+DEFAULT_QUOTA_UNITS = 5
+USER_QUOTA_PER_SECOND = 250
+
+
+def is_retryable(error: Exception) -> bool:
+    if not isinstance(error, HttpError):
+        # Transport level failures (timeouts, dropped connections) are worth another try
+        return isinstance(error, (OSError, TimeoutError))
+
+    return error.status_code in RETRYABLE_STATUSES or is_throttled(error)
+
+
+def error_status(error: Exception) -> str:
+    """HTTP status of a failed request, or the exception type when it did not get a response"""
+    return str(error.status_code) if isinstance(error, HttpError) else type(error).__name__
+
+
+def is_throttled(error: Exception) -> bool:
+    """Whether Gmail is asking us to slow down, as opposed to failing on its own"""
+    if not isinstance(error, HttpError):
+        return False
+
+    if error.status_code == 429:
+        return True
+    if error.status_code == 403:
+        return any(detail.get('reason') in RATE_LIMIT_REASONS for detail in (error.error_details or [])
+                   if isinstance(detail, dict))
+    return False
+
+
+@contextmanager
+def record_request(method: str, count: int = 1) -> Iterator[None]:
+    """Records a round trip of `count` requests in the metrics, the quota and slot waits are left out"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        metrics.inc('gmail_request_errors_total', count, method=method, status=error_status(e))
+        raise
+    finally:
+        metrics.inc('gmail_requests_total', count, method=method)
+        metrics.observe('gmail_request_seconds', time.perf_counter() - started, method=method)
+
+
+class TokenBucket:
+    """
+    Refills `rate` units per second up to `capacity`. A request costing more than the capacity,
+    like a batch of gets, waits for a full bucket and leaves it in debt, which keeps the long run rate
+    """
+
+    def __init__(
+            self, rate: float, capacity: Optional[float] = None,
+            clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, units: float) -> float:
+        """Takes the units and returns 0 when they are available, otherwise returns the time until they are"""
+        with self._lock:
+            self._refill()
+            needed = min(units, self.capacity)
+            if self.tokens >= needed:
+                self.tokens -= units
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def acquire(self, units: float) -> float:
+        """Takes the units, waiting for them if needed, and returns the time waited"""
+        waited = 0.0
+        while delay := self.reserve(units):
+            self._sleep(delay)
+            waited += delay
+        return waited
+
+
+class RequestScheduler:
+    """
+    Rate, concurrency and retries of the requests of a `GmailService`, shared by every thread using it.
+    The rate and concurrency adapt with AIMD between their minimum and the configured maximum,
+    a `units_per_second` of None does not limit the rate
+    """
+
+    def __init__(
+            self, units_per_second: Optional[float] = USER_QUOTA_PER_SECOND, concurrency: int = 8,
+            max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 32.0,
+            min_units_per_second: float = 10.0, min_concurrency: int = 1,
+            sleep: Callable[[float], None] = time.sleep) -> None:
+
+        if concurrency < min_concurrency:
+            raise ValueError(f'Concurrency must be at least {min_concurrency}')
+
+        self.max_units_per_second = units_per_second
+        self.min_units_per_second = min(min_units_per_second, units_per_second or min_units_per_second)
+        self.max_concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.bucket = TokenBucket(units_per_second, sleep=sleep) if units_per_second else None
+        self.concurrency_limit = float(concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.retried = 0
+        self._sleep = sleep
+        self._condition = threading.Condition()
+
+    @property
+    def units_per_second(self) -> Optional[float]:
+        return self.bucket.rate if self.bucket is not None else None
+
+    @contextmanager
+    def slot(self, method: str, count: int = 1) -> Iterator[None]:
+        """Spends the quota of `count` requests of `method` and holds one of the concurrency slots"""
+
+        if self.bucket is not None:
+            self.bucket.acquire(QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count)
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < int(self.concurrency_limit))
+            self.in_flight += 1
+        try:
+            with record_request(method, count):
+                yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            if self.bucket is not None and self.max_units_per_second:
+                self.bucket.rate = min(self.max_units_per_second, self.bucket.rate + self.max_units_per_second / 100)
+            self._condition.notify()
+
+    def on_throttled(self) -> None:
+        with self._condition:
+            self.throttled += 1
+            self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+            if self.bucket is not None:
+                self.bucket.rate = max(self.min_units_per_second, self.bucket.rate / 2)
+
+    def backoff_delay(self, attempt: int) -> float:
+        # Full jitter keeps the concurrent requests from retrying in lock step
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def execute(self, method: str, request: Any, **kwargs) -> Any:
+        """`request.execute(**kwargs)`, retrying the retryable errors up to `max_retries` times"""
+        return self.call(method, lambda: request.execute(**kwargs))
+
+    def call(self, method: str, run: Callable[[], T], count: int = 1) -> T:
+        attempt = 0
+        while True:
+            try:
+                with self.slot(method, count):
+                    result = run()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                if is_throttled(e):
+                    self.on_throttled()
+                self.retried += 1
+                delay = self.backoff_delay(attempt)
+                console.log(f"[yellow] Retrying {method} in {delay:.2f}s After {e}")
+                self._sleep(delay)
+                attempt += 1
+            else:
+                self.on_success()
+                return result
+
+
+class AsyncRequestScheduler(RequestScheduler):
+    """`RequestScheduler` of the coroutines of an event loop, waiting for the quota and slots without blocking it"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._async_condition: Optional[asyncio.Condition] = None
+
+    @asynccontextmanager
+    async def async_slot(self, method: str, count: int = 1) -> AsyncIterator[None]:
+        if self.bucket is not None:
+            while delay := self.bucket.reserve(QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count):
+                await asyncio.sleep(delay)
+
+        if self._async_condition is None:
+            self._async_condition = asyncio.Condition()
+        condition = self._async_condition
+
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.concurrency_limit))
+            self.in_flight += 1
+        try:
+            with record_request(method, count):
+                yield
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify()
+
+    async def async_on_success(self) -> None:
+        """`on_success`, also waking the coroutines waiting for the slots it adds"""
+        limit = int(self.concurrency_limit)
+        self.on_success()
+        if self._async_condition is not None and int(self.concurrency_limit) > limit:
+            async with self._async_condition:
+                self._async_condition.notify_all()
+
+    async def async_call(self, method: str, run: Callable[[], Awaitable[T]], count: int = 1) -> T:
+        attempt = 0
+        while True:
+            try:
+                async with self.async_slot(method, count):
+                    result = await run()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                if is_throttled(e):
+                    self.on_throttled()
+                self.retried += 1
+                delay = self.backoff_delay(attempt)
+                console.log(f"[yellow] Retrying {method} in {delay:.2f}s After {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                await self.async_on_success()
+                return result
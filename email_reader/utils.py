@@ -0,0 +1,16 @@
+from __future__ import annotations
+
+from itertools import islice
+from typing import Iterable, Iterator, List, TypeVar
+
+T = TypeVar('T')
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """Splits an iterable into lists of at most `size` items without materialising it"""
+    if size < 1:
+        raise ValueError('Chunk size must be at least 1')
+
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -1,19 +1,53 @@
+import io
 import os
+from contextlib import redirect_stdout
+from itertools import islice
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterator, Optional
 
 import pytest
 
-from email_reader.services.gmail import MockGmailService
+# Set before importing the package, the database settings are read from them
+current_dir = Path(__file__).parent
+os.environ['DB_USE_INMEMORY'] = '1'
+os.environ['PY_EMAIL_FILE_PATH'] = (current_dir / Path("static/test_emails.csv")).as_posix()
+os.environ['PY_RULES_FILE_PATH'] = (current_dir / Path("static/rules.json")).as_posix()
 
+from email_reader.database.engine import use_database  # noqa: E402
+from email_reader.services.gmail import MockGmailService  # noqa: E402
 
-def pytest_configure(config: Any) -> None:
-    current_dir = Path(__file__).parent
-    os.environ['DB_USE_INMEMORY'] = '1'
-    os.environ['PY_EMAIL_FILE_PATH'] = (current_dir / Path("static/test_emails.csv")).as_posix()
-    os.environ['PY_RULES_FILE_PATH'] = (current_dir / Path("static/rules.json")).as_posix()
+from .utils.fixtures import Mailbox  # noqa: E402
 
 
 @pytest.fixture(scope='session')
 def service() -> MockGmailService:
     return MockGmailService.create(None)
+
+
+@pytest.fixture
+def mailbox(service: MockGmailService) -> Mailbox:
+    """
+    Builds a mailbox from copies of the first `count` test emails, `fields(index)` gives the fields
+    to set on the email at that index, e.g. its labelIds or threadId
+    """
+    def build(count: int = 40, fields: Optional[Callable[[int], dict[str, Any]]] = None) -> dict[str, dict[str, Any]]:
+        return {
+            msg_id: {**message, **(fields(index) if fields is not None else {})}
+            for index, (msg_id, message) in enumerate(islice(service._service._data.items(), count))
+        }
+    return build
+
+
+@pytest.fixture
+def quiet() -> Iterator[None]:
+    """Silences the console output of the loader and the manager"""
+    with redirect_stdout(io.StringIO()):
+        yield
+
+
+@pytest.fixture
+def database(tmp_path: Path, quiet: None) -> Iterator[str]:
+    """A SQLite database of the test's own in place of the shared in memory one, yields its url"""
+    url = f'sqlite:///{tmp_path / "emails.sqlite"}'
+    with use_database(url):
+        yield url
@@ -8,13 +8,19 @@ from typing import cast
 
 import pytest
 from pydantic_core import ValidationError
+from sqlalchemy import select
 
 from email_reader.loader import load_emails
-from email_reader.logics.filters import Rules
-from email_reader.manager import process_emails
+from email_reader.logics.evaluator import IngestRuleEvaluator
+from email_reader.logics.actions import LabelChange
+from email_reader.logics.filters import FilterCondition, FilterRule, Rules
+from email_reader.logics.planner import RulePlanner
+from email_reader.manager import manage_emails, process_emails
 from email_reader.database.tables.email import Email, MailBox
 from email_reader.database.engine import SessionFactory
-from email_reader.services.gmail import MockGmailService
+from email_reader.metrics import metrics
+from email_reader.services.gmail import EmailAction, MockGmailService
+from .utils.fixtures import Mailbox
 from .utils.paths import RULES_FILE
 
 # from .utils.generate_fake_emails_and_rules import RULES_FILE
@@ -119,3 +125,108 @@ def test_003_filters_and_actions(service: MockGmailService) -> None:
         for any_condition in any_condition_check:
             any_check = cast(Email, session.get(Email, any_condition))
             assert any_check.read is False
+
+
+def test_004_predicates_match_statements() -> None:
+    conditions = [rule.conditions for rule in Rules.from_file(RULES_FILE).rules]
+    conditions += [
+        FilterCondition.model_validate({'operator': operator, 'rules': rules}) for operator, rules in [
+            ('ALL', [{'field': 'subject', 'predicate': 'DoesNotContain', 'value': 'e'}]),
+            ('ALL', [{'field': 'from_name', 'predicate': 'DoesNotContain', 'value': 'x'}]),
+            ('ANY', [{'field': 'body', 'predicate': 'Contains', 'value': 'WH_T%R'},
+                     {'field': 'to_email', 'predicate': 'DoesNotEqual', 'value': 'sarah49@example.com'}]),
+            ('ALL', [{'field': 'date', 'predicate': 'GreaterThan', 'value': '2024-12-01T00:00:00'},
+                     {'field': 'subject', 'predicate': 'Equals', 'value': 'Health compare concern.'}]),
+        ]
+    ]
+
+    with SessionFactory() as session:
+        emails = session.execute(select(*Email.__table__.columns, Email.body.label('body'))).mappings().all()
+
+        for condition in conditions:
+            predicate = condition.get_predicate()
+            expected = set(session.scalars(select(Email.id).where(condition.get_statement())))
+            assert {email['id'] for email in emails if predicate(email)} == expected
+
+
+def test_005_ingest_evaluator(service: MockGmailService) -> None:
+    rules = Rules.from_file(RULES_FILE)
+    relative_rule = FilterRule.model_validate({
+        'name': 'Older than a week', 'actions': [{'type': 'mark_as_read'}],
+        'conditions': {'operator': 'ALL', 'rules': [{'field': 'date', 'predicate': 'LessThan', 'value': '7d'}]},
+    })
+    evaluator = IngestRuleEvaluator(Rules(rules=[*rules.rules, relative_rule]))
+
+    assert evaluator.scanned_rules == [relative_rule]
+
+    rows = [service.parse_message_row(message) for message in service._service._data.values()]
+    evaluator(rows)
+
+    with SessionFactory() as session:
+        scanned_plans = {plan.email['id']: plan for plan in evaluator.planner.plan(session)}
+
+    ingest_plans = {plan.email['id']: plan for plan in evaluator.plans()}
+    assert ingest_plans.keys() == scanned_plans.keys()
+    assert all(plan.actions == scanned_plans[msg_id].actions for msg_id, plan in ingest_plans.items())
+
+
+def test_006_plan_resolves_conflicts() -> None:
+    rules = Rules.model_validate({'rules': [
+        {'name': name, 'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'subject', 'predicate': 'Contains', 'value': 'Invoice'}
+        ]}, 'actions': actions} for name, actions in [
+            ('Spam', [{'type': 'move_message', 'folder': 'SPAM'}, {'type': 'mark_as_read'}]),
+            ('Trash', [{'type': 'move_message', 'folder': 'TRASH'}, {'type': 'mark_as_read'}]),
+            ('Unread', [{'type': 'mark_as_unread'}]),
+        ]
+    ]})
+    planner = RulePlanner(rules)
+
+    plan = planner.plan_email({'id': 'invoice', 'mailbox': MailBox.Inbox, 'read': True}, [0, 1, 2])
+    assert plan.label_change == LabelChange(
+        add_labels=('TRASH', 'UNREAD'), remove_labels=('INBOX',), mailbox=MailBox.Trash, read=False
+    )
+    # The repeated mark_as_read is only listed once
+    assert [action.type for action in plan.actions] == [
+        EmailAction.MoveMessage, EmailAction.MarkAsRead, EmailAction.MoveMessage, EmailAction.MarkAsUnread
+    ]
+
+    sent_plan = planner.plan_email({'id': 'sent', 'mailbox': MailBox.Sent, 'read': False}, [0])
+    assert [(action.folder, error) for action, error in sent_plan.errors] == [(MailBox.Spam, 'CannotMoveEmail')]
+    assert sent_plan.label_change == LabelChange(remove_labels=('UNREAD',), read=True)
+
+    # Nothing to send when the email is already in the target state
+    assert planner.plan_email({'id': 'spam', 'mailbox': MailBox.Spam, 'read': True}, [0]).label_change is None
+
+
+@pytest.mark.usefixtures('database')
+def test_007_evaluated_and_scanned_rules_share_a_plan(service: MockGmailService, mailbox: Mailbox) -> None:
+    emails = mailbox(12, lambda index: {'labelIds': ['INBOX']})
+    msg_ids = list(emails)
+    target = service.parse_message_row(emails[msg_ids[6]])
+    rules = Rules.model_validate({'rules': [
+        {'name': 'Old To Trash', 'actions': [{'type': 'move_message', 'folder': 'TRASH'}],
+         'conditions': {'operator': 'ALL', 'rules': [{'field': 'date', 'predicate': 'LessThan', 'value': '1d'}]}},
+        {'name': 'Sender To Spam', 'actions': [{'type': 'move_message', 'folder': 'SPAM'}],
+         'conditions': {'operator': 'ALL', 'rules': [
+             {'field': 'from_email', 'predicate': 'Equals', 'value': target['from_email']},
+         ]}},
+    ]})
+
+    mock = MockGmailService(None, emails={msg_id: emails[msg_id] for msg_id in msg_ids[:6]})  # type: ignore
+    manage_emails(mock, rules)
+
+    # The sender rule is up to date, the evaluator matches the new emails while the trash rule scans the table
+    for msg_id in msg_ids[6:]:
+        mock._service.add_message(emails[msg_id])
+    metrics.reset()
+    manage_emails(mock, rules)
+
+    # Both are planned together, the last rule wins with a single call per email
+    senders = {
+        msg_id for msg_id, message in emails.items()
+        if service.parse_message_row(message)['from_email'] == target['from_email']
+    }
+    assert {msg_id for msg_id, message in emails.items() if 'SPAM' in message['labelIds']} == senders
+    assert all('TRASH' in message['labelIds'] for msg_id, message in emails.items() if msg_id not in senders)
+    assert metrics.value('gmail_requests_total', method='messages.batchModify') == 2
@@ -0,0 +1,138 @@
+import io
+import types
+from contextlib import redirect_stdout
+from itertools import islice
+from typing import cast
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email, SyncState
+from email_reader.database.tables.email import MailBox
+from email_reader.loader import load_emails
+from email_reader.services.gmail import MockGmailService
+from email_reader.utils import chunked
+
+
+def test_001_list_walks_every_page(service: MockGmailService) -> None:
+    msg_ids = list(service.list_message_ids(page_size=7))
+
+    assert len(msg_ids) == len(service._service._data)
+    assert msg_ids == list(service._service._data)
+
+
+def test_002_get_emails_is_lazy(service: MockGmailService) -> None:
+    emails = service.get_emails()
+
+    assert isinstance(emails, types.GeneratorType)
+    assert next(emails).id == next(iter(service._service._data))
+
+
+def test_003_chunked() -> None:
+    assert [len(chunk) for chunk in chunked(range(1001), 500)] == [500, 500, 1]
+    assert list(chunked([], 10)) == []
+
+
+def test_004_batched_fetch(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 250))
+    batched_service = MockGmailService.create(None, emails=emails, batch_size=100, concurrency=3)
+
+    fetched = [message['id'] for message in batched_service.fetcher.fetch(emails)]
+
+    assert fetched == list(emails)
+    assert batched_service._service.round_trips == 3
+
+
+def test_005_fetch_retries_partial_failures(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 50))
+    flaky_service = MockGmailService.create(None, emails=emails, batch_size=20, concurrency=2)
+    flaky_service.fetcher.backoff = 0
+    flaky_id, other_flaky_id = list(emails)[3], list(emails)[30]
+    flaky_service._service.transient_failures = {flaky_id: 2, other_flaky_id: 1}
+
+    fetched = [message['id'] for message in flaky_service.fetcher.fetch([*emails, 'missing-email'])]
+
+    assert fetched == list(emails)
+    assert list(flaky_service.fetcher.failed_ids) == ['missing-email']
+    # 3 initial batches, 2 retries for the first one and 1 for the second
+    assert flaky_service._service.round_trips == 6
+
+
+def test_006_history_sync(service: MockGmailService) -> None:
+    buffer = io.StringIO()
+    mock = service._service
+
+    # The initial load of test_01 stored the sync cursor
+    with SessionFactory() as session:
+        assert SyncState.get_history_id(session) is not None
+
+    new_id, relabeled_id, deleted_id = 'test-email-new', *islice(mock._data, 10, 12)
+    mock.add_message({**mock._data[relabeled_id], 'id': new_id, 'labelIds': ['INBOX', 'UNREAD']})
+    mock.modify(id=relabeled_id, body={'addLabelIds': ['UNREAD']}).execute()
+    mock.delete_message(deleted_id)
+    round_trips = mock.round_trips
+
+    with redirect_stdout(buffer):
+        added = load_emails(service)
+
+    assert added == 1
+    # One history listing and one batch of messages, no listing of the mailbox
+    assert mock.round_trips - round_trips == 2
+    assert 'Deleted 1 Emails' in buffer.getvalue()
+
+    with SessionFactory() as session:
+        assert cast(Email, session.get(Email, new_id)).read is False
+        assert cast(Email, session.get(Email, relabeled_id)).read is False
+        assert session.get(Email, deleted_id) is None
+        assert SyncState.get_history_id(session) == str(mock._history_id)
+
+
+def test_007_expired_history_runs_full_sync(service: MockGmailService) -> None:
+    buffer = io.StringIO()
+    service._service.expire_history()
+
+    with redirect_stdout(buffer):
+        added = load_emails(service)
+
+    assert 'Sync Cursor Has Expired' in buffer.getvalue()
+    assert added == len(service._service._data)
+
+
+def test_008_bulk_upsert(service: MockGmailService) -> None:
+    existing_id = next(iter(service._service._data))
+    rows = [
+        service.parse_message_row({**service._service._data[existing_id], 'labelIds': ['SPAM']}),
+        service.parse_message_row({**service._service._data[existing_id], 'id': 'test-email-upserted', 'labelIds': []}),
+    ]
+
+    with SessionFactory() as session:
+        assert Email.bulk_upsert(session, rows) == 2
+        session.commit()
+
+    with SessionFactory() as session:
+        assert cast(Email, session.get(Email, existing_id)).mailbox == MailBox.Spam
+        assert cast(Email, session.get(Email, 'test-email-upserted')).mailbox == MailBox.Inbox
+
+
+def test_009_parse_in_process_pool(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 120))
+    pooled_service = MockGmailService.create(None, emails=emails, parse_processes=2)
+    pooled_service.parser.chunk_size = 25
+
+    rows = list(pooled_service.get_email_rows_by_ids(emails))
+
+    assert rows == [service.parse_message_row(message) for message in emails.values()]
+
+
+def test_010_fetch_keeps_unfetched_ids_apart(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 10))
+    flaky_service = MockGmailService.create(None, emails=emails, batch_size=5)
+    flaky_service.fetcher.backoff = 0
+    failing_id = list(emails)[2]
+    flaky_service._service.transient_failures = {failing_id: 100}
+
+    with redirect_stdout(io.StringIO()):
+        fetched = [message['id'] for message in flaky_service.fetcher.fetch([*emails, 'missing-email'])]
+
+    # A deleted message is skipped for good, one still failing after the retries may be fetched later
+    assert fetched == [msg_id for msg_id in emails if msg_id != failing_id]
+    assert list(flaky_service.fetcher.failed_ids) == ['missing-email']
+    assert list(flaky_service.unfetched_ids) == [failing_id]
@@ -0,0 +1,186 @@
+import base64
+import io
+from contextlib import redirect_stdout
+from itertools import islice
+
+import pytest
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables.email import Email, MailBox
+from email_reader.loader import load_emails
+from email_reader.logics.actions import LabelChange, apply_label_changes
+from email_reader.logics.filters import FilterAction, Rules
+from email_reader.manager import manage_emails, process_emails
+from email_reader.services.gmail import EmailAction, MockGmailService
+from email_reader.services.ratelimit import TokenBucket
+
+from .utils.fixtures import Mailbox
+
+
+def test_001_label_changes() -> None:
+    move_to_spam = FilterAction(type=EmailAction.MoveMessage, folder=MailBox.Spam)
+
+    assert move_to_spam.get_label_change(MailBox.Inbox) == (
+        LabelChange(add_labels=('SPAM',), remove_labels=('INBOX',), mailbox=MailBox.Spam), None
+    )
+    assert move_to_spam.get_label_change(MailBox.Spam) == (None, None)
+    assert move_to_spam.get_label_change(MailBox.Sent) == (None, 'CannotMoveEmail')
+
+    move_to_trash = FilterAction(type=EmailAction.MoveMessage, folder=MailBox.Trash)
+    assert move_to_trash.get_label_change(MailBox.Sent) == (
+        LabelChange(add_labels=('TRASH',), mailbox=MailBox.Trash), None
+    )
+
+    mark_as_read = FilterAction(type=EmailAction.MarkAsRead)
+    assert mark_as_read.get_label_change(MailBox.Inbox) == (LabelChange(remove_labels=('UNREAD',), read=True), None)
+
+
+def test_002_batch_modify_chunks(service: MockGmailService) -> None:
+    msg_ids = list(islice(service._service._data, 250))
+    mark_as_unread = LabelChange(add_labels=('UNREAD',), read=False)
+    round_trips = service._service.round_trips
+    service.batch_modify_limit = 100
+
+    try:
+        with SessionFactory() as session:
+            results = list(apply_label_changes(service, session, {mark_as_unread: msg_ids}))
+    finally:
+        del service.batch_modify_limit
+
+    assert [(len(chunk), error) for chunk, _, error in results] == [(100, None), (100, None), (50, None)]
+    assert service._service.round_trips - round_trips == 3
+
+    with SessionFactory() as session:
+        assert all(session.get(Email, msg_id).read is False for msg_id in msg_ids)
+    assert all('UNREAD' in service._service._data[msg_id]['labelIds'] for msg_id in msg_ids)
+
+
+def watermark_rule(action: str) -> Rules:
+    return Rules.model_validate({'rules': [{
+        'name': 'Watermark', 'actions': [{'type': action}],
+        'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'subject', 'predicate': 'Contains', 'value': 'Watermark'}
+        ]},
+    }]})
+
+
+def test_003_rule_watermarks(service: MockGmailService) -> None:
+    mock = service._service
+    template = next(iter(mock._data.values()))
+
+    def add_email(msg_id: str) -> None:
+        raw = base64.urlsafe_b64decode(template['raw']).replace(b'Subject: ', b'Subject: Watermark ')
+        mock.add_message({**template, 'id': msg_id, 'raw': base64.urlsafe_b64encode(raw).decode(), 'labelIds': []})
+
+    def modified_ids(rules: Rules) -> list[str]:
+        history_length = len(mock._history)
+        with redirect_stdout(io.StringIO()):
+            process_emails(service, rules=rules)
+        return [record['labelsAdded'][0]['message']['id'] for record in mock._history[history_length:]]
+
+    add_email('watermark-1')
+    with redirect_stdout(io.StringIO()):
+        load_emails(service)
+
+    assert modified_ids(watermark_rule('mark_as_unread')) == ['watermark-1']
+    # Nothing new since the last run, the rule is skipped
+    assert modified_ids(watermark_rule('mark_as_unread')) == []
+
+    add_email('watermark-2')
+    with redirect_stdout(io.StringIO()):
+        load_emails(service)
+
+    assert modified_ids(watermark_rule('mark_as_unread')) == ['watermark-2']
+
+    # Editing the rule changes its fingerprint, so every email is processed again
+    history_length = len(mock._history)
+    with redirect_stdout(io.StringIO()):
+        process_emails(service, rules=watermark_rule('mark_as_read'))
+    assert sorted(record['labelsRemoved'][0]['message']['id'] for record in mock._history[history_length:]) == [
+        'watermark-1', 'watermark-2'
+    ]
+
+
+def test_004_no_op_actions_and_dry_run(service: MockGmailService) -> None:
+    mock = service._service
+
+    # Both emails were marked as read by the previous test, so there is nothing left to do
+    history_length, round_trips = len(mock._history), mock.round_trips
+    with redirect_stdout(io.StringIO()):
+        process_emails(service, rules=watermark_rule('mark_as_read'), use_watermarks=False)
+    assert service.alter_email_read_state('watermark-1', EmailAction.MarkAsRead) == (True, None)
+    assert service.move_email('watermark-1', MailBox.Inbox) == (True, None)
+    assert (len(mock._history), mock.round_trips) == (history_length, round_trips)
+
+    output = io.StringIO()
+    with redirect_stdout(output):
+        process_emails(service, rules=watermark_rule('mark_as_unread'), use_watermarks=False, dry_run=True)
+    assert '2 Emails Matched, 2 To Change With 1 API Calls, 0 Already Up To Date' in output.getvalue()
+    assert (len(mock._history), mock.round_trips) == (history_length, round_trips)
+
+    with SessionFactory() as session:
+        assert session.get(Email, 'watermark-1').read is True
+        assert session.get(Email, 'watermark-2').read is True
+
+
+def test_005_token_bucket() -> None:
+    now = [0.0]
+
+    def sleep(seconds: float) -> None:
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=10, clock=lambda: now[0], sleep=sleep)
+
+    assert bucket.acquire(10) == 0
+    assert bucket.acquire(5) == pytest.approx(0.5)
+    # A request over the capacity waits for a full bucket and leaves it in debt
+    assert bucket.acquire(50) == pytest.approx(1.0)
+    assert bucket.acquire(10) == pytest.approx(5.0)
+
+
+def test_006_throttled_requests_are_retried(service: MockGmailService) -> None:
+    throttled_service = MockGmailService.create(None, emails=dict(islice(service._service._data.items(), 10)))
+    mock, scheduler = throttled_service._service, throttled_service.scheduler
+    throttled_service.fetcher.backoff = 0
+    msg_ids = list(mock._data)
+    mock.throttled_requests = 2
+
+    with redirect_stdout(io.StringIO()):
+        assert throttled_service.batch_modify(msg_ids, add_labels=['UNREAD']) == (True, None)
+    assert (scheduler.throttled, scheduler.retried, mock.round_trips) == (2, 2, 3)
+    assert scheduler.concurrency_limit < scheduler.max_concurrency
+
+    # Fetches are throttled as a whole batch and retried the same way
+    mock.throttled_requests = 1
+    with redirect_stdout(io.StringIO()):
+        assert [message['id'] for message in throttled_service.fetcher.fetch(msg_ids)] == msg_ids
+    assert scheduler.throttled == 3
+
+    mock.throttled_requests = scheduler.max_retries + 1
+    with redirect_stdout(io.StringIO()):
+        success, error = throttled_service.batch_modify(msg_ids, remove_labels=['UNREAD'])
+    assert not success and '429' in str(error)
+
+
+@pytest.mark.usefixtures('database')
+def test_007_relabeled_emails_are_evaluated(service: MockGmailService, mailbox: Mailbox) -> None:
+    emails = mailbox(12, lambda index: {'labelIds': ['INBOX']})
+    target = service.parse_message_row(next(iter(emails.values())))
+    rules = Rules.model_validate({'rules': [{
+        'name': 'Sender To Spam', 'actions': [{'type': 'move_message', 'folder': 'SPAM'}],
+        'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'from_email', 'predicate': 'Equals', 'value': target['from_email']},
+        ]},
+    }]})
+
+    mock = MockGmailService(None, emails=emails)  # type: ignore
+    manage_emails(mock, rules)
+    assert 'SPAM' in emails[target['id']]['labelIds']
+
+    # Moved back by the user, the rule sees the relabeled email on the next run as it would without the evaluator
+    mock._service.change_labels(target['id'], ['INBOX'], ['SPAM'])
+    manage_emails(mock, rules)
+    assert 'SPAM' in emails[target['id']]['labelIds']
+
+    with SessionFactory() as session:
+        assert session.get(Email, target['id']).mailbox == MailBox.Spam
@@ -0,0 +1,178 @@
+import sqlite3
+from itertools import islice
+from pathlib import Path
+
+import pytest
+from sqlalchemy import inspect, select, text
+from sqlalchemy.orm import Session
+
+from email_reader.database import engine as engine_module
+from email_reader.database.compression import CODECS
+from email_reader.database.config import DatabaseConfig
+from email_reader.database.engine import create_engine_from_config
+from email_reader.database.search import match_statement
+from email_reader.database.tables import Email, EmailBody, EmailLabel
+from email_reader.logics import filters
+from email_reader.logics.filters import FilterCondition
+from email_reader.services.gmail import MockGmailService
+
+
+def test_001_config_from_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv('DB_USE_INMEMORY')
+    monkeypatch.setenv('EMAIL_READER_DB_URL', 'postgresql://localhost/emails')
+    monkeypatch.setenv('EMAIL_READER_DB_POOL_SIZE', '20')
+    monkeypatch.setenv('EMAIL_READER_DB_ECHO', 'debug')
+
+    config = DatabaseConfig.from_env()
+
+    assert config == DatabaseConfig(url='postgresql://localhost/emails', pool_size=20, echo='debug')
+    assert not config.is_sqlite
+    assert DatabaseConfig(url='sqlite://').is_memory
+
+
+def test_002_sqlite_pragmas(tmp_path: Path) -> None:
+    config = DatabaseConfig(url=f'sqlite:///{tmp_path / "emails.sqlite"}', sqlite_cache_size=1024)
+    engine = create_engine_from_config(config)
+
+    with engine.connect() as connection:
+        assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+        assert connection.execute(text('PRAGMA cache_size')).scalar() == -1024
+
+    engine.dispose()
+
+
+def test_003_search_index(tmp_path: Path, service: MockGmailService, monkeypatch: pytest.MonkeyPatch) -> None:
+    engine = create_engine_from_config(DatabaseConfig(url=f'sqlite:///{tmp_path / "emails.sqlite"}', search_index=True))
+    rows = [service.parse_message_row(message) for message in islice(service._service._data.values(), 300)]
+
+    with Session(engine) as session:
+        Email.bulk_upsert(session, rows)
+        Email.bulk_delete(session, [rows[0]['id']])
+        session.commit()
+
+        for field, value in [('subject', 'CONSIDER'), ('body', 'whether'), ('body', 'al. ')]:
+            like_ids = session.scalars(select(Email.id).where(getattr(Email, field).contains(value))).all()
+            match_ids = session.scalars(select(Email.id).where(match_statement(field, value))).all()
+            assert like_ids
+            assert sorted(like_ids) == sorted(match_ids)
+
+    monkeypatch.setattr(filters, 'can_search', lambda field_name, field_value: True)
+    rule = FilterCondition.Rule.model_validate({'field': 'body', 'predicate': 'DoesNotContain', 'value': 'whether'})
+    assert 'MATCH' in str(rule.get_statement())
+
+    engine.dispose()
+
+
+def test_004_upgrade_schema(tmp_path: Path) -> None:
+    db_file = tmp_path / "emails.sqlite"
+    with sqlite3.connect(db_file) as connection:
+        connection.execute(
+            "CREATE TABLE email (id VARCHAR NOT NULL PRIMARY KEY, from_name VARCHAR, from_email VARCHAR NOT NULL, "
+            "to_name VARCHAR, to_email VARCHAR NOT NULL, subject VARCHAR NOT NULL, date DATETIME NOT NULL, "
+            "mailbox VARCHAR(5) NOT NULL, read BOOLEAN NOT NULL, body TEXT NOT NULL)"
+        )
+        connection.execute(
+            "INSERT INTO email VALUES ('old', NULL, 'a@example.com', NULL, 'b@example.com', 'Old', "
+            "'2024-01-01 00:00:00.000000', 'Inbox', 1, 'Body'), ('spam', NULL, 'c@example.com', NULL, "
+            "'b@example.com', 'Spam', '2024-01-02 00:00:00.000000', 'Spam', 0, 'Body')"
+        )
+
+    engine = create_engine_from_config(DatabaseConfig(url=f'sqlite:///{db_file}'))
+
+    with Session(engine) as session:
+        assert session.scalar(select(Email.ingest_seq).where(Email.id == 'old')) == 0
+        assert session.scalar(select(Email.body).where(Email.id == 'old')) == 'Body'
+    assert 'ix_email_ingest_seq' in {index['name'] for index in inspect(engine).get_indexes('email')}
+    assert 'body' not in {column['name'] for column in inspect(engine).get_columns('email')}
+
+    # The labels `mailbox` and `read` stand for are stored, once
+    expected = {'old': {'INBOX'}, 'spam': {'SPAM', 'UNREAD'}}
+    with Session(engine) as session:
+        assert EmailLabel.get_labels(session, ['old', 'spam']) == expected
+    engine.dispose()
+
+    engine = create_engine_from_config(DatabaseConfig(url=f'sqlite:///{db_file}'))
+    with Session(engine) as session:
+        assert EmailLabel.get_labels(session, ['old', 'spam']) == expected
+
+    engine.dispose()
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib', 'zstd'])
+def test_005_compressed_bodies(tmp_path: Path, service: MockGmailService, codec: str) -> None:
+    if codec not in CODECS:
+        pytest.skip(f'{codec} is not available')
+
+    engine = create_engine_from_config(DatabaseConfig(url=f'sqlite:///{tmp_path / "emails.sqlite"}', body_codec=codec))
+    rows = [service.parse_message_row(message) for message in islice(service._service._data.values(), 50)]
+    rows[0]['body'] = 'Long Body ' * 100
+
+    with Session(engine) as session:
+        Email.bulk_upsert(session, rows)
+        session.commit()
+
+        content = session.scalar(select(EmailBody.content).where(EmailBody.id == rows[0]['id']))
+        assert content[0] == CODECS[codec][0][0]
+        if codec != 'none':
+            assert len(content) < len(rows[0]['body'])
+
+        # The body is only loaded when it is read
+        email = session.get(Email, rows[0]['id'])
+        assert 'stored_body' not in email.__dict__
+        assert email.body == rows[0]['body']
+
+        stmt = select(Email.id).where(Email.body.contains('Long Body')).order_by(Email.id)
+        assert session.scalars(stmt).all() == [rows[0]['id']]
+
+        # Bodies written through the ORM use the codec of the engine as well
+        email.body = 'New Body ' * 100
+        session.add(Email(**{**rows[1], 'id': 'orm-email', 'body': 'Orm Body ' * 100}))
+        session.commit()
+
+        for msg_id in (rows[0]['id'], 'orm-email'):
+            content = session.scalar(select(EmailBody.content).where(EmailBody.id == msg_id))
+            assert content[0] == CODECS[codec][0][0]
+        assert session.get(Email, 'orm-email').body == 'Orm Body ' * 100
+
+    engine.dispose()
+
+
+@pytest.mark.parametrize('field, predicate, value', [
+    ('subject', 'Contains', 'CONSIDER'),
+    ('subject', 'Contains', '100%'),
+    ('subject', 'Contains', 'abc_def'),
+    ('body', 'Contains', 'KÖLN'),
+    ('body', 'DoesNotContain', 'KÖLN'),
+    ('body', 'DoesNotContain', 'whether'),
+])
+def test_006_search_index_matches_like(
+        tmp_path: Path, service: MockGmailService, monkeypatch: pytest.MonkeyPatch,
+        field: str, predicate: str, value: str) -> None:
+    engine = create_engine_from_config(DatabaseConfig(url=f'sqlite:///{tmp_path / "emails.sqlite"}', search_index=True))
+    monkeypatch.setattr(engine_module, 'get_engine', lambda: engine)
+
+    rows = [service.parse_message_row(message) for message in islice(service._service._data.values(), 100)]
+    # `%` and `_` are wildcards of LIKE, which only folds the case of ASCII letters
+    rows[0]['subject'], rows[1]['subject'] = 'Save 100% Now', 'Save 1000 Now'
+    rows[2]['subject'], rows[3]['subject'] = 'From abc_def', 'From abcxdef'
+    rows[4]['body'], rows[5]['body'] = 'Grüße aus KÖLN', 'Grüße aus köln'
+    # Loaded without its body
+    rows[6]['body'] = None
+
+    rule = FilterCondition.Rule.model_validate({'field': field, 'predicate': predicate, 'value': value})
+    with Session(engine) as session:
+        Email.bulk_upsert(session, rows)
+        session.commit()
+
+        ids = session.scalars(select(Email.id).where(rule.get_statement())).all()
+        matches = rule.get_predicate()
+        assert ids
+        assert sorted(ids) == sorted(row['id'] for row in rows if matches(row))
+
+    # Every value is looked up in the index, the ones it does not find exactly are compared with LIKE as well
+    statement = str(rule.get_statement())
+    assert 'MATCH' in statement
+    assert ('LIKE' in statement) == (value not in ('CONSIDER', 'whether'))
+
+    engine.dispose()
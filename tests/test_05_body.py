@@ -0,0 +1,45 @@
+from email.message import EmailMessage
+
+import pytest
+
+from email_reader.body import BodyExtractor, bs4_html_to_text, html_to_text
+
+NEWSLETTER = '''
+<html><head><title>Weekly</title><style>td { color: red; }</style></head>
+<body><script>track();</script>
+<table><tr><td>Hello &amp; welcome</td><td>  </td></tr><tr><td>Deals <b>this</b> week</td></tr></table>
+<!-- footer --><p>Unsubscribe</p></body></html>
+'''
+
+
+def newsletter(plain: str = '') -> EmailMessage:
+    message = EmailMessage()
+    message['Subject'] = 'Weekly'
+    if plain:
+        message.set_content(plain)
+        message.add_alternative(NEWSLETTER, subtype='html')
+    else:
+        message.set_content(NEWSLETTER, subtype='html')
+    message.add_attachment(b'Attachment Text', maintype='text', subtype='plain', filename='notes.txt')
+    return message
+
+
+def test_001_html_to_text() -> None:
+    assert html_to_text(NEWSLETTER) == 'Weekly\nHello & welcome\nDeals\nthis\nweek\nUnsubscribe'
+    assert html_to_text(NEWSLETTER, max_length=10) == 'Weekly\nHel'
+
+    pytest.importorskip('bs4')
+    assert html_to_text(NEWSLETTER) == bs4_html_to_text(NEWSLETTER)
+
+
+def test_002_body_extractor() -> None:
+    extractor = BodyExtractor()
+
+    # The text/plain part wins over the html one and attachments are never used
+    assert extractor(newsletter(plain='Plain Body\n')) == 'Plain Body'
+    assert extractor(newsletter(plain='  \n')) == html_to_text(NEWSLETTER)
+    assert extractor(newsletter()) == html_to_text(NEWSLETTER)
+    assert BodyExtractor(max_length=5)(newsletter(plain='Plain Body')) == 'Plain'
+
+    with pytest.raises(ValueError):
+        BodyExtractor(html_parser='lxml')
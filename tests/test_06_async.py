@@ -0,0 +1,123 @@
+import asyncio
+import io
+import time
+from contextlib import redirect_stdout
+from itertools import islice
+from typing import cast
+
+import pytest
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email, SyncState
+from email_reader.database.tables.email import MailBox
+from email_reader.logics.filters import Rules
+from email_reader.services.gmail import EmailAction, MockGmailService
+
+pytest.importorskip('httpx')
+
+from email_reader.loader import load_emails_async  # noqa: E402
+from email_reader.manager import process_emails_async  # noqa: E402
+from email_reader.services.async_gmail import AsyncMockGmailService  # noqa: E402
+from email_reader.services.ratelimit import AsyncRequestScheduler  # noqa: E402
+
+
+def test_001_requests_in_flight(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 300))
+    async_service = AsyncMockGmailService(emails={**emails}, latency=0.1, concurrency=200)
+
+    async def fetch() -> list[dict]:
+        async with async_service:
+            return [row async for row in async_service.get_email_rows_by_ids([*emails, 'missing-email'])]
+
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        rows = asyncio.run(fetch())
+
+    assert rows == [service.parse_message_row(message) for message in emails.values()]
+    assert list(async_service.failed_ids) == ['missing-email']
+    assert async_service.max_in_flight == 200
+    # Two rounds of 0.1s rather than 301 sequential requests
+    assert time.perf_counter() - started < 5
+
+
+def test_002_async_load_and_actions(service: MockGmailService) -> None:
+    emails = {msg_id: {**message} for msg_id, message in islice(service._service._data.items(), 20)}
+    async_service = AsyncMockGmailService(emails=emails)
+    mock = async_service._service
+    template = next(iter(emails.values()))
+    rules = Rules.model_validate({'rules': [{
+        'name': 'Async', 'actions': [{'type': 'move_message', 'folder': 'SPAM'}],
+        'conditions': {'operator': 'ALL', 'rules': [{'field': 'from_email', 'predicate': 'Equals', 'value': 'x@y.z'}]},
+    }]})
+
+    async def run() -> None:
+        async with async_service:
+            with SessionFactory() as session:
+                SyncState.set_history_id(session, await async_service.get_history_id())
+                session.commit()
+
+            mock.add_message({**template, 'id': 'async-email', 'labelIds': ['INBOX']})
+            assert await load_emails_async(async_service) == 1
+
+            with SessionFactory() as session:
+                session.get(Email, 'async-email').from_email = 'x@y.z'
+                session.commit()
+            await process_emails_async(async_service, rules=rules)
+
+            mock.throttled_requests = 2
+            assert await async_service.alter_email_read_state('async-email', EmailAction.MarkAsUnread) == (True, None)
+            assert await async_service.move_email('async-email', MailBox.Spam) == (True, None)
+
+    with redirect_stdout(io.StringIO()):
+        asyncio.run(run())
+
+    assert mock._data['async-email']['labelIds'] == ['SPAM', 'UNREAD']
+    assert async_service.scheduler.throttled == 2
+    with SessionFactory() as session:
+        email = cast(Email, session.get(Email, 'async-email'))
+        assert (email.mailbox, email.read) == (MailBox.Spam, False)
+
+
+def test_003_grown_concurrency_wakes_waiting_requests() -> None:
+    scheduler = AsyncRequestScheduler(units_per_second=None, concurrency=4)
+    scheduler.concurrency_limit = 1.0
+
+    async def run() -> None:
+        release = asyncio.Event()
+
+        async def hold() -> None:
+            await release.wait()
+
+        async def waiting() -> None:
+            release.set()
+
+        holder = asyncio.create_task(scheduler.async_call('messages.get', hold))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.async_call('messages.get', waiting))
+        await asyncio.sleep(0)
+        assert scheduler.in_flight == 1
+
+        # The second slot is taken while the first one is still held
+        await scheduler.async_on_success()
+        await asyncio.wait_for(asyncio.gather(holder, waiter), timeout=1)
+
+    asyncio.run(run())
+    assert scheduler.in_flight == 0
+
+
+def test_004_unfetched_ids(service: MockGmailService) -> None:
+    emails = dict(islice(service._service._data.items(), 10))
+    async_service = AsyncMockGmailService(emails=emails)
+    failing_id = list(emails)[2]
+    async_service._service.transient_failures = {failing_id: 100}
+
+    async def fetch() -> list[str]:
+        async with async_service:
+            return [row['id'] async for row in async_service.get_email_rows_by_ids([*emails, 'missing-email'])]
+
+    with redirect_stdout(io.StringIO()):
+        fetched = asyncio.run(fetch())
+
+    assert fetched == [msg_id for msg_id in emails if msg_id != failing_id]
+    assert list(async_service.failed_ids) == ['missing-email']
+    assert list(async_service.unfetched_ids) == [failing_id]
@@ -0,0 +1,49 @@
+from benchmarks.pipeline import compare, percentile
+from benchmarks.synthetic import SyntheticMailbox, synthetic_rules
+from email_reader.logics.filters import Rules
+from email_reader.services.gmail import MockGmailService
+
+
+def test_001_synthetic_mailbox_is_deterministic() -> None:
+    mailbox = SyntheticMailbox(50, seed=3)
+
+    assert len(mailbox) == len(list(mailbox)) == 50
+    assert mailbox[mailbox.message_id(7)] == SyntheticMailbox(50, seed=3)[mailbox.message_id(7)]
+    assert mailbox[mailbox.message_id(7)] != SyntheticMailbox(50, seed=4)[mailbox.message_id(7)]
+    assert mailbox.get(mailbox.message_id(50)) is None
+
+    added = mailbox.generate(50)
+    mailbox[added['id']] = added
+    del mailbox[mailbox.message_id(0)]
+    assert len(mailbox) == len(list(mailbox)) == 50
+    assert list(mailbox)[-1] == added['id'] and mailbox.message_id(0) not in mailbox
+
+    assert synthetic_rules(20, seed=1) == synthetic_rules(20, seed=1)
+    assert len(Rules.model_validate(synthetic_rules(20, seed=1)).rules) == 20
+
+
+def test_002_mock_service_serves_synthetic_mailbox() -> None:
+    mailbox = SyntheticMailbox(120, html_ratio=0.3, multipart_ratio=0.3)
+    service = MockGmailService(None, emails=mailbox, latency=lambda: 0.0, batch_size=25)  # type: ignore[arg-type]
+
+    rows = list(service.get_email_rows())
+    assert [row['id'] for row in rows] == list(mailbox)
+    assert all(row['body'] and row['subject'] and row['from_email'] for row in rows)
+
+    # Label changes stick although the mailbox generates its messages
+    msg_id = mailbox.message_id(5)
+    service._service.change_labels(msg_id, ['SPAM'], [])
+    assert 'SPAM' in mailbox[msg_id]['labelIds']
+
+
+def test_003_compare_results() -> None:
+    assert percentile([], 0.5) == 0.0
+    assert percentile([float(value) for value in range(1, 101)], 0.99) == 99.0
+
+    baseline = {'stages': {'full load': {'items_per_second': 1000.0, 'peak_rss_mb': 100.0}}}
+    results = {'stages': {
+        'full load': {'items_per_second': 950.0, 'peak_rss_mb': 130.0},
+        'process rules': {'items_per_second': 10.0, 'peak_rss_mb': 100.0},
+    }}
+    regressions = compare(results, baseline, threshold=0.1)
+    assert len(regressions) == 1 and 'Peak RSS' in regressions[0]
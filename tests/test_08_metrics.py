@@ -0,0 +1,64 @@
+import io
+import json
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from email_reader.loader import load_emails
+from email_reader.logics.filters import Rules
+from email_reader.manager import process_emails
+from email_reader.metrics import Metrics, metrics
+from email_reader.services.gmail import MockGmailService
+
+
+def test_001_prometheus_text() -> None:
+    registry = Metrics()
+    registry.inc('gmail_requests_total', 3, method='messages.get')
+    registry.inc('rule_matches_total', rule='Say "Hi"')
+    for seconds in (0.002, 0.02, 0.02, 120.0):
+        registry.observe('gmail_request_seconds', seconds, method='messages.get')
+
+    text = registry.to_prometheus()
+    assert '# TYPE email_reader_gmail_requests_total counter' in text
+    assert 'email_reader_gmail_requests_total{method="messages.get"} 3' in text
+    assert 'email_reader_rule_matches_total{rule="Say \\"Hi\\""} 1' in text
+    assert 'email_reader_gmail_request_seconds_bucket{method="messages.get",le="0.005"} 1' in text
+    assert 'email_reader_gmail_request_seconds_bucket{method="messages.get",le="60"} 3' in text
+    assert 'email_reader_gmail_request_seconds_bucket{method="messages.get",le="+Inf"} 4' in text
+    assert 'email_reader_gmail_request_seconds_count{method="messages.get"} 4' in text
+
+    histogram = registry.histogram('gmail_request_seconds', method='messages.get')
+    assert (histogram.quantile(0.5), histogram.quantile(0.99)) == (0.025, 60.0)
+
+
+def test_002_load_and_process_metrics(service: MockGmailService, tmp_path: Path) -> None:
+    rules = Rules.model_validate({'rules': [{
+        'name': 'Metrics', 'actions': [{'type': 'mark_as_read'}],
+        'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'subject', 'predicate': 'Contains', 'value': 'Health them end physical'}
+        ]},
+    }]})
+    metrics.reset()
+
+    with redirect_stdout(io.StringIO()):
+        total = load_emails(service, since_last_commit=False)
+        process_emails(service, rules=rules, use_watermarks=False)
+
+    assert metrics.value('gmail_requests_total', method='messages.get') == total
+    assert metrics.value('emails_parsed_total') == metrics.value('emails_written_total') == total
+    assert metrics.value('gmail_fetched_bytes_total') > 0
+    assert metrics.histogram('db_write_seconds').count >= 1
+    assert metrics.histogram('rule_query_seconds').count == 1
+    matches = metrics.value('rule_matches_total', rule='Metrics')
+    assert matches >= 1
+    # Every match has a single action, emails added by other tests are unknown to the service and fail
+    results = ('succeeded', 'unchanged', 'failed')
+    assert sum(metrics.value('actions_total', result=result) for result in results) == matches
+    assert metrics.histogram('stage_seconds', stage='load').count == 1
+
+    metrics.write(tmp_path / 'metrics.json')
+    summary = json.loads((tmp_path / 'metrics.json').read_text())
+    assert {'gmail_requests_total', 'actions_total'} <= summary['counters'].keys()
+    assert summary['histograms']['stage_seconds'][0]['count'] == 1
+
+    metrics.write(tmp_path / 'metrics.prom')
+    assert 'email_reader_emails_written_total' in (tmp_path / 'metrics.prom').read_text()
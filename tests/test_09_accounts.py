@@ -0,0 +1,71 @@
+from pathlib import Path
+
+import pytest
+from pydantic import ValidationError
+from sqlalchemy import func, select
+
+from email_reader.accounts import Account, Accounts, run_accounts
+from email_reader.database.engine import SessionFactory, use_database
+from email_reader.database.tables import Email, SyncState
+from email_reader.loader import load_accounts
+from email_reader.manager import manage_accounts
+from email_reader.services.gmail import MockGmailService
+
+
+def accounts(tmp_path: Path, *names: str) -> list[Account]:
+    credentials_file = tmp_path / 'credentials.json'
+    return [
+        Account(name=name, credentials_file=credentials_file, database_url=f'sqlite:///{tmp_path / name}.db')
+        for name in names
+    ]
+
+
+def test_001_accounts_file(tmp_path: Path) -> None:
+    account = Account(name='me@example.com', credentials_file=tmp_path / 'credentials.json')
+    assert account.get_token_file() == tmp_path / 'token-me@example.com.json'
+    assert account.get_database_url().endswith('/accounts/me@example.com.sqlite')
+
+    with pytest.raises(ValidationError):
+        Account(name='../me', credentials_file=tmp_path / 'credentials.json')
+    with pytest.raises(ValidationError, match='Unique'):
+        Accounts(accounts=accounts(tmp_path, 'work', 'work'))
+
+
+@pytest.mark.usefixtures('quiet')
+def test_002_accounts_are_loaded_into_their_own_database(tmp_path: Path) -> None:
+    work, home = accounts(tmp_path, 'work', 'home')
+
+    results = load_accounts([work, home], parallel=2, service_class=MockGmailService)
+
+    expected = len(MockGmailService.read_emails_file())
+    assert results == {'work': expected, 'home': expected}
+
+    for account in (work, home):
+        with use_database(account.get_database_url()), SessionFactory() as session:
+            assert session.scalar(select(func.count()).select_from(Email)) == expected
+            assert SyncState.get_history_id(session) is not None
+
+
+@pytest.mark.usefixtures('quiet')
+def test_003_failing_account_does_not_stop_the_others(tmp_path: Path) -> None:
+    def task(account: Account) -> str:
+        if account.name == 'broken':
+            raise RuntimeError('Token Revoked')
+        with SessionFactory() as session:
+            return str(session.get_bind().url)
+
+    results = run_accounts(accounts(tmp_path, 'broken', 'work'), task)
+
+    assert isinstance(results['broken'], RuntimeError)
+    assert results['work'] == f'sqlite:///{tmp_path / "work"}.db'
+
+
+@pytest.mark.usefixtures('quiet')
+def test_004_manage_accounts(tmp_path: Path) -> None:
+    rules_file = Path(__file__).parent / 'static/rules.json'
+
+    results = manage_accounts(
+        accounts(tmp_path, 'work', 'home'), rules_file, parallel=2, service_class=MockGmailService
+    )
+
+    assert results == {'work': None, 'home': None}
@@ -0,0 +1,79 @@
+import datetime
+import io
+import json
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from pydantic import ValidationError
+
+from email_reader.daemon import EmailDaemon, RulesFile, TokenRefresher
+from email_reader.services.gmail import MockGmailService
+
+
+def write_rules(path: Path, *subjects: str) -> None:
+    path.write_text(json.dumps({'rules': [
+        {
+            'name': f'Daemon {subject}', 'actions': [{'type': 'mark_as_read'}],
+            'conditions': {
+                'operator': 'ALL', 'rules': [{'field': 'subject', 'predicate': 'Contains', 'value': subject}]
+            },
+        }
+        for subject in subjects
+    ]}))
+
+
+def test_001_rules_file_reloads_on_change(tmp_path: Path) -> None:
+    path = tmp_path / 'rules.json'
+    write_rules(path, 'Invoice')
+    rules_file = RulesFile(path)
+
+    rules = rules_file.get()
+    assert rules_file.get() is rules
+
+    write_rules(path, 'Invoice', 'Receipt')
+    with redirect_stdout(io.StringIO()):
+        assert len(rules_file.get().rules) == 2
+
+        # An invalid edit keeps the rules in use
+        path.write_text('{"rules": [')
+        assert len(rules_file.get().rules) == 2
+
+    with pytest.raises(ValidationError):
+        RulesFile(path).get()
+
+
+def test_002_token_refresher() -> None:
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    assert TokenRefresher(SimpleNamespace(expiry=now + datetime.timedelta(minutes=2))).expires_soon()
+    assert not TokenRefresher(SimpleNamespace(expiry=now + datetime.timedelta(hours=1))).expires_soon()
+    assert not TokenRefresher(SimpleNamespace(expiry=None)).expires_soon()
+
+
+def test_003_daemon_loop(service: MockGmailService, tmp_path: Path) -> None:
+    path = tmp_path / 'rules.json'
+    write_rules(path, 'Invoice')
+    sleeps: list[float] = []
+
+    def sleep(seconds: float) -> bool:
+        sleeps.append(seconds)
+        # Edited between two runs, the next run uses the new rules
+        write_rules(path, 'Invoice', 'Receipt')
+        return False
+
+    daemon = EmailDaemon(service, path, interval=30, sleep=sleep, metrics_file=tmp_path / 'metrics.prom')
+    with redirect_stdout(io.StringIO()):
+        daemon.serve(max_iterations=2)
+
+    assert (daemon.iterations, daemon.failures) == (2, 0)
+    assert len(sleeps) == 1 and 0 < sleeps[0] <= 30
+    assert len(daemon.rules.get().rules) == 2
+    assert 'email_reader_stage_seconds' in (tmp_path / 'metrics.prom').read_text()
+
+    # A failing run is logged and the daemon keeps going
+    path.unlink()
+    with redirect_stdout(io.StringIO()):
+        assert daemon.run_once() is False
+    assert daemon.failures == 1
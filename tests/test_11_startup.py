@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+from email_reader.services import discovery
+from email_reader.services.discovery import build_service, cached_document, get_discovery_document
+
+IMPORT_CHECK = '''
+import sys
+import email_reader.loader, email_reader.manager
+from email_reader.database import engine
+deferred = ['googleapiclient.discovery', 'google_auth_oauthlib', 'requests', 'httplib2', 'rich.table']
+print([module for module in deferred if module in sys.modules], engine._engine)
+'''
+
+
+def test_001_importing_the_commands_defers_the_clients() -> None:
+    env = {**os.environ, 'EMAIL_READER_DB_URL': 'sqlite:///:memory:'}
+    output = subprocess.run([sys.executable, '-c', IMPORT_CHECK], env=env, capture_output=True, text=True, check=True)
+
+    assert output.stdout.split() == ['[]', 'None']
+
+
+def test_002_discovery_document_is_read_once() -> None:
+    document = get_discovery_document()
+    assert document['name'] == 'gmail'
+    assert get_discovery_document() is document
+
+    service = build_service(Credentials(token='token'))
+    assert service.users().messages().get(userId='me', id='1').uri.endswith('/users/me/messages/1?alt=json')
+
+
+def test_003_cached_discovery_document(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    downloads = []
+
+    def download(api: str, version: str) -> str:
+        downloads.append(api)
+        if len(downloads) > 1:
+            raise ConnectionError('Offline')
+        return '{"name": "gmail"}'
+
+    monkeypatch.setattr(discovery, 'download_document', download)
+
+    assert cached_document('gmail', 'v1', tmp_path) == '{"name": "gmail"}'
+    assert cached_document('gmail', 'v1', tmp_path) == '{"name": "gmail"}'
+    assert len(downloads) == 1
+
+    # A week old copy is downloaded again, and still used when the download fails
+    stale = time.time() - discovery.MAX_CACHE_AGE - 1
+    os.utime(tmp_path / 'gmail.v1.json', (stale, stale))
+    assert cached_document('gmail', 'v1', tmp_path) == '{"name": "gmail"}'
+    assert len(downloads) == 2
@@ -0,0 +1,74 @@
+import datetime
+import time
+from email.message import Message
+
+import pytest
+from sqlalchemy import select
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email
+from email_reader.loader import load_emails
+from email_reader.logics.filters import Rules
+from email_reader.manager import manage_emails
+from email_reader.metrics import metrics
+from email_reader.services.gmail import MockGmailService
+
+from .utils.fixtures import Mailbox
+
+
+def test_001_metadata_rows(service: MockGmailService, mailbox: Mailbox) -> None:
+    emails = mailbox()
+    full_rows = [service.parse_message_row(message) for message in emails.values()]
+
+    metrics.reset()
+    rows = list(MockGmailService(None, emails=emails, metadata_only=True).get_email_rows_by_ids(emails))  # type: ignore
+
+    assert [{**row, 'body': None, 'body_fetched': False} for row in full_rows] == rows
+    assert 0 < metrics.value('gmail_fetched_bytes_total') < sum(len(message['raw']) for message in emails.values())
+
+
+@pytest.mark.usefixtures('database')
+def test_002_bodies_are_fetched_for_body_rules(service: MockGmailService, mailbox: Mailbox) -> None:
+    emails = mailbox()
+    full_rows = {row['id']: row for row in map(service.parse_message_row, emails.values())}
+    target = next(row for row in full_rows.values() if row['body'])
+    word = target['body'].split()[0]
+
+    rules = Rules.model_validate({'rules': [{
+        'name': 'Body', 'actions': [{'type': 'move_message', 'folder': 'SPAM'}],
+        'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'from_email', 'predicate': 'Equals', 'value': target['from_email']},
+            {'field': 'body', 'predicate': 'Contains', 'value': word},
+        ]},
+    }]})
+    candidates = {msg_id for msg_id, row in full_rows.items() if row['from_email'] == target['from_email']}
+    expected = {msg_id for msg_id in candidates if word.lower() in (full_rows[msg_id]['body'] or '').lower()}
+
+    metadata_service = MockGmailService(None, emails=emails, metadata_only=True)  # type: ignore
+    manage_emails(metadata_service, rules)
+
+    with SessionFactory() as session:
+        fetched = set(session.scalars(select(Email.id).where(Email.body_fetched)))
+        assert fetched == candidates
+        assert session.scalar(select(Email.body).where(Email.id == target['id'])) == target['body']
+
+        # Loading again without bodies keeps the ones already fetched
+        load_emails(metadata_service, since_last_commit=False)
+        assert set(session.scalars(select(Email.id).where(Email.body_fetched))) == candidates
+
+    assert {msg_id for msg_id, message in emails.items() if 'SPAM' in message.get('labelIds', [])} == expected
+
+
+@pytest.mark.parametrize('date', ['Mon, 1 Jan 2024 12:00:00 -0000', 'Mon, 1 Jan 2024 07:00:00 -0500'])
+def test_003_dates_are_stored_in_utc(monkeypatch: pytest.MonkeyPatch, date: str) -> None:
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    headers = Message()
+    headers['From'], headers['To'], headers['Subject'], headers['Date'] = 'a@b.c', 'd@e.f', 'Date', date
+    try:
+        row = Email.row_from_headers(headers, 'dated-email', ['INBOX'])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+    assert row['date'] == datetime.datetime(2024, 1, 1, 12, 0)
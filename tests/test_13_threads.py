@@ -0,0 +1,99 @@
+from typing import Any
+
+import pytest
+from sqlalchemy import select
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email
+from email_reader.database.tables.email import MailBox
+from email_reader.loader import load_emails
+from email_reader.logics.actions import LabelChange, apply_label_changes
+from email_reader.logics.filters import Rules
+from email_reader.manager import manage_emails
+from email_reader.metrics import metrics
+from email_reader.services.gmail import MockGmailService
+
+from .utils.fixtures import Mailbox
+
+
+def in_threads(index: int) -> dict[str, Any]:
+    """Unread inbox emails, three per thread"""
+    return {'labelIds': ['INBOX', 'UNREAD'], 'threadId': f'thread-{index // 3}'}
+
+
+def thread_rule(subject: str) -> Rules:
+    return Rules.model_validate({'rules': [{
+        'name': 'Conversation', 'actions': [{'type': 'mark_as_read'}, {'type': 'move_message', 'folder': 'SPAM'}],
+        'conditions': {'operator': 'ALL', 'scope': 'thread', 'rules': [
+            {'field': 'subject', 'predicate': 'Equals', 'value': subject},
+        ]},
+    }]})
+
+
+def test_001_thread_ids_are_stored(mailbox: Mailbox) -> None:
+    emails = mailbox(12, in_threads)
+
+    rows = list(MockGmailService(None, emails=emails).get_email_rows_by_ids(emails))  # type: ignore
+    metadata_service = MockGmailService(None, emails=emails, metadata_only=True)  # type: ignore
+    metadata_rows = list(metadata_service.get_email_rows_by_ids(emails))
+
+    thread_ids = [message['threadId'] for message in emails.values()]
+    assert [row['thread_id'] for row in rows] == [row['thread_id'] for row in metadata_rows] == thread_ids
+
+
+@pytest.mark.usefixtures('database')
+def test_002_thread_rules_modify_whole_threads(service: MockGmailService, mailbox: Mailbox) -> None:
+    emails = mailbox(12, in_threads)
+    msg_ids = list(emails)
+    subject = service.parse_message_row(emails[msg_ids[4]])['subject']
+    rules = thread_rule(subject)
+
+    rule = rules.rules[0]
+    message_rule = rule.model_copy(update={'conditions': rule.conditions.model_copy(update={'scope': 'message'})})
+    assert message_rule.fingerprint != rule.fingerprint
+
+    def threads_in_spam() -> set[str]:
+        return {message['threadId'] for message in emails.values() if 'SPAM' in message['labelIds']}
+
+    mock = MockGmailService(None, emails=emails)  # type: ignore
+    metrics.reset()
+    manage_emails(mock, rules)
+    assert threads_in_spam() == {'thread-1'}
+    assert metrics.value('gmail_requests_total', method='threads.modify') == 1
+    assert metrics.value('gmail_requests_total', method='messages.batchModify') == 0
+
+    # A reply matching the rule brings the older emails of its thread along
+    mock._service.add_message({**emails[msg_ids[4]], 'id': 'reply', 'threadId': 'thread-2'})
+    manage_emails(mock, rules)
+    assert threads_in_spam() == {'thread-1', 'thread-2'}
+
+    with SessionFactory() as session:
+        rows = session.execute(select(Email.thread_id, Email.read).where(Email.thread_id == 'thread-2')).all()
+        assert rows == [('thread-2', True)] * 4
+
+
+@pytest.mark.usefixtures('database')
+def test_003_whole_threads_only_when_fewer_calls(mailbox: Mailbox) -> None:
+    emails = mailbox(12, in_threads)
+    msg_ids = list(emails)
+    threads = {msg_id: message['threadId'] for msg_id, message in emails.items()}
+    move_to_trash = LabelChange(add_labels=('TRASH',), remove_labels=('INBOX',), mailbox=MailBox.Trash)
+    mark_as_read = LabelChange(remove_labels=('UNREAD',), read=True)
+
+    mock = MockGmailService(None, emails=emails)  # type: ignore
+    load_emails(mock, since_last_commit=False)
+
+    with SessionFactory() as session:
+        metrics.reset()
+        # A whole thread, two whole threads which fit in one batchModify and a thread missing an email
+        changes = {move_to_trash: msg_ids[:3], mark_as_read: msg_ids[3:9] + msg_ids[9:11]}
+        results = [(len(ids), error) for ids, _, error in apply_label_changes(mock, session, changes, threads)]
+
+        assert results == [(3, None), (8, None)]
+        assert metrics.value('gmail_requests_total', method='threads.trash') == 1
+        assert metrics.value('gmail_requests_total', method='messages.batchModify') == 1
+        trashed = session.scalars(select(Email.mailbox).where(Email.thread_id == 'thread-0')).all()
+        assert trashed == [MailBox.Trash] * 3
+
+    assert all('TRASH' in emails[msg_id]['labelIds'] for msg_id in msg_ids[:3])
+    assert all('UNREAD' not in emails[msg_id]['labelIds'] for msg_id in msg_ids[3:11])
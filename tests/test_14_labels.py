@@ -0,0 +1,133 @@
+from typing import Any
+
+import pytest
+from pydantic import ValidationError
+from sqlalchemy import select, text
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email, EmailLabel, Label
+from email_reader.loader import load_emails
+from email_reader.logics.filters import FilterCondition, Rules
+from email_reader.logics.planner import RulePlanner
+from email_reader.manager import manage_emails
+from email_reader.metrics import metrics
+from email_reader.services.gmail import MockGmailService
+
+from .utils.fixtures import Mailbox
+
+LABELS = (['INBOX', 'Label_1'], ['INBOX', 'UNREAD', 'STARRED'], ['INBOX', 'Label_1', 'STARRED'], ['SPAM'])
+
+
+def labelled(index: int) -> dict[str, Any]:
+    return {'labelIds': list(LABELS[index % len(LABELS)])}
+
+
+@pytest.mark.usefixtures('database')
+def test_001_labels_are_stored_and_synced(mailbox: Mailbox) -> None:
+    emails = mailbox(12, labelled)
+    msg_ids = list(emails)
+
+    mock = MockGmailService(None, emails=emails)  # type: ignore
+    load_emails(mock, since_last_commit=False)
+
+    with SessionFactory() as session:
+        expected = {msg_id: set(message['labelIds']) for msg_id, message in emails.items()}
+        assert EmailLabel.get_labels(session, msg_ids) == expected
+        assert set(session.get(Email, msg_ids[2]).label_ids) == {'INBOX', 'Label_1', 'STARRED'}
+        ingest_seq = session.scalar(select(Email.ingest_seq).where(Email.id == msg_ids[0]))
+
+    # Starring leaves the mailbox and the read state alone, the history sync still picks it up
+    mock._service.change_labels(msg_ids[0], ['STARRED'], [])
+    load_emails(mock)
+
+    with SessionFactory() as session:
+        assert EmailLabel.get_labels(session, [msg_ids[0]]) == {msg_ids[0]: {'INBOX', 'Label_1', 'STARRED'}}
+        assert session.scalar(select(Email.ingest_seq).where(Email.id == msg_ids[0])) > ingest_seq
+        assert session.scalar(select(Email.ingest_seq).where(Email.id == msg_ids[1])) == ingest_seq
+
+
+@pytest.mark.usefixtures('database')
+def test_002_label_rules(mailbox: Mailbox) -> None:
+    emails = mailbox(12, labelled)
+    msg_ids = list(emails)
+    rules = Rules.model_validate({'rules': [{
+        'name': 'Done With Work',
+        'conditions': {'operator': 'ALL', 'rules': [
+            {'field': 'labels', 'predicate': 'Contains', 'value': 'Work'},
+            {'field': 'labels', 'predicate': 'DoesNotContain', 'value': 'SPAM'},
+        ]},
+        'actions': [{'type': 'add_label', 'label': 'Done'}, {'type': 'remove_label', 'label': 'STARRED'}],
+    }]})
+    work = [msg_id for msg_id in msg_ids if 'Label_1' in emails[msg_id]['labelIds']]
+
+    mock = MockGmailService(None, emails=emails)  # type: ignore
+    mock._service.add_label('Label_1', 'Work')
+    mock._service.add_label('Label_2', 'Done')
+    metrics.reset()
+    manage_emails(mock, rules)
+
+    # Starred and unstarred Work emails need different label changes, a batchModify call each
+    assert {msg_id for msg_id in msg_ids if 'Label_2' in emails[msg_id]['labelIds']} == set(work)
+    assert not any('STARRED' in emails[msg_id]['labelIds'] for msg_id in work)
+    assert metrics.value('gmail_requests_total', method='messages.batchModify') == 2
+
+    with SessionFactory() as session:
+        assert EmailLabel.get_labels(session, work) == {msg_id: {'INBOX', 'Label_1', 'Label_2'} for msg_id in work}
+
+        planner = RulePlanner(rules, label_ids={'Done': 'Label_2'})
+        assert all(plan.label_change is None for plan in planner.plan(session))
+
+        statement = planner.get_statement()
+        sql = str(statement.compile(session.get_bind(), compile_kwargs={'literal_binds': True}))
+        query_plan = ' '.join(row[-1] for row in session.execute(text(f'EXPLAIN QUERY PLAN {sql}')))
+        assert 'ix_email_label_label_id_email_id' in query_plan
+
+
+def test_003_label_action_validation() -> None:
+    def action(**kwargs) -> Rules:
+        return Rules.model_validate({'rules': [{
+            'name': 'Labels', 'actions': [kwargs],
+            'conditions': {'operator': 'ANY', 'rules': [{'field': 'labels', 'predicate': 'Contains', 'value': 'x'}]},
+        }]})
+
+    with pytest.raises(ValidationError, match='`label` must be provided'):
+        action(type='add_label')
+    with pytest.raises(ValidationError, match='Use `move_message`'):
+        action(type='remove_label', label='INBOX')
+    with pytest.raises(ValidationError, match='not support for Labels'):
+        Rules.model_validate({'rules': [{
+            'name': 'Labels', 'actions': [{'type': 'mark_as_read'}],
+            'conditions': {'operator': 'ANY', 'rules': [{'field': 'labels', 'predicate': 'Equals', 'value': 'x'}]},
+        }]})
+
+    rule = action(type='add_label', label='Missing').rules[0]
+    plan = RulePlanner(Rules(rules=[rule]), label_ids={}).plan_email({'id': 'x', 'mailbox': None, 'read': True}, [0])
+    assert plan.errors == [(rule.actions[0], 'LabelNotFound')]
+
+
+@pytest.mark.usefixtures('database')
+def test_004_label_predicates_match_statements(mailbox: Mailbox) -> None:
+    mock = MockGmailService(None, emails=mailbox(12, labelled))  # type: ignore
+    mock._service.add_label('Label_1', 'Work')
+    load_emails(mock, since_last_commit=False)
+
+    conditions = [
+        FilterCondition.model_validate({'operator': operator, 'rules': [
+            {'field': 'labels', 'predicate': predicate, 'value': value} for predicate, value in rules
+        ]}) for operator, rules in [
+            ('ALL', [('Contains', 'Work'), ('DoesNotContain', 'STARRED')]),
+            ('ANY', [('Contains', 'SPAM'), ('Contains', 'Missing')]),
+            ('ALL', [('DoesNotContain', 'Label_1')]),
+        ]
+    ]
+
+    with SessionFactory() as session:
+        Label.sync(session, mock.list_labels())
+        label_ids = Label.get_ids(session)
+        labels = EmailLabel.get_labels(session, list(session.scalars(select(Email.id))))
+        emails = [{'id': msg_id, 'label_ids': labels.get(msg_id)} for msg_id in session.scalars(select(Email.id))]
+
+        for condition in conditions:
+            predicate = condition.get_predicate(label_ids)
+            expected = set(session.scalars(select(Email.id).where(condition.get_statement())))
+            assert expected and {email['id'] for email in emails if predicate(email)} == expected
@@ -0,0 +1,251 @@
+import asyncio
+from typing import Any, Iterable, Iterator, Optional
+
+import pytest
+from sqlalchemy import func, select
+
+from email_reader.database.engine import SessionFactory
+from email_reader.database.tables import Email, SyncState
+from email_reader.loader import UnfetchedEmailsError, load_emails
+from email_reader.metrics import metrics
+from email_reader.services.gmail import MockGmailService
+
+from .utils.fixtures import Mailbox
+
+PAGE_SIZE = 20
+
+
+class InterruptedMockGmailService(MockGmailService):
+    """Lists `PAGE_SIZE` emails per page and fails once `fail_after` emails are fetched, as an expired token would"""
+
+    fail_after: Optional[int] = None
+
+    def list_message_pages(
+            self, query: Optional[str] = None, page_token: Optional[str] = None,
+            page_size: int = PAGE_SIZE) -> Iterator[tuple[Optional[str], list[str]]]:
+        return super().list_message_pages(query, page_token, page_size)
+
+    def get_email_rows_by_ids(self, msg_ids: Iterable[str]) -> Iterator[dict[str, Any]]:
+        for fetched, row in enumerate(super().get_email_rows_by_ids(msg_ids)):
+            if self.fail_after is not None and fetched >= self.fail_after:
+                raise RuntimeError('Token Has Expired')
+            yield row
+
+
+def fetched_ids(service: MockGmailService, run) -> list[str]:
+    fetched: list[str] = []
+    get_email_rows_by_ids = service.get_email_rows_by_ids
+
+    def record(msg_ids: Iterable[str]) -> Iterator[dict[str, Any]]:
+        for row in get_email_rows_by_ids(msg_ids):
+            fetched.append(row['id'])
+            yield row
+
+    service.get_email_rows_by_ids = record  # type: ignore[method-assign]
+    try:
+        run()
+    finally:
+        del service.get_email_rows_by_ids
+    return fetched
+
+
+@pytest.mark.usefixtures('database')
+def test_001_interrupted_sync_resumes(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+    msg_ids = list(emails)
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    mock.fail_after = 35
+    with pytest.raises(RuntimeError, match='Token Has Expired'):
+        load_emails(mock, since_last_commit=False, chunk_size=10)
+
+    with SessionFactory() as session:
+        # Three chunks committed, the last one ends on the second page
+        assert session.scalar(select(func.count(Email.id))) == 30
+        state = SyncState.get_listing(session)
+        assert state is not None and state.listing_page_token == str(PAGE_SIZE)
+        assert state.history_id is None
+
+    mock.fail_after = None
+    metrics.reset()
+    fetched = fetched_ids(mock, lambda: load_emails(mock, chunk_size=10))
+
+    # Only the emails of the second page which were not committed are fetched again
+    assert fetched == msg_ids[30:]
+    assert metrics.value('gmail_requests_total', method='messages.list') == 2
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        assert SyncState.get_history_id(session) is not None
+        assert session.scalar(select(func.count(Email.id))) == 60
+
+    # The cursor of the finished listing is in place, the next load is a history sync
+    assert fetched_ids(mock, lambda: load_emails(mock, chunk_size=10)) == []
+
+
+@pytest.mark.usefixtures('database')
+def test_002_no_resume_starts_over(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    mock.fail_after = 25
+    with pytest.raises(RuntimeError):
+        load_emails(mock, since_last_commit=False, chunk_size=10)
+
+    mock.fail_after = None
+    fetched = fetched_ids(mock, lambda: load_emails(mock, since_last_commit=False, chunk_size=10, resume=False))
+    assert fetched == list(emails)
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+
+
+@pytest.mark.usefixtures('database')
+def test_003_interrupted_async_sync_resumes(mailbox: Mailbox) -> None:
+    pytest.importorskip('httpx')
+    from email_reader.loader import load_emails_async
+    from email_reader.services.async_gmail import AsyncMockGmailService
+
+    emails = mailbox(60)
+    msg_ids = list(emails)
+
+    class InterruptedAsyncMockGmailService(AsyncMockGmailService):
+        fail_after: Optional[int] = None
+        fetched: list[str] = []
+
+        def list_message_pages(self, query=None, page_token=None, page_size=PAGE_SIZE):
+            return super().list_message_pages(query, page_token, page_size)
+
+        async def get_email_rows_by_ids(self, msg_ids):
+            async for row in super().get_email_rows_by_ids(msg_ids):
+                if self.fail_after is not None and len(self.fetched) >= self.fail_after:
+                    raise RuntimeError('Token Has Expired')
+                self.fetched.append(row['id'])
+                yield row
+
+    async def load(fail_after: Optional[int]) -> list[str]:
+        async with InterruptedAsyncMockGmailService(emails=emails) as async_service:
+            async_service.fail_after, async_service.fetched = fail_after, []
+            await load_emails_async(async_service, since_last_commit=False, chunk_size=10)
+            return async_service.fetched
+
+    with pytest.raises(RuntimeError, match='Token Has Expired'):
+        asyncio.run(load(45))
+
+    assert asyncio.run(load(None)) == msg_ids[40:]
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        assert session.scalar(select(func.count(Email.id))) == 60
+
+
+@pytest.mark.usefixtures('database')
+def test_004_full_sync_does_not_resume_incremental_listing(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+
+    with SessionFactory.begin() as session:
+        # An incremental listing interrupted on its second page
+        SyncState.start_listing(session, '1', 'after:1', ingest_seq=1)
+        SyncState.set_listing_page(session, str(PAGE_SIZE))
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    fetched = fetched_ids(mock, lambda: load_emails(mock, since_last_commit=False, chunk_size=10))
+    assert fetched == list(emails)
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        assert session.scalar(select(func.count(Email.id))) == 60
+
+
+@pytest.mark.usefixtures('database')
+def test_005_expired_page_token_restarts_listing(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+    msg_ids = list(emails)
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    mock.fail_after = 35
+    with pytest.raises(RuntimeError, match='Token Has Expired'):
+        load_emails(mock, since_last_commit=False, chunk_size=10)
+
+    with SessionFactory.begin() as session:
+        SyncState.set_listing_page(session, 'expired')
+
+    mock.fail_after = None
+    fetched = fetched_ids(mock, lambda: load_emails(mock, chunk_size=10))
+
+    # The listing starts over from the first page, the emails already written are not fetched again
+    assert fetched == msg_ids[30:]
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        assert session.scalar(select(func.count(Email.id))) == 60
+
+
+@pytest.mark.usefixtures('database')
+def test_006_unfetched_emails_are_fetched_by_the_next_load(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+    msg_ids = list(emails)
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    mock.fetcher.backoff = 0
+    mock._service.transient_failures = {msg_ids[25]: 100}
+    with pytest.raises(UnfetchedEmailsError):
+        load_emails(mock, since_last_commit=False, chunk_size=10)
+
+    with SessionFactory() as session:
+        # The listing stays on the page of the email which could not be fetched
+        state = SyncState.get_listing(session)
+        assert state is not None and state.listing_page_token == str(PAGE_SIZE)
+        assert session.scalar(select(func.count(Email.id))) == 59
+
+    mock._service.transient_failures = {}
+    assert fetched_ids(mock, lambda: load_emails(mock, chunk_size=10)) == [msg_ids[25]]
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        history_id = SyncState.get_history_id(session)
+
+    # An email added since is fetched by the next history sync, which fails without moving the cursor
+    added = {**emails[msg_ids[0]], 'id': 'unfetched-email'}
+    mock._service.add_message(added)
+    mock._service.transient_failures = {'unfetched-email': 100}
+    with pytest.raises(UnfetchedEmailsError):
+        load_emails(mock, chunk_size=10)
+
+    with SessionFactory() as session:
+        assert SyncState.get_history_id(session) == history_id
+
+    mock._service.transient_failures = {}
+    assert fetched_ids(mock, lambda: load_emails(mock, chunk_size=10)) == ['unfetched-email']
+
+    with SessionFactory() as session:
+        assert SyncState.get_history_id(session) != history_id
+        assert session.scalar(select(func.count(Email.id))) == 61
+
+
+@pytest.mark.usefixtures('database')
+def test_007_no_resume_drops_interrupted_listing(mailbox: Mailbox) -> None:
+    emails = mailbox(60)
+    msg_ids = list(emails)
+
+    mock = InterruptedMockGmailService(None, emails=emails)  # type: ignore
+    load_emails(mock, chunk_size=10)
+
+    # A sync from the beginning is interrupted, then a history sync runs without resuming it
+    mock.fail_after = 25
+    with pytest.raises(RuntimeError):
+        load_emails(mock, since_last_commit=False, chunk_size=10)
+    mock.fail_after = None
+
+    added = {**emails[msg_ids[0]], 'id': 'added-email'}
+    mock._service.add_message(added)
+    assert fetched_ids(mock, lambda: load_emails(mock, chunk_size=10, resume=False)) == ['added-email']
+
+    with SessionFactory() as session:
+        assert SyncState.get_listing(session) is None
+        history_id = SyncState.get_history_id(session)
+
+    # The next load is a history sync from the cursor of the last one, not the resumed listing
+    assert fetched_ids(mock, lambda: load_emails(mock, chunk_size=10)) == []
+    with SessionFactory() as session:
+        assert SyncState.get_history_id(session) == history_id
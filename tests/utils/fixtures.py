@@ -0,0 +1,4 @@
+from typing import Any, Callable
+
+# Type of the `mailbox` fixture, `mailbox(count, fields)` builds a mailbox from the test emails
+Mailbox = Callable[..., dict[str, dict[str, Any]]]